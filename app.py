@@ -1,64 +1,81 @@
-from flask import Flask, redirect, render_template, flash, url_for
+from flask import Flask, redirect, render_template, flash, url_for, session
 from flask_login import LoginManager, login_user, logout_user
 from flask_authorize import Authorize
-from flask_debugtoolbar import DebugToolbarExtension
 from models.user_models import User
-from models.db import connect_db
+from models.user_cache import get_principal
+from models.db import connect_db, init_query_stats
+from models.metrics import init_metrics
 from forms import LoginForm
-import os
-from dotenv import load_dotenv
+from config import configs, default_config_name
 
-load_dotenv()
+login_manager = LoginManager()
+login_manager.login_view = 'login'
 
-app = Flask(__name__)
+def create_app(config_name=None):
+    """Create the omakase app with the 'production', 'development' or 'testing' configuration
 
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL','postgresql:///omakase'))
+    config_name defaults to the APP_CONFIG environment variable, see config.py
+    """
+    app = Flask(__name__)
+    app.config.from_object(configs[config_name or default_config_name()])
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-# Use os.environ here to protect SECRET_KEY
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    if app.config['DEBUG_TB_ENABLED']:
+        # imported here so production never loads the toolbar
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
 
-debug = DebugToolbarExtension(app)
-login = LoginManager(app)
-authorize = Authorize(app)
+    login_manager.init_app(app)
+    Authorize(app)
 
-connect_db(app)
-app.app_context().push()
+    connect_db(app)
+    init_query_stats(app)
+    init_metrics(app)
 
-############# Register Flask Blueprints ############
-from blueprints.customers.customers_routes import customers_bp
-app.register_blueprint(customers_bp)
+    ############# Register Flask Blueprints ############
+    # blueprints set up Flask-Authorize with current_app when first imported
+    with app.app_context():
+        from blueprints.customers.customers_routes import customers_bp
+        app.register_blueprint(customers_bp)
 
-from blueprints.employees.employees_routes import employees_bp
-app.register_blueprint(employees_bp, url_prefix='/employees')
+        from blueprints.employees.employees_routes import employees_bp
+        app.register_blueprint(employees_bp, url_prefix='/employees')
 
-from blueprints.api.api_routes import api_bp
-app.register_blueprint(api_bp, url_prefix='/omakase/api')
-####################################################
+        from blueprints.api.api_routes import api_bp
+        app.register_blueprint(api_bp, url_prefix='/omakase/api')
 
-@login.user_loader
+        from blueprints.internal.internal_routes import internal_bp
+        app.register_blueprint(internal_bp)
+    ####################################################
+
+    from commands import orders_cli, menu_cli, users_cli
+    app.cli.add_command(orders_cli)
+    app.cli.add_command(menu_cli)
+    app.cli.add_command(users_cli)
+
+    app.register_error_handler(401, unauthorized_access)
+    app.register_error_handler(404, not_found)
+    app.add_url_rule('/login', view_func=login, methods=['GET', 'POST'])
+    app.add_url_rule('/logout', view_func=logout, methods=['POST'])
+
+    return app
+
+@login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    """Get the logged in user's cached principal, with their role and group names"""
+    return get_principal(int(user_id))
 
-@app.errorhandler(401)
 def unauthorized_access(e):
     """Handle unauthorized access error"""
 
     # note that we set the 401 status explicitly
     return render_template('/error_pages/custom_error.html', e=e), 401
-@app.errorhandler(404)
+
 def not_found(e):
     """Handle not found error"""
 
     # note that we set the 404 status explicitly
     return render_template('/error_pages/custom_error.html', e=e), 404
 
-login.login_view = 'login'
-
-@app.route('/login', methods=['GET', 'POST'])
 def login():
     form = LoginForm()
 
@@ -68,15 +85,19 @@ def login():
             flash('User credentials incorrect, check username and password', 'danger')
             return redirect(url_for('login'))
         login_user(user)
+        if user.restaurant_id:
+            session['restaurant_id'] = user.restaurant_id
 
         flash(f'Welcome back {user.username}', 'success')
         return redirect(url_for('employees.dashboard'))
-        
+
     return render_template('login.html', form=form)
 
-@app.route('/logout', methods=['POST'])
 def logout():
     logout_user()
 
     flash('Successfully logged out', 'success')
     return redirect(url_for('customers.landing_page'))
+
+# for `flask run`, gunicorn app:app, the seed script and tests
+app = create_app()
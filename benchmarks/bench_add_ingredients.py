@@ -0,0 +1,56 @@
+"""Benchmark adding ingredients to a menu item against a 100,000 ingredient catalog
+
+Compares the old MenuItem.add_ingredients, which loaded the whole catalog to check
+names and appended links one by one over two commits, against the bulk upsert.
+"""
+
+import random
+from benchmarks.common import db, reset_db, measure
+from models.item_models import MenuItem, Ingredient, ItemIngredient
+
+CATALOG_SIZE = 100000
+INGREDIENTS_PER_DISH = 12
+NEW_PER_DISH = 4
+DISHES = 5
+
+def seed():
+    reset_db()
+    db.session.execute(Ingredient.__table__.insert(), [{'name': f'ingredient {i}'} for i in range(CATALOG_SIZE)])
+    db.session.execute(MenuItem.__table__.insert(), [
+        {'name': f'dish {i}', 'meal_type': 'entree', 'cost': 10} for i in range(DISHES * 2)
+    ])
+    db.session.commit()
+
+def dish_ingredients(dish):
+    """Mostly existing ingredient names, with a few new to the catalog"""
+    names = [f'ingredient {i}' for i in random.sample(range(CATALOG_SIZE), INGREDIENTS_PER_DISH - NEW_PER_DISH)]
+    return names + [f'new ingredient {dish} {i}' for i in range(NEW_PER_DISH)]
+
+def legacy_add_ingredients(ingr_names_add, menu_item_id):
+    """MenuItem.add_ingredients as it was"""
+    ingredient_names = [i.name for i in Ingredient.query.all()]
+
+    new_ingredients = [Ingredient(name=i) for i in ingr_names_add if i and i not in ingredient_names]
+    db.session.add_all(new_ingredients)
+    db.session.commit()
+
+    menu_item = MenuItem.query.get_or_404(menu_item_id)
+    for i in Ingredient.query.filter(Ingredient.name.in_(ingr_names_add)):
+        menu_item.ingredients.append(i)
+    db.session.commit()
+
+    return menu_item
+
+if __name__ == '__main__':
+    seed()
+    print(f'\n{CATALOG_SIZE} ingredients in the catalog, {INGREDIENTS_PER_DISH} per dish, {NEW_PER_DISH} of them new')
+
+    with measure(f'legacy add_ingredients x{DISHES}'):
+        for dish in range(1, DISHES + 1):
+            legacy_add_ingredients(dish_ingredients(dish), dish)
+
+    with measure(f'bulk add_ingredients x{DISHES}'):
+        for dish in range(DISHES + 1, DISHES * 2 + 1):
+            MenuItem.add_ingredients(dish_ingredients(dish), dish)
+
+    assert ItemIngredient.query.count() == DISHES * 2 * INGREDIENTS_PER_DISH
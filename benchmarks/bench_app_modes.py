@@ -0,0 +1,57 @@
+"""Benchmark startup time and per request overhead of the app configurations
+
+Each configuration runs in a fresh interpreter, so startup includes importing
+the app and its extensions, eg. the DebugToolbar in development. Requests
+render the landing page, an HTML page the toolbar injects itself into.
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+MODES = ['production', 'development', 'testing']
+REQUESTS = 500
+
+def run_mode():
+    """Time importing the app and serving requests, in a process started with APP_CONFIG set"""
+    start = time.perf_counter()
+    from app import app
+    startup = time.perf_counter() - start
+
+    client = app.test_client()
+    client.get('/')
+
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        client.get('/')
+    per_request = (time.perf_counter() - start) / REQUESTS
+
+    print(json.dumps({'startup': startup, 'per_request': per_request,
+                      'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+
+def main():
+    # imported here, as benchmarks.common imports the app with the testing configuration
+    from benchmarks.common import db, reset_db
+    from models.restaurant_models import Restaurant
+
+    reset_db()
+    db.session.add(Restaurant(name='Example Restaurant', address='52 Main Street'))
+    db.session.commit()
+
+    print(f'{"config":<15} {"startup":>12} {"per request":>14} {"max rss":>10}')
+    for mode in MODES:
+        env = {**os.environ, 'APP_CONFIG': mode, 'SECRET_KEY': os.environ.get('SECRET_KEY') or 'bench'}
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_app_modes', 'child'],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        print(f'{mode:<15} {result["startup"] * 1000:>9.1f} ms {result["per_request"] * 1000:>11.2f} ms '
+              f'{result["max_rss_mb"]:>7.1f} MB')
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['child']:
+        run_mode()
+    else:
+        main()
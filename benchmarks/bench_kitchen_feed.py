@@ -0,0 +1,90 @@
+"""Load test the kitchen display feed: 20 screens polling 500 active orders
+
+Each screen polls the kitchen tickets API once a second, as static/scripts/kitchen.js
+does, while a writer keeps adding items to random orders. Compares screens reloading
+every active order on each poll against polling with the cursor for changes only.
+"""
+
+import random
+import statistics
+import time
+from threading import Event, Thread
+from benchmarks.common import app, db, reset_db, measure
+from models.item_models import MenuItem
+from models.order_models import Order, OrderedItems
+
+ACTIVE_ORDERS = 500
+LINES_PER_ORDER = 3
+SCREENS = 20
+POLLS_PER_SCREEN = 10
+POLL_INTERVAL = 1
+WRITE_INTERVAL = 0.05
+
+def seed():
+    reset_db()
+    db.session.execute(MenuItem.__table__.insert(), [
+        {'name': f'item {i}', 'meal_type': 'entree', 'cost': round(random.uniform(1, 30), 2)}
+        for i in range(50)
+    ])
+    db.session.execute(Order.__table__.insert(), [
+        {'type': random.choice(['Dining In', 'Takeout', 'Delivery'])} for _ in range(ACTIVE_ORDERS)
+    ])
+    db.session.execute(OrderedItems.__table__.insert(), [
+        {'order_id': order_id, 'menu_item_id': menu_item_id, 'quantity': random.randint(1, 4)}
+        for order_id in range(1, ACTIVE_ORDERS + 1)
+        for menu_item_id in random.sample(range(1, 51), LINES_PER_ORDER)
+    ])
+    db.session.commit()
+
+def writer(stop):
+    """Add an item to a random order every WRITE_INTERVAL seconds until stopped"""
+    with app.app_context():
+        while not stop.is_set():
+            OrderedItems.add_items(random.randint(1, ACTIVE_ORDERS), {random.randint(1, 50): 1})
+            time.sleep(WRITE_INTERVAL)
+        db.session.remove()
+
+def screen(incremental, latencies):
+    client = app.test_client()
+    cursor = None
+    for _ in range(POLLS_PER_SCREEN):
+        params = {'since': cursor} if incremental and cursor else {}
+        start = time.perf_counter()
+        resp = client.get('/omakase/api/kitchen/tickets', query_string=params)
+        latencies.append(time.perf_counter() - start)
+        assert resp.status_code == 200
+        cursor = resp.json['cursor']
+        time.sleep(POLL_INTERVAL)
+
+def run(incremental):
+    label = 'cursor polls (changes only)' if incremental else 'full reload polls'
+    latencies = []
+    stop = Event()
+    write_thread = Thread(target=writer, args=(stop,))
+    write_thread.start()
+
+    screens = [Thread(target=screen, args=(incremental, latencies)) for _ in range(SCREENS)]
+    for t in screens:
+        t.start()
+    for t in screens:
+        t.join()
+
+    stop.set()
+    write_thread.join()
+
+    latencies = sorted(l * 1000 for l in latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f'{label:<45} {len(latencies):>5} polls  p50 {statistics.median(latencies):>7.1f} ms  p95 {p95:>7.1f} ms')
+
+if __name__ == '__main__':
+    seed()
+    print(f'\n{ACTIVE_ORDERS} active orders, {LINES_PER_ORDER} lines each, {SCREENS} screens')
+
+    client = app.test_client()
+    with measure('one full reload poll'):
+        cursor = client.get('/omakase/api/kitchen/tickets').json['cursor']
+    with measure('one cursor poll'):
+        client.get('/omakase/api/kitchen/tickets', query_string={'since': cursor})
+
+    run(incremental=False)
+    run(incremental=True)
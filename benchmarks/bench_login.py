@@ -0,0 +1,71 @@
+"""Benchmark a shift change login burst on one gunicorn worker
+
+Simulates a threaded worker (WORKER_THREADS request threads) taking LOGINS logins at
+once while other requests for the cached menu keep coming in. Compares checking
+passwords with flask_bcrypt on the request threads, as before, against
+User.Authenticate() with at most PASSWORD_HASH_WORKERS hashes at once, reporting login
+throughput and the latency of the other requests during the burst.
+"""
+
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+from flask_bcrypt import Bcrypt
+from benchmarks.common import app, db, reset_db
+from models.passwords import hash_passwords
+from models.user_models import User
+
+ROUNDS = 12
+USERS = 20
+LOGINS = 80
+WORKER_THREADS = 8
+
+flask_bcrypt = Bcrypt()
+
+def seed():
+    reset_db()
+    passwords = hash_passwords([f'password{i}' for i in range(USERS)], rounds=ROUNDS)
+    db.session.add_all([User(name=f'employee {i}', uname=f'employee{i}', password=pw) for i, pw in enumerate(passwords)])
+    db.session.commit()
+
+def authenticate_on_request_thread(username, password):
+    """User.Authenticate() as it was, checking with flask_bcrypt on the calling thread"""
+    user = User.query.filter(User.uname == username).first()
+    if user and flask_bcrypt.check_password_hash(user.password, password):
+        return user
+
+def other_requests(stop, latencies):
+    client = app.test_client()
+    while not stop.is_set():
+        start = time.perf_counter()
+        client.get('/omakase/api/menu/list_menu_items')
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.01)
+
+def run(label, authenticate):
+    def login(i):
+        with app.app_context():
+            assert authenticate(f'employee{i % USERS}', f'password{i % USERS}')
+            db.session.remove()
+
+    stop, latencies = Event(), []
+    requests = Thread(target=other_requests, args=(stop, latencies))
+    requests.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=WORKER_THREADS) as request_threads:
+        list(request_threads.map(login, range(LOGINS)))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    requests.join()
+    latencies.sort()
+    print(f'{label:<32} {LOGINS / elapsed:>8.1f} logins/s   other requests: '
+          f'p50 {statistics.median(latencies) * 1000:>6.1f} ms  p95 {latencies[int(len(latencies) * 0.95)] * 1000:>6.1f} ms')
+
+if __name__ == '__main__':
+    app.config['BCRYPT_LOG_ROUNDS'] = ROUNDS
+    seed()
+    run('flask_bcrypt on request threads', authenticate_on_request_thread)
+    run('bounded concurrent hashes', User.Authenticate)
@@ -0,0 +1,63 @@
+"""Benchmark menu search against a 100,000 item catalog across 50 restaurants
+
+Compares a case insensitive LIKE scan over names and descriptions, which is what
+search looks like without an index, against MenuItem.search() on the GIN indexed
+search_vector, for type-ahead prefixes across all restaurants and within one.
+"""
+
+import random
+from benchmarks.common import db, reset_db, measure
+from models.item_models import MenuItem
+from models.restaurant_models import Restaurant
+
+CATALOG_SIZE = 100000
+RESTAURANTS = 50
+BATCH_SIZE = 1000
+QUERIES = ['sp', 'spag', 'chick cur', 'garlic', 'tof', 'lemon tart']
+RUNS = 20
+
+# a few real dish words among made up ones, so each word is in about as many items as in a real catalog
+WORDS = ['spaghetti', 'chicken', 'curry', 'garlic', 'tofu', 'lemon', 'tart', 'beef', 'noodle', 'soup',
+         'salad', 'roasted', 'grilled', 'spicy', 'sweet', 'pork', 'rice', 'dumpling', 'basil', 'miso']
+WORDS += [''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=random.randint(4, 9))) for _ in range(2000)]
+
+def seed():
+    reset_db()
+    db.session.add_all([Restaurant(name=f'restaurant {i}', address=f'{i} Main St.') for i in range(RESTAURANTS)])
+    db.session.commit()
+
+    for batch in range(CATALOG_SIZE // BATCH_SIZE):
+        MenuItem.import_items([{
+            'name': ' '.join(random.sample(WORDS, 3)) + f' {batch}-{i}',
+            'meal_type': 'entree',
+            'cost': 10,
+            'description': ' '.join(random.choices(WORDS, k=8)),
+            'ingredients': random.sample(WORDS, 3),
+        } for i in range(BATCH_SIZE)], restaurant_id=batch % RESTAURANTS + 1)
+
+    db.session.execute('ANALYZE')
+    db.session.commit()
+
+def like_search(q, restaurant_id=None):
+    query = MenuItem.query
+    for word in q.split():
+        query = query.filter(db.or_(MenuItem.name.ilike(f'%{word}%'), MenuItem.description.ilike(f'%{word}%')))
+    if restaurant_id is not None:
+        query = query.filter(MenuItem.restaurants.any(id=restaurant_id))
+    return query.limit(20).all()
+
+if __name__ == '__main__':
+    seed()
+    print(f'\n{CATALOG_SIZE} menu items across {RESTAURANTS} restaurants, {RUNS} runs of {len(QUERIES)} queries each')
+
+    for restaurant_id in (None, 7):
+        scope = 'all restaurants' if restaurant_id is None else 'one restaurant'
+        with measure(f'ILIKE scan, {scope}'):
+            for _ in range(RUNS):
+                for q in QUERIES:
+                    like_search(q, restaurant_id)
+
+        with measure(f'MenuItem.search() tsvector, {scope}'):
+            for _ in range(RUNS):
+                for q in QUERIES:
+                    MenuItem.search(q, restaurant_id=restaurant_id).all()
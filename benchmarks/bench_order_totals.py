@@ -0,0 +1,63 @@
+"""Benchmark order totals: per-item lookups vs. set-based aggregate
+
+Compares the old Order.total_cost loop (one MenuItem query per ordered line)
+against Order.totals() and the total_cost hybrid expression for 1, 100 and 10,000 orders.
+"""
+
+import random
+from benchmarks.common import db, reset_db, measure
+from models.item_models import MenuItem
+from models.order_models import Order, OrderedItems
+
+ORDER_COUNTS = [1, 100, 10000]
+LINES_PER_ORDER = 3
+
+def seed(num_orders):
+    reset_db()
+    db.session.execute(MenuItem.__table__.insert(), [
+        {'name': f'item {i}', 'meal_type': 'entree', 'cost': round(random.uniform(1, 30), 2)}
+        for i in range(50)
+    ])
+    db.session.execute(Order.__table__.insert(), [
+        {'type': random.choice(['Dining In', 'Takeout', 'Delivery'])} for _ in range(num_orders)
+    ])
+    db.session.execute(OrderedItems.__table__.insert(), [
+        {'order_id': order_id, 'menu_item_id': menu_item_id, 'quantity': random.randint(1, 4)}
+        for order_id in range(1, num_orders + 1)
+        for menu_item_id in random.sample(range(1, 51), LINES_PER_ORDER)
+    ])
+    db.session.commit()
+
+def legacy_total(order):
+    """Order.total_cost as it was, one query per ordered line"""
+    total = 0
+    for item in order.ordered_items:
+        total += item.quantity * MenuItem.query.filter_by(id=item.menu_item_id).first().cost
+    if order.type == 'Delivery':
+        total += 5
+    return round(total, 2)
+
+def run(num_orders):
+    seed(num_orders)
+    print(f'\n{num_orders} orders, {LINES_PER_ORDER} lines each')
+
+    orders = Order.query.all()
+    order_ids = [o.id for o in orders]
+    with measure('per-item queries (legacy total_cost)'):
+        legacy = {o.id: legacy_total(o) for o in orders}
+    db.session.expire_all()
+
+    with measure('Order.totals() batch'):
+        totals = Order.totals(order_ids)
+
+    with measure('query(Order.id, Order.total_cost)'):
+        db.session.query(Order.id, Order.total_cost).all()
+
+    with measure('filter + sort on Order.total_cost'):
+        Order.query.filter(Order.total_cost > 20).order_by(Order.total_cost.desc()).all()
+
+    assert legacy == totals
+
+if __name__ == '__main__':
+    for n in ORDER_COUNTS:
+        run(n)
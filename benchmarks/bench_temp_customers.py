@@ -0,0 +1,103 @@
+"""Benchmark purging 2,000,000 temporary customers, three quarters of them stale
+
+Every takeout and delivery order used to add a temporary customer, so the users
+table only grew. Compares deleting stale customers in one statement, which holds
+its row locks until every one is gone, against User.purge_temp_customers() in
+batches of 1000, reporting the total time and the longest transaction of each.
+Also times returning customers found by phone number, and counting every user
+before and after the purge.
+"""
+
+import time
+from datetime import timedelta
+from benchmarks.common import db, reset_db, measure
+from models.order_models import Order, CustomerOrder
+from models.restaurant_models import Restaurant
+from models.user_models import User, Group
+
+TEMP_CUSTOMERS = 2000000
+EMPLOYEES = 50
+# customers are last seen up to this many days ago, so with RETENTION three quarters are stale
+SPREAD_DAYS = 120
+RETENTION = timedelta(days=30)
+LINKED_EVERY = 10
+BATCH_SIZE = 1000
+RETURNING = 200
+
+def seed():
+    reset_db()
+    db.session.add(Restaurant(name='restaurant', address='1 Main St.'))
+    db.session.add_all([Group(name='employee'), Group(name='customer')])
+    db.session.commit()
+
+    db.session.execute("""
+        INSERT INTO users (name, temp, restaurant_id)
+        SELECT 'employee ' || i, false, 1 FROM generate_series(1, :employees) AS i
+    """, {'employees': EMPLOYEES})
+    db.session.execute("""
+        INSERT INTO users (name, temp, phone_number, last_seen_at)
+        SELECT 'customer ' || i, true, 'phone ' || i, localtimestamp - random() * :spread * interval '1 day'
+        FROM generate_series(1, :customers) AS i
+    """, {'customers': TEMP_CUSTOMERS, 'spread': SPREAD_DAYS})
+    db.session.execute("""
+        INSERT INTO user_group (user_id, group_id)
+        SELECT users.id, groups.id FROM users JOIN groups ON groups.name = CASE WHEN users.temp THEN 'customer' ELSE 'employee' END
+    """)
+    # one order for every LINKED_EVERY customers, linked to them
+    db.session.execute("""
+        INSERT INTO orders (restaurant_id, type, active, need_assistance, timestamp, updated_at)
+        SELECT 1, 'Takeout', false, false, localtimestamp, localtimestamp FROM generate_series(1, :orders)
+    """, {'orders': TEMP_CUSTOMERS // LINKED_EVERY})
+    db.session.execute("""
+        INSERT INTO customers_orders (customer_id, order_id)
+        SELECT customers.id, orders.id
+        FROM (SELECT id, row_number() OVER (ORDER BY id) AS n FROM users WHERE temp) AS customers
+        JOIN (SELECT id, row_number() OVER (ORDER BY id) AS n FROM orders) AS orders ON customers.n = orders.n * :every
+    """, {'every': LINKED_EVERY})
+    db.session.execute('ANALYZE')
+    db.session.commit()
+
+def stale_count():
+    return User.query.filter(User.temp, User.last_seen_at < db.func.localtimestamp() - RETENTION).count()
+
+def delete_in_one_statement():
+    """Delete every stale customer in one transaction, links going through the foreign key cascades"""
+    User.query.filter(User.temp, User.last_seen_at < db.func.localtimestamp() - RETENTION).delete(synchronize_session=False)
+    db.session.commit()
+
+def returning_customers():
+    for i in range(1, RETURNING + 1):
+        User.register_customer({'contact_info': {'name': f'customer {i}', 'phone_number': f'phone {i * 997}'}})
+
+def count_users():
+    return db.session.query(db.func.count(User.id)).scalar()
+
+if __name__ == '__main__':
+    seed()
+    print(f'\n{TEMP_CUSTOMERS} temporary customers, {stale_count()} of them not seen for {RETENTION.days} days')
+
+    with measure(f'{RETURNING} returning customers by phone'):
+        returning_customers()
+    with measure('count every user, before purge'):
+        count_users()
+
+    start = time.perf_counter()
+    with measure('single DELETE statement'):
+        delete_in_one_statement()
+    print(f'{"  longest transaction":<45} {(time.perf_counter() - start) * 1000:>25.1f} ms')
+
+    seed()
+    longest = 0
+    with measure(f'purge_temp_customers(), batches of {BATCH_SIZE}'):
+        batches = User.purge_temp_customers(RETENTION, BATCH_SIZE)
+        while True:
+            start = time.perf_counter()
+            if next(batches, None) is None:
+                break
+            longest = max(longest, time.perf_counter() - start)
+    print(f'{"  longest transaction":<45} {longest * 1000:>25.1f} ms')
+
+    with measure('count every user, after purge'):
+        count_users()
+    print(f'{User.query.filter_by(temp=True).count()} temporary customers left, '
+          f'{db.session.query(CustomerOrder).count()} order links, {Order.query.count()} orders')
@@ -0,0 +1,35 @@
+"""Shared setup for the omakase benchmarks
+
+Benchmarks run against the test database, which they drop and recreate.
+Run them from the project root like:
+
+    python -m benchmarks.bench_order_totals
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+# Before importing app, point it at the test db so benchmarks never touch real data
+os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
+
+from app import app
+app.app_context().push()
+from models.db import db, QueryCounter
+
+def reset_db():
+    """Drop and recreate all tables"""
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+@contextmanager
+def measure(label):
+    """Print number of queries and elapsed time for the wrapped block"""
+    with QueryCounter() as counter:
+        start = time.perf_counter()
+        yield counter
+        elapsed = time.perf_counter() - start
+
+    print(f'{label:<45} {counter.count:>8} queries {elapsed * 1000:>10.1f} ms')
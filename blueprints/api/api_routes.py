@@ -1,35 +1,113 @@
 ############ Omakase API  Blueprint############
-from flask import Blueprint, jsonify, request
-from models.item_models import MenuItem
-from models.order_models import Order, OrderedItems
+from datetime import datetime
+from flask import Blueprint, jsonify, request, abort, Response, stream_with_context, current_app, session
+from flask_authorize import Authorize
+from flask_login import current_user
+from models.item_models import MenuItem, SEARCH_LIMIT
+from models.order_models import Order, OrderedItems, PAGE_SIZE
 from models.db import db
+from models.menu_cache import get_menu_payload
+
+authorize = Authorize(current_app)
 
 api_bp = Blueprint('api', __name__)
 
 ##########ORDER API##############
+MAX_PAGE_SIZE = 200
+
+def parse_order_filters(args):
+    """Read order filters from query string args for Order.filtered()
+
+    active is 'true' or 'false', since and until are ISO 8601 datetimes.
+    restaurant_id defaults to the one in the session, if any.
+    Aborts with 400 on malformed values
+    """
+    filters = {
+        'type': args.get('type'),
+        'table_number': args.get('table_number', type=int),
+        'employee_id': args.get('employee_id', type=int),
+        'restaurant_id': args.get('restaurant_id', type=int) or session.get('restaurant_id'),
+    }
+
+    active = args.get('active')
+    if active is not None:
+        if active.lower() not in ('true', 'false'):
+            abort(400)
+        filters['active'] = active.lower() == 'true'
+
+    for key in ('since', 'until'):
+        if args.get(key):
+            try:
+                filters[key] = datetime.fromisoformat(args[key])
+            except ValueError:
+                abort(400)
+
+    return filters
+
 @api_bp.route('/orders')
 def get_all_orders():
-    """Get all order objects and return jsonified"""
-    all_orders = Order.query.all()
-    data = []
+    """Get a page of order objects, newest first, and return jsonified
 
-    for order in all_orders:
-        data.append(Order.serialize(order))
+    Optional query string: active, type, table_number, employee_id, restaurant_id, since, until, limit, cursor.
+    Pass next_cursor from the response as cursor to get the following page
+    """
+    limit = min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE)
+    if limit < 1:
+        abort(400)
+    query = Order.filtered(**parse_order_filters(request.args))
 
-    return(jsonify(data=data), 200)
+    try:
+        query = Order.page(query, cursor=request.args.get('cursor'), limit=limit)
+    except ValueError:
+        abort(400)
+
+    data = Order.serialize_all(query)
+    next_cursor = None
+    if len(data) == limit:
+        next_cursor = Order.encode_cursor(data[-1]['timestamp'], data[-1]['id'])
+
+    return(jsonify(data=data, next_cursor=next_cursor), 200)
+
+@api_bp.route('/orders/export')
+def export_orders():
+    """Stream orders with their ordered items and totals for reporting
+
+    Optional query string: format ('ndjson' default, or 'csv') and the same filters as /orders.
+    Rows are read through a server-side cursor and written chunk by chunk
+    """
+    export_format = request.args.get('format', 'ndjson')
+    query = Order.filtered(**parse_order_filters(request.args))
+
+    if export_format == 'ndjson':
+        return Response(stream_with_context(Order.export_ndjson(query)), mimetype='application/x-ndjson')
+    if export_format == 'csv':
+        return Response(stream_with_context(Order.export_csv(query)), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=orders.csv'})
+    abort(400)
 
 @api_bp.route('/order/<int:id>')
 def get_order(id):
-    """get an order object and return jsonified order object"""
+    """get an order object and return jsonified order object
+
+    With ?expand=items, each ordered item also has its menu item name and cost
+    """
     order = Order.query.get_or_404(id)
 
-    data = Order.serialize(order)
+    data = Order.serialize(order, expand_items=request.args.get('expand') == 'items')
     return (jsonify(data=data), 200)
 
 @api_bp.route('/order', methods=['POST'])
 def new_order():
-    """Create new order"""
-    new_order = Order.create(**request.json)
+    """Create new order
+
+    restaurant_id defaults to the one in the session, if any
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+    data['restaurant_id'] = data.get('restaurant_id') or session.get('restaurant_id')
+
+    new_order = Order.create(**data)
     data = Order.serialize(new_order)
     return (jsonify(data=data), 200)
 
@@ -45,29 +123,187 @@ def update_order(id):
 
 @api_bp.route('/order/<int:id>/add_item', methods=['PATCH'])
 def add_to_order(id):
-    """Add a menu item from id with qty=1 to an existing order"""
-    
+    """Add menu items to an existing order
+
+    Takes either one menu_item_id with an optional quantity (default 1), eg.
+    {"menu_item_id": 3, "quantity": 2}, or a list of items, eg.
+    {"items": [{"menu_item_id": 3, "quantity": 2}, {"menu_item_id": 7}]}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+    lines = data.get('items') or [data]
+    if not isinstance(lines, list):
+        abort(400)
+
+    items = {}
+    try:
+        for line in lines:
+            menu_item_id = int(line['menu_item_id'])
+            quantity = int(line.get('quantity', 1))
+            if quantity < 1:
+                abort(400)
+            items[menu_item_id] = items.get(menu_item_id, 0) + quantity
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+    if not OrderedItems.add_items(id, items):
+        abort(404)
+
     order = Order.query.get_or_404(id)
-    menu_item_id = request.json.get('menu_item_id')  
-    ordered_item = OrderedItems.get_or_create_ordered_item(order, menu_item_id)
-    
-    ordered_item.update({'quantity': ordered_item.quantity + 1})
     data = Order.serialize(order)
 
     return (jsonify(updated_order=data), 202)
 
+@api_bp.route('/kitchen/tickets')
+def get_kitchen_tickets():
+    """Get kitchen display tickets: active orders with item names
+
+    Pass the cursor from the previous response as ?since= to get only orders
+    changed since then, closed orders included so screens can remove them.
+    Only shows the restaurant given as ?restaurant_id= or the one in the session, if any
+    """
+    since = request.args.get('since')
+    if since:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            abort(400)
+
+    restaurant_id = request.args.get('restaurant_id', type=int) or session.get('restaurant_id')
+    tickets, cursor = Order.kitchen_tickets(since=since or None, restaurant_id=restaurant_id)
+
+    return (jsonify(data=tickets, cursor=cursor.isoformat()), 200)
+
 ##############MENU API##################
+# seconds browsers and proxies may reuse a menu response before revalidating
+MENU_CACHE_MAX_AGE = 30
+MAX_IMPORT_ITEMS = 1000
+MAX_EXCLUDED_INTOLERANTS = 50
+
+def cached_menu_response(key, build):
+    """Respond with a cached menu payload, with a strong ETag and Cache-Control headers
+
+    Answers 304 Not Modified when If-None-Match has the current ETag.
+    Neither a 304 nor a cache hit touches the database
+    """
+    payload = get_menu_payload(key, build)
+
+    if payload.etag in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = Response(payload.body, status=200, mimetype='application/json')
+
+    resp.set_etag(payload.etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = current_app.config.get('MENU_CACHE_MAX_AGE', MENU_CACHE_MAX_AGE)
+    return resp
+
+@api_bp.route('/menu')
+def get_menu_items():
+    """Get several menu items in one request, eg. /menu?ids=1,2,3
+
+    Returns the items that exist, ordered by id
+    """
+    try:
+        ids = {int(id) for id in request.args.get('ids', '').split(',') if id}
+    except ValueError:
+        abort(400)
+    if not ids or len(ids) > MAX_PAGE_SIZE:
+        abort(400)
+
+    items = (MenuItem.query.filter(MenuItem.id.in_(ids))
+             .options(db.selectinload(MenuItem.ingredients), db.selectinload(MenuItem.intolerants))
+             .order_by(MenuItem.id))
+    data = [MenuItem.serialize(item) for item in items]
+
+    return (jsonify(data=data), 200)
+
+@api_bp.route('/menu/search')
+def search_menu_items():
+    """Search menu items by name, ingredients and description, best matches first
+
+    Query string: q, the search text, matched by word prefix for type-ahead.
+    Optional restaurant_id to search one restaurant's menu, defaulting to the
+    one in the session if any, and limit
+    """
+    q = request.args.get('q', '')
+    limit = min(request.args.get('limit', SEARCH_LIMIT, type=int), MAX_PAGE_SIZE)
+    if not q.strip() or limit < 1:
+        abort(400)
+
+    restaurant_id = request.args.get('restaurant_id', type=int) or session.get('restaurant_id')
+    items = (MenuItem.search(q, restaurant_id=restaurant_id, limit=limit)
+             .options(db.selectinload(MenuItem.ingredients), db.selectinload(MenuItem.intolerants)))
+    data = [MenuItem.serialize(item) for item in items]
+
+    return (jsonify(data=data), 200)
+
 @api_bp.route('/menu/<int:id>')
 def get_menu_item(id):
-    menu_item = MenuItem.query.get_or_404(id)
+    return cached_menu_response(('item', id), lambda: MenuItem.serialize(MenuItem.query.get_or_404(id)))
 
-    data = MenuItem.serialize(menu_item)
-    
-    return (jsonify(data=data), 200)
+def parse_menu_filters(args):
+    """Read menu filters from query string args for MenuItem.filtered()
+
+    exclude_intolerants is a comma separated list of intolerant names,
+    vegetarian and in_stock are 'true' or 'false', restaurant_id defaults to the
+    one in the session, if any. Aborts with 400 on malformed values
+    """
+    filters = {
+        'exclude_intolerants': sorted({name.strip().lower() for name in args.get('exclude_intolerants', '').split(',') if name.strip()}),
+        'restaurant_id': args.get('restaurant_id', type=int) or session.get('restaurant_id'),
+    }
+    if len(filters['exclude_intolerants']) > MAX_EXCLUDED_INTOLERANTS:
+        abort(400)
+
+    for key in ('vegetarian', 'in_stock'):
+        value = args.get(key)
+        if value is not None:
+            if value.lower() not in ('true', 'false'):
+                abort(400)
+            filters[key] = value.lower() == 'true'
+
+    return filters
 
 @api_bp.route('/menu/list_menu_items')
 def list_menu_items():
-    items = MenuItem.query.all()
-    results = [MenuItem.serialize(item) for item in items]
+    """Get every menu item, ordered by id
+
+    Optional query string: exclude_intolerants, eg. ?exclude_intolerants=Dairy,Peanuts
+    for items free of both, vegetarian, in_stock and restaurant_id
+    """
+    filters = parse_menu_filters(request.args)
+
+    def build():
+        items = (MenuItem.filtered(**filters)
+                 .options(db.selectinload(MenuItem.ingredients), db.selectinload(MenuItem.intolerants))
+                 .order_by(MenuItem.id))
+        return [MenuItem.serialize(item) for item in items]
+
+    key = ('list', tuple(filters['exclude_intolerants']), filters.get('vegetarian'), filters.get('in_stock'), filters['restaurant_id'])
+    return cached_menu_response(key, build)
+
+@api_bp.route('/menu/import', methods=['POST'])
+@authorize.has_role('manager')
+def import_menu_items():
+    """Add many menu items to the current restaurant's menu in one transaction
+
+    Takes {"items": [...]}, each item with MenuItem fields plus optional
+    "ingredients" and "intolerants" lists of names. Nothing is saved if any item fails
+    """
+    items = (request.json or {}).get('items')
+    if not isinstance(items, list) or not items or len(items) > MAX_IMPORT_ITEMS:
+        abort(400)
+    if not all(isinstance(item, dict) for item in items):
+        abort(400)
+
+    restaurant_id = session.get('restaurant_id') or current_user.restaurant_id
+    if restaurant_id is None:
+        abort(400)
+
+    ids = MenuItem.import_items(items, restaurant_id)
+    if ids is None:
+        abort(400)
 
-    return (jsonify(data=results), 200)
+    return (jsonify(data=ids), 201)
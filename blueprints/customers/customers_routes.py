@@ -1,12 +1,12 @@
 ########## Customer Routes Blueprint ############
 
-import pdb
 from functools import wraps
 from flask import Blueprint, render_template, redirect, flash, session, url_for, current_app, request
 from models.db import db
 from models.user_models import User, Group
 from models.restaurant_models import Restaurant, Table
 from models.order_models import Order
+from models.menu_cache import get_menu_snapshot
 from forms import SelectTableForm, TakeoutForm, DeliveryForm, PaymentMethodForm
 from flask_authorize import Authorize
 
@@ -36,8 +36,11 @@ def employee_redirect(f):
 @customers_bp.route('/')
 @employee_redirect
 def landing_page():
-    
-    restaurant = db.session.query(Restaurant).first()
+    """Show the restaurant picked with ?restaurant_id=, the one already in the session, or the first one"""
+    restaurant_id = request.args.get('restaurant_id', type=int) or session.get('restaurant_id')
+    restaurant = Restaurant.query.get(restaurant_id) if restaurant_id else None
+    if restaurant is None:
+        restaurant = db.session.query(Restaurant).order_by(Restaurant.id).first()
     session['restaurant_id'] = restaurant.id
     return render_template('landing.html', restaurant=restaurant)
 
@@ -50,12 +53,12 @@ def assign_table_number():
     """Set up new Order instance and assign table_number, for dining in"""
         
     form = SelectTableForm()
-    tables = [(table.id, table.id) for table in Table.query.all() if not table.taken]
+    tables = [(table.id, table.id) for table in Table.available(session.get('restaurant_id'))]
     form.table_number.choices = tables
     
     if form.validate_on_submit():
         Table.assign(form.table_number.data)
-        new_order = Order.create(form.table_number.data, 'Dining In')
+        new_order = Order.create(form.table_number.data, 'Dining In', restaurant_id=session.get('restaurant_id'))
 
         session['current_order_id'] = new_order.id
         session['curr_table_num'] = new_order.table_number
@@ -74,11 +77,10 @@ def order_page():
     if not session.get('current_order_id'):
         return redirect(url_for('customers.landing_page'))
     
-    restaurant = db.session.query(Restaurant).filter_by(id=session['restaurant_id']).first()
-    meal_types = {item.meal_type for item in restaurant.menu}
+    menu = get_menu_snapshot(session['restaurant_id'])
     curr_order_type = db.session.query(Order.type).filter_by(id=(session['current_order_id'])).first()
 
-    return render_template('order.html', items=restaurant.menu, types = meal_types, order_type = curr_order_type)
+    return render_template('order.html', menu=menu.by_type, order_type = curr_order_type)
 
 @customers_bp.route('/takeout')
 @order_active
@@ -105,8 +107,7 @@ def contact_form(state):
         if form.validate_on_submit():
             """Create new customer from form data and new order, set current order to new order"""
             new_customer = User.register_customer(form.data)
-            # pdb.set_trace()
-            new_order = Order.create(type='Takeout')
+            new_order = Order.create(type='Takeout', restaurant_id=session.get('restaurant_id'))
             
             session['current_order_id'] = new_order.id
             session['temp_customer_id'] = new_customer.id
@@ -120,7 +121,7 @@ def contact_form(state):
         if form.validate_on_submit():
             """Create new customer from form data and new order, set current order to new order"""
             new_customer = User.register_customer(form.data)
-            new_order = Order.create(type='Delivery')
+            new_order = Order.create(type='Delivery', restaurant_id=session.get('restaurant_id'))
             
             session['current_order_id'] = new_order.id
             session['temp_customer_id'] = new_customer.id
@@ -1,12 +1,16 @@
 ############# Employee Routes Blueprint #############
 
-from flask import Blueprint, render_template, redirect, flash, session, url_for, current_app, abort
+import json
+from queue import Empty
+from flask import Blueprint, render_template, redirect, flash, session, url_for, current_app, abort, request, Response
 from flask_login import login_user
 from models.db import db
 from models.user_models import User, Role, Group
 from models.restaurant_models import Restaurant
-from models.order_models import Order
+from models.order_models import Order, PAGE_SIZE
 from models.item_models import MenuItem, Intolerant
+from models.menu_cache import get_menu_snapshot
+from models.order_events import order_event_bus
 from forms import SignupForm, LoginForm, AddMenuItemForm, EditRestaurantForm
 
 from flask_authorize import Authorize
@@ -16,6 +20,11 @@ authorize = Authorize(current_app)
 
 employees_bp = Blueprint("employees", __name__, template_folder='templates')
 
+# seconds between keepalive comments on the dashboard event stream
+EVENT_KEEPALIVE = 15
+# employees per page of the employee list
+EMPLOYEE_PAGE_SIZE = 50
+
 @employees_bp.route('/edit-restaurant', methods=["GET", "POST"])
 @authorize.has_role('manager')
 def edit_restaurant():
@@ -39,7 +48,8 @@ def employee_signup():
 
     if form.validate_on_submit(extra_validators=None):
 
-        emp = User.register_employee(form.data)
+        # new employees work at the manager's restaurant
+        emp = User.register_employee({**form.data, 'restaurant_id': session.get('restaurant_id')})
 
         flash(f'Employee {emp.username} successfully added', 'success')
 
@@ -57,6 +67,8 @@ def login():
             flash('Employee credentials incorrect, check username and password', 'danger')
             return redirect(url_for('login'))
         login_user(user)
+        if user.restaurant_id:
+            session['restaurant_id'] = user.restaurant_id
 
         flash(f'Welcome back {user.username}', 'success')
         return redirect(url_for('employees.dashboard'))
@@ -67,38 +79,109 @@ def login():
 @employees_bp.route('/list')
 @authorize.in_group('employee')
 def show_employee_list():
-    employees = User.query.all()
+    """List the restaurant's employees a page at a time, optionally filtered by name and role"""
+    name = request.args.get('name', '').strip()
+    role = request.args.get('role', '')
+
+    employees = (User.employees(restaurant_id=session.get('restaurant_id'), name=name, role=role)
+                 .paginate(page=request.args.get('page', 1, type=int), per_page=EMPLOYEE_PAGE_SIZE, error_out=False))
+    roles = [role_name for role_name, in db.session.query(Role.name).order_by(Role.name)]
 
-    return render_template('employee-list.html', employees=employees)
+    return render_template('employee-list.html', employees=employees, roles=roles, name=name, role=role)
     
 @employees_bp.route('/dashboard')
 @authorize.in_group('employee')
 def dashboard():
     """Starting view for employees"""
-    restaurant_name = db.session.query(Restaurant.name).filter_by(id=session['restaurant_id']).scalar()
-    all_orders = Order.query.all()
-    menu_items = MenuItem.query.all()
-
-    return render_template('emp_dashboard.html', restaurant_name=restaurant_name, all_orders=all_orders, menu_items=menu_items)
+    restaurant_id = session['restaurant_id']
+    restaurant_name = db.session.query(Restaurant.name).filter_by(id=restaurant_id).scalar()
+    load_items = db.selectinload(Order.ordered_items)
+    active_orders = (Order.filtered(active=True, restaurant_id=restaurant_id).options(load_items)
+                     .order_by(Order.timestamp.desc(), Order.id.desc()).all())
+    # order history is paged with a keyset cursor instead of loading every past order
+    try:
+        past_orders = (Order.page(Order.filtered(active=False, restaurant_id=restaurant_id), cursor=request.args.get('cursor'))
+                       .options(load_items).all())
+    except ValueError:
+        abort(400)
+
+    next_cursor = None
+    if len(past_orders) == PAGE_SIZE:
+        next_cursor = Order.encode_cursor(past_orders[-1].timestamp, past_orders[-1].id)
+
+    # only the items on the listed orders, not every location's whole menu
+    menu_item_ids = {item.menu_item_id for order in active_orders + past_orders for item in order.ordered_items}
+    menu_items = MenuItem.query.filter(MenuItem.id.in_(menu_item_ids)).all()
+    # totals for every listed order in one query, instead of one per order
+    totals = Order.totals(order.id for order in active_orders + past_orders)
+
+    return render_template('emp_dashboard.html', restaurant_name=restaurant_name, active_orders=active_orders, past_orders=past_orders, next_cursor=next_cursor, menu_items=menu_items, totals=totals)
     
+@employees_bp.route('/dashboard/events')
+@authorize.in_group('employee')
+def dashboard_events():
+    """Server-sent events stream of order events for the dashboard
+
+    Each event is named after the order event, eg. 'order_created', with JSON data
+    {"event": ..., "order_id": ..., "restaurant_id": ...}. Only events for the
+    restaurant in the session are sent. Comments are sent every EVENT_KEEPALIVE
+    seconds to keep proxies from closing the connection
+    """
+    restaurant_id = session.get('restaurant_id')
+    queue = order_event_bus.subscribe()
+    # the stream runs no queries, don't keep a pooled connection checked out for as long as it's open
+    db.session.close()
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                # dropped for falling behind, end the stream so the browser reconnects and reloads
+                if not order_event_bus.is_subscribed(queue):
+                    return
+                try:
+                    event = queue.get(timeout=EVENT_KEEPALIVE)
+                except Empty:
+                    # listener connection lost, end the stream so the browser reconnects and restarts it
+                    if not order_event_bus.is_listening():
+                        return
+                    yield ': keepalive\n\n'
+                    continue
+                if restaurant_id and event.get('restaurant_id') != restaurant_id:
+                    continue
+                yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            order_event_bus.unsubscribe(queue)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@employees_bp.route('/dashboard/orders/<int:id>')
+@authorize.in_group('employee')
+def dashboard_order_card(id):
+    """Render one order card, for the dashboard to swap in when the order changes"""
+    order = Order.query.options(db.selectinload(Order.ordered_items)).get_or_404(id)
+    if session.get('restaurant_id') and order.restaurant_id != session['restaurant_id']:
+        abort(404)
+    menu_items = MenuItem.query.filter(MenuItem.id.in_([item.menu_item_id for item in order.ordered_items])).all()
+
+    return render_template('order_card.html', order=order, menu_items=menu_items, totals=Order.totals([id]))
+
 @employees_bp.route('/full-menu')
 @authorize.in_group('employee')
 def full_menu():
     """Full view of menu"""
-    restaurant = Restaurant.query.filter_by(id=session['restaurant_id']).first()
-    meal_types = {item.meal_type for item in restaurant.menu}
+    menu = get_menu_snapshot(session['restaurant_id'])
 
-    return render_template('full_menu.html', items=restaurant.menu, types = meal_types)
+    return render_template('full_menu.html', menu=menu.by_type)
 
-# # Future implementation
-# @app.route('/kitchen-dashboard')
-# @authorize.in_group('employee')
-# def kitchen_dashboard():
-#     """View of orders for kitchen staff to prepare food"""
-#     all_orders = Order.query.all()
-#     menu_items = MenuItem.query.all()
+@employees_bp.route('/kitchen-dashboard')
+@authorize.in_group('employee')
+def kitchen_dashboard():
+    """View of orders for kitchen staff to prepare food
 
-#     return render_template('employee/kitchen_dashboard.html', all_orders=all_orders, menu_items=menu_items)
+    Tickets are loaded and kept up to date by polling the kitchen tickets API
+    """
+    return render_template('kitchen_dashboard.html')
 
 @employees_bp.route('/add-menu-item', methods=["GET","POST"])
 @authorize.in_group('employee') 
@@ -108,20 +191,27 @@ def add_menu_item():
     menu_item_form.intolerants.choices = [(i.name, i.name) for i in intolerants]
     
     if menu_item_form.validate_on_submit():
-        menu_item = MenuItem.add_new_item(menu_item_form.data)
+        menu_item = MenuItem.add_new_item(menu_item_form.data, restaurant_id=session.get('restaurant_id'))
+
+        if menu_item:
+            flash(f'Added {menu_item.name}!', 'success')
+            return redirect(url_for('employees.full_menu'))
 
-        flash(f'Added {menu_item.name}!', 'success')
-        return redirect(url_for('employees.full_menu'))
+        flash('Could not add menu item, nothing was saved', 'danger')
 
     return render_template('add_menu_item.html', form=menu_item_form)
 
 @employees_bp.route('/<int:id>/delete', methods=["POST"])
 @authorize.has_role('manager')
 def delete_user(id):
-    """Delete User by id"""
+    """Delete User by id, only one of the session's restaurant's"""
 
     if(current_user.id == id):
         raise abort(401)
+
+    user = User.query.get(id)
+    if user is None or (session.get('restaurant_id') and user.restaurant_id != session['restaurant_id']):
+        raise abort(404)
     
     res = User.delete(id)
     if(res==None):
@@ -0,0 +1,49 @@
+############ Internal Blueprint ############
+# Operational endpoints for monitoring, only served with the INTERNAL_TOKEN bearer token,
+# or without one configured, to local and private network addresses not behind a proxy
+import hmac
+from ipaddress import ip_address
+from flask import Blueprint, Response, jsonify, request, abort, current_app
+from models.db import db, pool_metrics
+from models.metrics import render_metrics
+
+internal_bp = Blueprint('internal', __name__)
+
+# headers a reverse proxy adds, whose requests all come from the proxy's own address
+FORWARDED_HEADERS = ('Forwarded', 'X-Forwarded-For', 'X-Real-IP')
+
+@internal_bp.before_request
+def internal_only():
+    """Hide internal endpoints from anyone without the INTERNAL_TOKEN bearer token
+
+    Without INTERNAL_TOKEN, only requests straight from local and private network
+    addresses are served. Behind a reverse proxy every request comes from the proxy's
+    address, so proxied requests are refused, but set INTERNAL_TOKEN there
+    """
+    token = current_app.config.get('INTERNAL_TOKEN')
+    if token:
+        scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(credentials.encode(), token.encode()):
+            abort(404)
+        return
+
+    if any(header in request.headers for header in FORWARDED_HEADERS):
+        abort(404)
+
+    try:
+        address = ip_address(request.remote_addr or '')
+    except ValueError:
+        abort(404)
+
+    if not (address.is_loopback or address.is_private):
+        abort(404)
+
+@internal_bp.route('/internal/db-pool')
+def get_pool_metrics():
+    """Get this worker's connection pool checkouts, wait time, timeouts and overflow"""
+    return (jsonify(data=pool_metrics.snapshot(db.engine.pool)), 200)
+
+@internal_bp.route('/metrics')
+def get_metrics():
+    """Prometheus scrape endpoint: request latency and status counts, order throughput and the connection pool"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
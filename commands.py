@@ -0,0 +1,262 @@
+"""Flask CLI commands for omakase
+
+Registered on the app in app.py, run like:
+
+    flask orders export --format csv --output orders.csv
+    flask orders migrate-restaurants --restaurant-id 1
+    flask menu import menu.csv --restaurant-id 1
+    flask users migrate-usernames
+    flask users purge-temp-customers --older-than-days 30
+"""
+
+import csv
+import json
+import os
+import time
+from datetime import timedelta
+from itertools import islice
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from models.db import db
+from models.item_models import MenuItem, CSV_LIST_SEPARATOR
+from models.order_models import Order
+from models.restaurant_models import Restaurant, Table
+from models.user_models import User, USERNAME_TRIGGER_DDL
+
+orders_cli = AppGroup('orders', help='Order reporting commands')
+menu_cli = AppGroup('menu', help='Menu import and export commands')
+users_cli = AppGroup('users', help='User maintenance commands')
+
+IMPORT_BATCH_SIZE = 1000
+# indexes on restaurant_id added to existing databases by `flask orders migrate-restaurants`
+RESTAURANT_INDEXES = {
+    'ix_tables_restaurant_id': 'tables (restaurant_id)',
+    'ix_users_restaurant_id': 'users (restaurant_id)',
+    'ix_orders_restaurant_id_timestamp_id': 'orders (restaurant_id, timestamp, id)',
+    'ix_orders_restaurant_id_active_timestamp_id': 'orders (restaurant_id, active, timestamp, id)',
+}
+
+def create_index_concurrently(name, definition, unique=False):
+    """Build an index without blocking writes to its table, if it isn't there already
+
+    CREATE INDEX CONCURRENTLY can't run in a transaction. A build that failed
+    half way leaves an invalid index behind, which is dropped and built again
+    """
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        valid = conn.execute(db.text('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'), name=name).scalar()
+        if valid is False:
+            conn.execute(f'DROP INDEX CONCURRENTLY {name}')
+        conn.execute(f'CREATE {"UNIQUE " if unique else ""}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}')
+
+@orders_cli.command('export')
+@click.option('--format', 'export_format', type=click.Choice(['ndjson', 'csv']), default='ndjson', help='Output format')
+@click.option('--output', type=click.File('w'), default='-', help='File to write to, defaults to stdout')
+@click.option('--since', type=click.DateTime(), help='Only orders placed at or after this time')
+@click.option('--until', type=click.DateTime(), help='Only orders placed before this time')
+def export_orders(export_format, output, since, until):
+    """Stream orders with their ordered items and totals as NDJSON or CSV"""
+    query = Order.filtered(since=since, until=until)
+    chunks = Order.export_ndjson(query) if export_format == 'ndjson' else Order.export_csv(query)
+
+    for chunk in chunks:
+        output.write(chunk)
+
+@orders_cli.command('migrate-restaurants')
+@click.option('--restaurant-id', type=int, help='Restaurant for orders and tables with nothing else to go by, defaults to the first one')
+@click.option('--batch-size', type=click.IntRange(min=1), default=IMPORT_BATCH_SIZE, show_default=True, help='Orders updated per transaction')
+def migrate_restaurants(restaurant_id, batch_size):
+    """Add restaurant_id to the orders and tables of a database from before restaurants were kept apart
+
+    Tables without a restaurant get restaurant_id's. Orders get their table's restaurant,
+    or their employee's, or restaurant_id's, in batches, and the indexes are built
+    concurrently, so orders keep coming in meanwhile. Safe to run again
+    """
+    if restaurant_id is None:
+        restaurant_id = db.session.query(Restaurant.id).order_by(Restaurant.id).limit(1).scalar()
+    if restaurant_id is None or Restaurant.query.get(restaurant_id) is None:
+        raise click.ClickException('No restaurant to assign orders and tables to')
+
+    for table in ('tables', 'orders'):
+        db.session.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS restaurant_id integer REFERENCES restaurants (id) ON DELETE CASCADE')
+    tables = Table.query.filter(Table.restaurant_id == None).update({'restaurant_id': restaurant_id}, synchronize_session=False)
+    db.session.commit()
+
+    start = time.perf_counter()
+    orders = sum(Order.backfill_restaurants(restaurant_id, batch_size))
+    click.echo(f'Assigned restaurants to {tables} tables and {orders} orders in {time.perf_counter() - start:.2f}s', err=True)
+
+    for name, definition in RESTAURANT_INDEXES.items():
+        create_index_concurrently(name, definition)
+    click.echo('Restaurant indexes are ready', err=True)
+
+def read_menu_csv(file):
+    """Yield menu items from a CSV file with MENU_CSV_HEADERS columns
+
+    Empty columns are left out so the column defaults apply
+    """
+    for row in csv.DictReader(file):
+        item = {k: v for k, v in row.items() if v not in ('', None)}
+        for key in ('ingredients', 'intolerants'):
+            item[key] = item[key].split(CSV_LIST_SEPARATOR) if key in item else []
+        for key in ('vegetarian', 'in_stock'):
+            if key in item:
+                item[key] = item[key].strip().lower() in ('true', 't', 'yes', 'y', '1')
+        yield item
+
+def read_menu_ndjson(file):
+    """Yield menu items from newline delimited JSON, one item per line"""
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            raise click.ClickException(f'Line {number} is not valid JSON: {e}')
+        if not isinstance(item, dict):
+            raise click.ClickException(f'Line {number} is not a JSON object')
+        yield item
+
+def read_menu_json(file):
+    """Yield menu items from a JSON array of items
+
+    The whole array is read at once, use NDJSON for menus too large for memory
+    """
+    try:
+        items = json.load(file)
+    except json.JSONDecodeError as e:
+        raise click.ClickException(f'Line {e.lineno} is not valid JSON: {e.msg}')
+    if not isinstance(items, list):
+        raise click.ClickException('The file is not a JSON array of menu items')
+
+    for number, item in enumerate(items, 1):
+        if not isinstance(item, dict):
+            raise click.ClickException(f'Item {number} is not a JSON object')
+        yield item
+
+MENU_READERS = {'csv': read_menu_csv, 'ndjson': read_menu_ndjson, 'json': read_menu_json}
+# formats guessed from file extensions, anything else is read as CSV
+MENU_EXTENSIONS = {'.ndjson': 'ndjson', '.jsonl': 'ndjson', '.json': 'json'}
+
+@menu_cli.command('import')
+@click.argument('file', type=click.File('r'))
+@click.option('--format', 'import_format', type=click.Choice(['csv', 'ndjson', 'json']), help='Input format, guessed from the file extension if not given')
+@click.option('--restaurant-id', type=int, help='Restaurant whose menu the items are added to, defaults to the first one')
+@click.option('--batch-size', type=click.IntRange(min=1), default=IMPORT_BATCH_SIZE, show_default=True, help='Items inserted per transaction')
+def import_menu(file, import_format, restaurant_id, batch_size):
+    """Stream menu items from a CSV, NDJSON or JSON array file into a restaurant's menu
+
+    Items are read and inserted batch_size at a time, each batch in its own
+    transaction, creating any ingredients and intolerants that don't exist yet
+    """
+    if import_format is None:
+        import_format = MENU_EXTENSIONS.get(os.path.splitext(file.name)[1].lower(), 'csv')
+    if restaurant_id is None:
+        restaurant_id = db.session.query(Restaurant.id).order_by(Restaurant.id).limit(1).scalar()
+    if restaurant_id is None:
+        raise click.ClickException('No restaurant to import the menu into')
+
+    items = MENU_READERS[import_format](file)
+
+    imported = 0
+    start = time.perf_counter()
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            break
+        if MenuItem.import_items(batch, restaurant_id, create_intolerants=True) is None:
+            raise click.ClickException(f'Batch starting at item {imported + 1} failed, {imported} items were imported before it')
+        imported += len(batch)
+
+    # refresh planner statistics now rather than waiting for autovacuum, so queries
+    # run straight after a large import don't plan as if the tables were still empty
+    db.session.execute(db.text('ANALYZE menu_items, restaurants_menus, ingredients, items_ingredients, intolerants, items_intolerants'))
+    db.session.commit()
+
+    elapsed = time.perf_counter() - start
+    click.echo(f'Imported {imported} menu items in {elapsed:.2f}s ({imported / elapsed if elapsed else 0:.0f} rows/s)', err=True)
+
+@menu_cli.command('export')
+@click.option('--format', 'export_format', type=click.Choice(['ndjson', 'csv']), default='csv', help='Output format')
+@click.option('--output', type=click.File('w'), default='-', help='File to write to, defaults to stdout')
+@click.option('--restaurant-id', type=int, help="Only export this restaurant's menu")
+def export_menu(export_format, output, restaurant_id):
+    """Stream menu items with their ingredients and intolerants as CSV or NDJSON, in the format import reads"""
+    exported = 0
+    def counted(items):
+        nonlocal exported
+        for item in items:
+            exported += 1
+            yield item
+
+    items = counted(MenuItem.export(restaurant_id))
+    chunks = MenuItem.export_ndjson(items) if export_format == 'ndjson' else MenuItem.export_csv(items)
+
+    start = time.perf_counter()
+    for chunk in chunks:
+        output.write(chunk)
+
+    elapsed = time.perf_counter() - start
+    click.echo(f'Exported {exported} menu items in {elapsed:.2f}s ({exported / elapsed if elapsed else 0:.0f} rows/s)', err=True)
+
+@users_cli.command('migrate-usernames')
+@click.option('--batch-size', type=click.IntRange(min=1), default=IMPORT_BATCH_SIZE, show_default=True, help='Users updated per transaction')
+def migrate_usernames(batch_size):
+    """Add the normalized username column, trigger and unique index to an existing database
+
+    Existing users are backfilled in batches, temporary customers losing their usernames,
+    and the index is built concurrently, so logins keep working meanwhile. Safe to run again
+    """
+    db.session.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS username_normalized varchar(255)')
+    db.session.execute(USERNAME_TRIGGER_DDL)
+    db.session.commit()
+
+    start = time.perf_counter()
+    migrated = sum(User.backfill_usernames(batch_size))
+    click.echo(f'Backfilled {migrated} users in {time.perf_counter() - start:.2f}s', err=True)
+
+    duplicates = (db.session.query(User.username_normalized)
+                  .filter(User.temp == False)
+                  .group_by(User.username_normalized)
+                  .having(db.func.count() > 1)
+                  .limit(20)
+                  .all())
+    if duplicates:
+        names = ', '.join(name for name, in duplicates)
+        raise click.ClickException(f'These usernames are used more than once, rename those users and run this again: {names}')
+
+    # DROP INDEX CONCURRENTLY waits for every transaction that read users, this one's too
+    db.session.commit()
+
+    # an index on every user, from before temporary customers had no usernames, is
+    # replaced by building the partial one beside it, so usernames stay unique throughout
+    definition = 'users (username_normalized) WHERE NOT temp'
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        partial = conn.execute("SELECT indpred IS NOT NULL FROM pg_index WHERE indexrelid = to_regclass('ux_users_username_normalized')").scalar()
+        if partial is False:
+            create_index_concurrently('ux_users_username_normalized_partial', definition, unique=True)
+            conn.execute('DROP INDEX CONCURRENTLY ux_users_username_normalized')
+            conn.execute('ALTER INDEX ux_users_username_normalized_partial RENAME TO ux_users_username_normalized')
+        else:
+            create_index_concurrently('ux_users_username_normalized', definition, unique=True)
+            # left behind by a run stopped before the rename
+            conn.execute('DROP INDEX CONCURRENTLY IF EXISTS ux_users_username_normalized_partial')
+
+    click.echo('Unique index ux_users_username_normalized is ready', err=True)
+
+@users_cli.command('purge-temp-customers')
+@click.option('--older-than-days', type=click.IntRange(min=0), help='Delete customers not seen for this many days, defaults to TEMP_CUSTOMER_RETENTION_DAYS')
+@click.option('--batch-size', type=click.IntRange(min=1), default=IMPORT_BATCH_SIZE, show_default=True, help='Customers deleted per transaction')
+def purge_temp_customers(older_than_days, batch_size):
+    """Delete takeout and delivery customers who haven't ordered for a while, with their order links
+
+    Meant to run regularly, eg. nightly from cron
+    """
+    if older_than_days is None:
+        older_than_days = current_app.config['TEMP_CUSTOMER_RETENTION_DAYS']
+
+    start = time.perf_counter()
+    deleted = sum(User.purge_temp_customers(timedelta(days=older_than_days), batch_size))
+    elapsed = time.perf_counter() - start
+
+    click.echo(f'Deleted {deleted} temporary customers not seen for {older_than_days} days in {elapsed:.2f}s', err=True)
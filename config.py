@@ -0,0 +1,68 @@
+"""App configurations, picked by create_app() in app.py
+
+APP_CONFIG chooses one of 'production', 'development' or 'testing'. Without it,
+FLASK_ENV=development picks development and anything else production.
+Values are read from the environment (or the .env file) when this module is imported.
+"""
+
+import os
+from dotenv import load_dotenv
+from models.db import engine_options
+
+load_dotenv()
+
+class Config:
+    """Settings shared by every configuration"""
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///omakase')
+    # set to connect LISTEN straight to PostgreSQL when DATABASE_URL goes through PgBouncer
+    DATABASE_DIRECT_URL = os.environ.get('DATABASE_DIRECT_URL')
+    # pool size, overflow, timeout, recycle and pre-ping from DB_POOL_* variables, see engine_options()
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options()
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    # statements at least this slow are logged with the route that ran them
+    SLOW_QUERY_MS = int(os.environ.get('SLOW_QUERY_MS', 100))
+    # Use os.environ here to protect SECRET_KEY
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    DEBUG_TB_ENABLED = False
+    # bcrypt cost for new password hashes, older hashes are upgraded on login
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    # passwords hashed or checked at once per process, see models/passwords.py
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    # seconds a logged in user's roles and groups are reused before loading them again
+    PRINCIPAL_CACHE_TTL = int(os.environ.get('PRINCIPAL_CACHE_TTL', 30))
+    # bearer token /metrics and the other internal endpoints require, see blueprints/internal
+    INTERNAL_TOKEN = os.environ.get('INTERNAL_TOKEN')
+    # directory where gunicorn workers share their metrics counters, see models/metrics.py
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    # days a takeout or delivery customer is kept after their last order, see `flask users purge-temp-customers`
+    TEMP_CUSTOMER_RETENTION_DAYS = int(os.environ.get('TEMP_CUSTOMER_RETENTION_DAYS', 30))
+
+class ProductionConfig(Config):
+    """No debug extensions are loaded"""
+
+class DevelopmentConfig(Config):
+    """Debug mode with the Flask DebugToolbar"""
+    DEBUG = True
+    DEBUG_TB_ENABLED = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+class TestingConfig(Config):
+    """For the test suite and benchmarks: the omakase-test database, errors raised in tests and no CSRF"""
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///omakase-test')
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    # the lowest cost bcrypt allows, so tests don't spend their time hashing
+    BCRYPT_LOG_ROUNDS = 4
+
+configs = {
+    'production': ProductionConfig,
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+}
+
+def default_config_name():
+    if os.environ.get('APP_CONFIG'):
+        return os.environ['APP_CONFIG']
+
+    return 'development' if os.environ.get('FLASK_ENV') == 'development' else 'production'
@@ -0,0 +1,37 @@
+"""gunicorn settings, read automatically by `gunicorn app:app` run from the project root
+
+The dashboard's order event stream (/employees/dashboard/events) stays open for as
+long as the dashboard does. On gunicorn's default sync workers every open dashboard
+would hold a whole worker, so workers run threads instead, and each open stream
+holds one thread. Keep GUNICORN_THREADS above the number of dashboards open at once
+plus the requests a worker should serve alongside them.
+
+With METRICS_DIR set, workers share their metrics counters through files there,
+see models/metrics.py. It's emptied when gunicorn starts.
+"""
+
+import multiprocessing
+import os
+from glob import glob
+from dotenv import load_dotenv
+
+# METRICS_DIR may be set in .env, which the app reads too
+load_dotenv()
+
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+
+def on_starting(server):
+    """Start metrics counters from zero, as the workers writing the old ones are gone"""
+    if os.environ.get('METRICS_DIR'):
+        for path in glob(os.path.join(os.environ['METRICS_DIR'], '*.json')):
+            os.remove(path)
+
+def worker_exit(server, worker):
+    """Save the exiting worker's last counters, so the metrics totals don't go down"""
+    # imported here so the master process never loads the app
+    from app import app
+    from models.metrics import counters
+    with app.app_context():
+        counters.flush()
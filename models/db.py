@@ -1,7 +1,144 @@
+import os
+import time
+from threading import Lock
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool, QueuePool
 
 db = SQLAlchemy()
 
+############ Connection pool ############
+POOL_DEFAULTS = {
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_POOL_TIMEOUT': 30,
+    'DB_POOL_RECYCLE': -1,
+}
+
+def env_flag(environ, key):
+    return environ.get(key, '').lower() in ('1', 'true', 'yes', 'on')
+
+def engine_options(environ=os.environ):
+    """SQLAlchemy engine options read from the environment
+
+    DB_POOL_SIZE connections are kept open per worker process, and up to
+    DB_MAX_OVERFLOW more are opened at peaks, so a gunicorn deployment can hold
+    workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections. Checkouts wait up to
+    DB_POOL_TIMEOUT seconds for a free connection. Connections older than
+    DB_POOL_RECYCLE seconds are replaced, and DB_POOL_PRE_PING=true tests each
+    connection before handing it out.
+
+    DB_PGBOUNCER=true is for DATABASE_URL pointing at PgBouncer in transaction
+    pooling mode: PgBouncer does the pooling, so connections are not kept here
+    """
+    if env_flag(environ, 'DB_PGBOUNCER'):
+        return {'poolclass': InstrumentedNullPool}
+
+    size, overflow, timeout, recycle = (int(environ.get(key, default)) for key, default in POOL_DEFAULTS.items())
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': size,
+        'max_overflow': overflow,
+        'pool_timeout': timeout,
+        'pool_recycle': recycle,
+        'pool_pre_ping': env_flag(environ, 'DB_POOL_PRE_PING'),
+    }
+
+class PoolMetrics:
+    """Connection pool counters for this process
+
+    wait_seconds is the time spent in checkouts: waiting for a free connection,
+    plus opening a new one or pre-pinging when that happens
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.connects = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+
+    def record_checkout(self, wait, timed_out=False):
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def record_connect(self):
+        with self.lock:
+            self.connects += 1
+
+    def snapshot(self, pool):
+        """Counters plus the pool's current state, as a dictionary"""
+        with self.lock:
+            data = {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'connects': self.connects,
+                'wait_seconds': round(self.wait_seconds, 6),
+                'max_wait_seconds': round(self.max_wait_seconds, 6),
+            }
+
+        if isinstance(pool, QueuePool):
+            data.update(size=pool.size(), checked_out=pool.checkedout(), overflow=max(pool.overflow(), 0))
+
+        return data
+
+pool_metrics = PoolMetrics()
+
+class InstrumentedPool:
+    """Mixin recording checkouts and new connections in pool_metrics"""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            conn = super().connect()
+        except exc.TimeoutError:
+            pool_metrics.record_checkout(time.perf_counter() - start, timed_out=True)
+            raise
+
+        pool_metrics.record_checkout(time.perf_counter() - start)
+        return conn
+
+    def _create_connection(self):
+        pool_metrics.record_connect()
+        return super()._create_connection()
+
+class InstrumentedQueuePool(InstrumentedPool, QueuePool):
+    pass
+
+class InstrumentedNullPool(InstrumentedPool, NullPool):
+    pass
+
+_listen_engine = None
+
+def listen_engine():
+    """Engine for connections holding session state, like the order events LISTEN
+
+    PgBouncer in transaction pooling mode can't keep LISTEN, so DATABASE_DIRECT_URL,
+    pointing straight at PostgreSQL, is used when set. Otherwise this is db.engine
+    """
+    global _listen_engine
+    url = current_app.config.get('DATABASE_DIRECT_URL')
+    if not url:
+        return db.engine
+
+    if _listen_engine is None:
+        _listen_engine = create_engine(url, poolclass=NullPool)
+
+    return _listen_engine
+
 def connect_db(app):
     """Connect this database to provided Flask app.
     
@@ -9,4 +146,90 @@ def connect_db(app):
     """
 
     db.app = app
-    db.init_app(app)
\ No newline at end of file
+    db.init_app(app)
+
+class QueryCounter:
+    """Context manager that counts SQL statements sent to the database
+
+    with QueryCounter() as counter:
+        Order.query.all()
+    counter.count # => 1
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        self.engine = self.engine or db.engine
+        event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+
+@contextmanager
+def query_budget(limit, engine=None):
+    """Fail with an AssertionError listing the statements if more than limit run inside the block
+
+    Used by tests to keep N+1 queries from coming back:
+
+    with query_budget(5):
+        client.get('/employees/dashboard')
+    """
+    with QueryCounter(engine) as counter:
+        yield counter
+
+    if counter.count > limit:
+        statements = '\n'.join(counter.statements)
+        raise AssertionError(f'{counter.count} queries, over the budget of {limit}:\n{statements}')
+
+############ Per request query stats ############
+DEFAULT_SLOW_QUERY_MS = 100
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_start'] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start']
+    # queries outside requests, eg. CLI commands or the order events listener, aren't tracked
+    if not has_request_context():
+        return
+
+    g.query_count = g.get('query_count', 0) + 1
+    g.query_seconds = g.get('query_seconds', 0.0) + elapsed
+
+    if elapsed * 1000 >= current_app.config.get('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS):
+        current_app.logger.warning('Slow query, %.1fms in %s: %s', elapsed * 1000, request.endpoint, statement)
+
+def reset_query_stats():
+    """Start the request's counts from zero
+
+    g lives on the app context, which a worker can keep across requests, eg. when
+    one is pushed for the whole process, so the counts don't reset by themselves
+    """
+    g.query_count = 0
+    g.query_seconds = 0.0
+
+def add_server_timing(response):
+    """Add the request's query count and database time as a Server-Timing header"""
+    count = g.get('query_count', 0)
+    response.headers.add('Server-Timing', f'db;dur={g.get("query_seconds", 0.0) * 1000:.1f};desc="{count} queries"')
+    return response
+
+def init_query_stats(app):
+    """Count queries and database time per request, sent back in a Server-Timing header
+
+    Statements taking SLOW_QUERY_MS or more are logged as warnings with the route name
+    """
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    app.before_request(reset_query_stats)
+    app.after_request(add_server_timing)
@@ -1,8 +1,21 @@
 """Menu Item Models"""
 
+import csv
+import io
+import json
+import re
 from models.db import db
 from models.restaurant_models import Restaurant
+from sqlalchemy import DDL, event
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import array_agg, aggregate_order_by, TSVECTOR
+
+EXPORT_CHUNK_SIZE = 1000
+# separates ingredient and intolerant names inside a single CSV column
+CSV_LIST_SEPARATOR = '|'
+MENU_CSV_HEADERS = ['name', 'meal_type', 'cost', 'description', 'image', 'vegetarian', 'in_stock', 'ingredients', 'intolerants']
+SEARCH_LIMIT = 20
 
 class MenuItem(db.Model):
     """Menu item model
@@ -21,90 +34,300 @@ class MenuItem(db.Model):
     description = db.Column(db.Text)
     cost = db.Column(db.Numeric(precision=10, scale=2), nullable=False)
 
+    # name, ingredient names and description for full text search, kept up to date by
+    # triggers (see the DDL below the models) and only loaded when asked for
+    search_vector = db.deferred(db.Column(TSVECTOR))
+
+    __table_args__ = (
+        db.Index('ix_menu_items_search_vector', 'search_vector', postgresql_using='gin'),
+    )
+
     ingredients = db.relationship('Ingredient', secondary='items_ingredients', backref='menu_items')
     intolerants = db.relationship('Intolerant', secondary='items_intolerants', backref='in_items')
 
+    @classmethod
+    def filtered(cls, exclude_intolerants=None, vegetarian=None, in_stock=None, restaurant_id=None):
+        """Build a menu item query from optional filters; filters left as None are not applied
+
+        exclude_intolerants is a list of intolerant names, matched case insensitively.
+        Items with any of them are left out by an anti-join on items_intolerants,
+        so the filtering happens in SQL without loading intolerants.
+        restaurant_id limits the items to that restaurant's menu
+        """
+        query = cls.query
+        if restaurant_id is not None:
+            query = (query.join(RestaurantMenu, RestaurantMenu.menu_item_id == cls.id)
+                     .filter(RestaurantMenu.restaurant_id == restaurant_id))
+        for column, value in ((cls.vegetarian, vegetarian), (cls.in_stock, in_stock)):
+            if value is not None:
+                query = query.filter(column == value)
+
+        if exclude_intolerants:
+            names = [name.lower() for name in exclude_intolerants]
+            unsafe = (db.session.query(ItemIntolerant.menu_item_id)
+                      .join(Intolerant, Intolerant.id == ItemIntolerant.intolerant_id)
+                      .filter(ItemIntolerant.menu_item_id == cls.id)
+                      .filter(db.func.lower(Intolerant.name).in_(names)))
+            query = query.filter(~unsafe.exists())
+
+        return query
+
+    @classmethod
+    def search(cls, q, restaurant_id=None, limit=SEARCH_LIMIT):
+        """Full text search of menu item names, ingredients and descriptions, best matches first
+
+        Every word of q must match the start of a word in the item, so partial input
+        like 'spag meat' works for type-ahead. Name matches rank above ingredient
+        matches, which rank above description matches. Uses the GIN index on search_vector
+        """
+        words = re.findall(r'\w+', q.lower())
+        if not words:
+            return cls.query.filter(db.false())
+
+        tsquery = db.func.to_tsquery('simple', ' & '.join(f'{word}:*' for word in words))
+        query = cls.query.filter(cls.search_vector.op('@@')(tsquery))
+        if restaurant_id is not None:
+            query = (query.join(RestaurantMenu, RestaurantMenu.menu_item_id == cls.id)
+                     .filter(RestaurantMenu.restaurant_id == restaurant_id))
+
+        return query.order_by(db.func.ts_rank(cls.search_vector, tsquery).desc(), cls.id).limit(limit)
+
     @classmethod
     def add_ingredients(cls, ingr_names_add, menu_item_id):
-        """Add ingredient to a menu item
+        """Add ingredients to a menu item, creating any that aren't in the catalog yet
         ingr_names_add must be a list
         menu_item_id must be integer
         """
+        # imported here since menu_cache imports this module
+        from models.menu_cache import bump_menu_version
 
-        all_ingredients = Ingredient.query.all()
-        ingredient_names = [i.name for i in all_ingredients]
-            
-        # if ingredient in list of ingredients being added to new menu_item
-        # not already in db, then add ingredient
-        new_ingredients = []
-        for i in ingr_names_add:
-            if i and i not in ingredient_names:
-                new_ingredients.append(Ingredient(name=i))
-
-        db.session.add_all(new_ingredients)
-        db.session.commit()
-
-        # Get menu_item add_ingredients is called for and add ingredients to it
         menu_item = MenuItem.query.get_or_404(menu_item_id)
-        filtered_ingredients = Ingredient.query.filter(Ingredient.name.in_(ingr_names_add))
 
-        ingr_add = [i for i in filtered_ingredients]
-        for i in ingr_add:
-            menu_item.ingredients.append(i)
+        try:
+            MenuItem.link_ingredients({menu_item_id: ingr_names_add})
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(e)
+            return None
 
-        db.session.commit()
+        bump_menu_version()
 
         return menu_item
 
+    @classmethod
+    def link_ingredients(cls, names_by_item):
+        """Link ingredients to menu items by name without committing
+        names_by_item is a dict of menu item id to list of ingredient names
+
+        Takes two statements however large the ingredient catalog is: missing names
+        are inserted with ON CONFLICT DO NOTHING, then the links are inserted from a
+        join of the names against the catalog. Blank names and existing links are skipped.
+        Runs core statements, so callers must bump the menu version after committing
+        """
+        links = link_rows(names_by_item)
+        if not links:
+            return
+
+        insert_names(Ingredient.__table__, {name for _, name in links})
+        insert_links('items_ingredients', 'ingredient_id', 'ingredients', links)
+
     @classmethod
     def add_intolerants(cls, int_names_add, menu_item_id):
         """Add intolerants to a menu item
         int_names_add must be a list
         """
+        # imported here since menu_cache imports this module
+        from models.menu_cache import bump_menu_version
 
         # If no intolerants being added, simply return
         if not int_names_add:
             return
-        # This code is copied from above, but modified for intolerants
-        # Consider data validation to check that intolerant exists in db
+
         menu_item = MenuItem.query.get_or_404(menu_item_id)
-        filtered_intolerants = Intolerant.query.filter(Intolerant.name.in_(int_names_add))
 
-        ingr_add = [i for i in filtered_intolerants]
-        for i in ingr_add:
-            menu_item.intolerants.append(i)
+        try:
+            MenuItem.link_intolerants({menu_item_id: int_names_add})
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(e)
+            return None
 
-        db.session.commit()
+        bump_menu_version()
 
         return menu_item
-    
+
     @classmethod
-    def add_new_item(cls, menu_item_form):
-        restaurant = Restaurant.query.first()
+    def link_intolerants(cls, names_by_item, create=False):
+        """Link intolerants to menu items by name in one statement without committing
+        names_by_item is a dict of menu item id to list of intolerant names
+
+        Unknown names are skipped, or added to the intolerants first if create is True.
+        Runs core statements, so callers must bump the menu version after committing
+        """
+        links = link_rows(names_by_item)
+        if not links:
+            return
+
+        if create:
+            insert_names(Intolerant.__table__, {name for _, name in links})
+        insert_links('items_intolerants', 'intolerant_id', 'intolerants', links)
+
+    @classmethod
+    def add_new_item(cls, menu_item_form, restaurant_id=None):
+        """Create a menu item with its ingredients and intolerants on a restaurant's menu
+        in one transaction, the first restaurant's if restaurant_id is None
+
+        Returns the new menu item, or None if anything failed and nothing was saved
+        """
         menu_item_data = { k:v for k, v in menu_item_form.items() if k != "csrf_token" and k != "intolerants" and k != 'ingredients' }
-        
+
         menu_item = MenuItem(**menu_item_data)
 
         try:
+            if restaurant_id is None:
+                restaurant_id = db.session.query(Restaurant.id).order_by(Restaurant.id).limit(1).scalar()
+
             db.session.add(menu_item)
+            db.session.flush()
+
+            db.session.add(RestaurantMenu(menu_item_id=menu_item.id, restaurant_id=restaurant_id))
+            MenuItem.link_ingredients({menu_item.id: menu_item_form.get("ingredients") or []})
+            MenuItem.link_intolerants({menu_item.id: menu_item_form.get("intolerants") or []})
+            # the new menu item itself marks every cached menu stale on commit
             db.session.commit()
         except SQLAlchemyError as e:
             db.session.rollback()
             print(e)
             return None
-        
-        MenuItem.add_ingredients(menu_item_form["ingredients"], menu_item.id)
-        MenuItem.add_intolerants(menu_item_form["intolerants"], menu_item.id)
-        restaurant.menu.append(menu_item)
 
-        try: 
+        return menu_item
+
+    @classmethod
+    def import_items(cls, items, restaurant_id, create_intolerants=False):
+        """Create many menu items on a restaurant's menu in one transaction
+        items is a list of dicts of MenuItem columns, plus optional
+        'ingredients' and 'intolerants' lists of names. Unknown intolerants
+        are skipped unless create_intolerants is True
+
+        Takes a fixed number of statements however many items there are: one to
+        reserve ids, one insert each for the items and their restaurant links, and the
+        ingredient and intolerant statements of link_ingredients and link_intolerants.
+        Returns the new menu item ids in the order given, or None if anything
+        failed and nothing was saved
+        """
+        # imported here since menu_cache imports this module
+        from models.menu_cache import bump_menu_version
+
+        if not items:
+            return []
+
+        table = MenuItem.__table__
+        unknown = {k for item in items for k in item} - set(table.c.keys()) - {'ingredients', 'intolerants'}
+        if unknown:
+            print(f'Unknown menu item columns: {", ".join(sorted(unknown))}')
+            return None
+
+        # every row needs every column, so gaps get the column defaults
+        columns = {column.name: [item.get(column.name, column.default.arg if column.default is not None else None) for item in items]
+                   for column in table.c if column.name not in ('id', 'search_vector')}
+
+        try:
+            # ids are reserved up front so items can be inserted from arrays and still be matched to their links
+            ids = [id for id, in db.session.execute(
+                db.text("SELECT nextval(pg_get_serial_sequence('menu_items', 'id')) FROM generate_series(1, :n)"), {'n': len(items)})]
+
+            insert_arrays(table, {'id': ids, **columns})
+            insert_arrays(RestaurantMenu.__table__, {'menu_item_id': ids, 'restaurant_id': [restaurant_id] * len(ids)})
+            MenuItem.link_ingredients({id: item.get('ingredients') or [] for id, item in zip(ids, items)})
+            MenuItem.link_intolerants({id: item.get('intolerants') or [] for id, item in zip(ids, items)}, create=create_intolerants)
             db.session.commit()
         except SQLAlchemyError as e:
             db.session.rollback()
             print(e)
             return None
-        
-        return menu_item
+
+        bump_menu_version()
+
+        return ids
+
+    @classmethod
+    def export(cls, restaurant_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+        """Stream menu items with their ingredient and intolerant names, in id order
+
+        Runs one query, with the names aggregated into arrays, through a server-side
+        cursor fetching chunk_size rows at a time, so memory use doesn't grow with the menu.
+        Only exports restaurant_id's menu if given. Yields one dictionary per item,
+        in the shape import_items takes
+        """
+        ingredients = (db.select([array_agg(aggregate_order_by(Ingredient.name, Ingredient.name))])
+                       .where(ItemIngredient.menu_item_id == cls.id)
+                       .where(Ingredient.id == ItemIngredient.ingredient_id)
+                       .as_scalar())
+        intolerants = (db.select([array_agg(aggregate_order_by(Intolerant.name, Intolerant.name))])
+                       .where(ItemIntolerant.menu_item_id == cls.id)
+                       .where(Intolerant.id == ItemIntolerant.intolerant_id)
+                       .as_scalar())
+
+        query = db.session.query(cls.name, cls.meal_type, cls.cost, cls.description, cls.image, cls.vegetarian, cls.in_stock,
+                                 ingredients, intolerants)
+        if restaurant_id is not None:
+            query = (query.join(RestaurantMenu, RestaurantMenu.menu_item_id == cls.id)
+                     .filter(RestaurantMenu.restaurant_id == restaurant_id))
+
+        for row in query.order_by(cls.id).yield_per(chunk_size):
+            item = dict(zip(MENU_CSV_HEADERS, row))
+            item['ingredients'] = item['ingredients'] or []
+            item['intolerants'] = item['intolerants'] or []
+            yield item
+
+    @classmethod
+    def export_ndjson(cls, items=None, chunk_size=EXPORT_CHUNK_SIZE):
+        """Stream menu items as newline delimited JSON, one item per line
+
+        items defaults to every menu item from MenuItem.export().
+        Yields text chunks of up to chunk_size items
+        """
+        if items is None:
+            items = cls.export(chunk_size=chunk_size)
+
+        lines = []
+        for item in items:
+            lines.append(json.dumps(item, default=str))
+            if len(lines) == chunk_size:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    @classmethod
+    def export_csv(cls, items=None, chunk_size=EXPORT_CHUNK_SIZE):
+        """Stream menu items as CSV, ingredient and intolerant names joined by CSV_LIST_SEPARATOR
+
+        items defaults to every menu item from MenuItem.export().
+        Yields text chunks of up to chunk_size items, the first one starting with the header row
+        """
+        if items is None:
+            items = cls.export(chunk_size=chunk_size)
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(MENU_CSV_HEADERS)
+
+        for count, item in enumerate(items, start=1):
+            item['ingredients'] = CSV_LIST_SEPARATOR.join(item['ingredients'])
+            item['intolerants'] = CSV_LIST_SEPARATOR.join(item['intolerants'])
+            writer.writerow([item[header] for header in MENU_CSV_HEADERS])
+
+            if count % chunk_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        if buffer.getvalue():
+            yield buffer.getvalue()
 
     @classmethod
     def serialize(cls, m):
@@ -122,6 +345,52 @@ class MenuItem(db.Model):
             }
         return data
 
+def link_rows(names_by_item):
+    """Flatten a dict of menu item id to list of names into (menu item id, name) pairs, skipping blank names"""
+    return [(menu_item_id, name) for menu_item_id, names in names_by_item.items() for name in names if name]
+
+def insert_names(table, names):
+    """Insert names into an ingredient or intolerant table in one statement, skipping existing ones"""
+    # sorted so concurrent imports insert names in the same order and can't deadlock
+    db.session.execute(db.text(f"""
+        INSERT INTO {table.name} (name)
+        SELECT name FROM unnest(CAST(:names AS varchar[])) AS names (name)
+        ON CONFLICT DO NOTHING"""),
+        {'names': sorted(names)})
+
+def insert_arrays(table, columns):
+    """Insert rows in one statement however many there are, unnesting one array per column
+    columns is a dict of column name to list of values, all the same length
+
+    Much cheaper to build and parse than a multi-row VALUES insert for large batches
+    """
+    params = {}
+    casts = []
+    for name, values in columns.items():
+        column_type = table.c[name].type
+        if isinstance(column_type, db.Numeric):
+            # as text, so a mix of strings, ints and floats makes one numeric array
+            values = [None if v is None else str(v) for v in values]
+        params[name] = values
+        casts.append(f'CAST(:{name} AS {column_type.compile(dialect=postgresql.dialect())}[])')
+
+    db.session.execute(db.text(f"""
+        INSERT INTO {table.name} ({', '.join(columns)})
+        SELECT * FROM unnest({', '.join(casts)})"""),
+        params)
+
+def insert_links(join_table, fk_column, catalog_table, links):
+    """Insert join table rows for (menu item id, name) pairs in one statement,
+    looking names up in the catalog table. Unknown names and existing links are skipped
+    """
+    db.session.execute(db.text(f"""
+        INSERT INTO {join_table} (menu_item_id, {fk_column})
+        SELECT links.menu_item_id, {catalog_table}.id
+        FROM unnest(CAST(:menu_item_ids AS integer[]), CAST(:names AS varchar[])) AS links (menu_item_id, name)
+        JOIN {catalog_table} ON {catalog_table}.name = links.name
+        ON CONFLICT DO NOTHING"""),
+        {'menu_item_ids': [menu_item_id for menu_item_id, _ in links], 'names': [name for _, name in links]})
+
 class Ingredient(db.Model):
     """Ingredient model"""
     __tablename__ = 'ingredients'
@@ -166,3 +435,58 @@ class RestaurantMenu(db.Model):
 
     menu_item_id = db.Column(db.ForeignKey('menu_items.id', ondelete='cascade'), primary_key=True)
     restaurant_id = db.Column(db.ForeignKey('restaurants.id', ondelete='cascade'), primary_key=True)
+
+############ Full text search triggers ############
+# menu_items.search_vector is set from an item's name, ingredient names and description,
+# weighted in that order, whenever the item is inserted or those columns change, and
+# again, in one set based update, for the items whose ingredient links a statement inserts or deletes.
+# Created with items_ingredients, which comes after the menu_items and ingredients tables the triggers read
+event.listen(ItemIngredient.__table__, 'after_create', DDL("""
+    CREATE OR REPLACE FUNCTION menu_item_search_vector(name varchar, ingredient_names text, description text) RETURNS tsvector AS $$
+        SELECT setweight(to_tsvector('simple', coalesce(name, '')), 'A')
+            || setweight(to_tsvector('simple', coalesce(ingredient_names, '')), 'B')
+            || setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION menu_items_set_search_vector() RETURNS trigger AS $$
+    DECLARE
+        ingredient_names text;
+    BEGIN
+        -- a new item can't have ingredient links yet
+        IF TG_OP = 'UPDATE' THEN
+            SELECT string_agg(ingredients.name, ' ') INTO ingredient_names
+            FROM items_ingredients JOIN ingredients ON ingredients.id = items_ingredients.ingredient_id
+            WHERE items_ingredients.menu_item_id = NEW.id;
+        END IF;
+
+        NEW.search_vector := menu_item_search_vector(NEW.name, ingredient_names, NEW.description);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER menu_items_search_vector BEFORE INSERT OR UPDATE OF name, description ON menu_items
+    FOR EACH ROW EXECUTE FUNCTION menu_items_set_search_vector();
+
+    CREATE OR REPLACE FUNCTION items_ingredients_refresh_search_vector() RETURNS trigger AS $$
+    BEGIN
+        UPDATE menu_items SET search_vector = menu_item_search_vector(menu_items.name, links.ingredient_names, menu_items.description)
+        FROM (
+            SELECT changed.menu_item_id, string_agg(ingredients.name, ' ') AS ingredient_names
+            FROM (SELECT DISTINCT menu_item_id FROM changed_links) AS changed
+            LEFT JOIN items_ingredients ON items_ingredients.menu_item_id = changed.menu_item_id
+            LEFT JOIN ingredients ON ingredients.id = items_ingredients.ingredient_id
+            GROUP BY changed.menu_item_id
+        ) AS links
+        WHERE menu_items.id = links.menu_item_id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER items_ingredients_inserted AFTER INSERT ON items_ingredients
+    REFERENCING NEW TABLE AS changed_links
+    FOR EACH STATEMENT EXECUTE FUNCTION items_ingredients_refresh_search_vector();
+
+    CREATE TRIGGER items_ingredients_deleted AFTER DELETE ON items_ingredients
+    REFERENCING OLD TABLE AS changed_links
+    FOR EACH STATEMENT EXECUTE FUNCTION items_ingredients_refresh_search_vector();
+"""))
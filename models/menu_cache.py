@@ -0,0 +1,165 @@
+"""In-process cache of restaurant menus
+
+Menus change a few times a day but are rendered on every order page, so each
+restaurant's menu is loaded once into a MenuSnapshot and reused until it goes stale.
+
+A snapshot is stale when the restaurant's menu version has been bumped since it was
+built, or when it is older than MENU_CACHE_TTL seconds. Versions are bumped
+automatically when a commit touches menu items, ingredients, intolerants or restaurants
+through the ORM. Code writing menu tables with bulk/core statements must call
+bump_menu_version() itself. The TTL bounds how long other worker processes,
+which don't see this process' bumps, can serve an old menu.
+"""
+
+import time
+from hashlib import sha1
+from threading import Lock
+from flask import current_app, json
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models.db import db
+from models.item_models import MenuItem, Ingredient, Intolerant, ItemIngredient, ItemIntolerant, RestaurantMenu
+from models.restaurant_models import Restaurant
+
+DEFAULT_TTL = 60
+# payloads kept at most, as filtered menu responses get one per filter combination
+MAX_PAYLOADS = 1000
+ALL_RESTAURANTS = 'all'
+
+_lock = Lock()
+# bumped when a change could touch any restaurant's menu, eg. an edited menu item
+_generation = 0
+_versions = {}
+_snapshots = {}
+_payloads = {}
+
+class MenuSnapshot:
+    """A restaurant's menu as plain dictionaries, the same shape as MenuItem.serialize()
+
+    items is the whole menu ordered by id, by_type groups the same items by meal_type,
+    in order of first appearance, so templates can render each tab without scanning every item
+    """
+
+    def __init__(self, restaurant_id, version, items):
+        self.restaurant_id = restaurant_id
+        self.version = version
+        self.items = items
+        self.by_type = {}
+        for item in items:
+            self.by_type.setdefault(item['meal_type'], []).append(item)
+        self.built_at = time.monotonic()
+
+    def __repr__(self):
+        return f'<MenuSnapshot restaurant:{self.restaurant_id}, version:{self.version}, items:{len(self.items)}>'
+
+def menu_version(restaurant_id):
+    """Current menu version of a restaurant in this process, as a (generation, restaurant version) tuple"""
+    return (_generation, _versions.get(restaurant_id, 0))
+
+def bump_menu_version(restaurant_id=None):
+    """Mark a restaurant's cached menu as stale, or every restaurant's if restaurant_id is None"""
+    global _generation
+    with _lock:
+        if restaurant_id is None:
+            _generation += 1
+        else:
+            _versions[restaurant_id] = _versions.get(restaurant_id, 0) + 1
+
+def get_menu_snapshot(restaurant_id):
+    """Get the menu snapshot for a restaurant, building it if missing or stale
+
+    A hit runs no queries. A miss loads the menu items with their ingredients and
+    intolerants in three queries
+    """
+    version = menu_version(restaurant_id)
+    ttl = current_app.config.get('MENU_CACHE_TTL', DEFAULT_TTL)
+
+    snapshot = _snapshots.get(restaurant_id)
+    if snapshot and snapshot.version == version and time.monotonic() - snapshot.built_at < ttl:
+        return snapshot
+
+    items = (MenuItem.query
+             .join(RestaurantMenu, RestaurantMenu.menu_item_id == MenuItem.id)
+             .filter(RestaurantMenu.restaurant_id == restaurant_id)
+             .options(db.selectinload(MenuItem.ingredients), db.selectinload(MenuItem.intolerants))
+             .order_by(MenuItem.id)
+             .all())
+
+    # built with the version read before loading, so a bump during the load leaves it stale
+    snapshot = MenuSnapshot(restaurant_id, version, [MenuItem.serialize(item) for item in items])
+    with _lock:
+        _snapshots[restaurant_id] = snapshot
+
+    return snapshot
+
+class MenuPayload:
+    """A serialized menu API response body and its strong ETag
+
+    The ETag is a hash of the body, so every worker process gives the same
+    content the same ETag whatever its local menu version is
+    """
+
+    def __init__(self, version, body):
+        self.version = version
+        self.body = body
+        self.etag = sha1(body.encode()).hexdigest()
+        self.built_at = time.monotonic()
+
+def get_menu_payload(key, build):
+    """Get a cached JSON response body for a menu API endpoint
+
+    key identifies the endpoint and its arguments. On a miss, or once the menu
+    has changed, build() is called for the data to serialize as {"data": ...}.
+    A hit runs no queries
+    """
+    version = _generation
+    ttl = current_app.config.get('MENU_CACHE_TTL', DEFAULT_TTL)
+
+    payload = _payloads.get(key)
+    if payload and payload.version == version and time.monotonic() - payload.built_at < ttl:
+        return payload
+
+    payload = MenuPayload(version, json.dumps({'data': build()}))
+    with _lock:
+        _payloads.pop(key, None)
+        _payloads[key] = payload
+        # dicts keep insertion order, so the first key is the least recently built payload
+        while len(_payloads) > MAX_PAYLOADS:
+            del _payloads[next(iter(_payloads))]
+
+    return payload
+
+def clear_menu_cache():
+    """Drop every cached snapshot and payload"""
+    with _lock:
+        _snapshots.clear()
+        _payloads.clear()
+
+############ Invalidation on commit ############
+MENU_MODELS = (MenuItem, Ingredient, Intolerant, ItemIngredient, ItemIntolerant)
+
+@event.listens_for(Session, 'after_flush')
+def _collect_menu_changes(session, flush_context):
+    """Note which restaurants' menus a flush changed, to bump once the transaction commits"""
+    changed = session.info.setdefault('menu_changes', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, MENU_MODELS):
+            changed.add(ALL_RESTAURANTS)
+        elif isinstance(obj, Restaurant):
+            changed.add(obj.id)
+        elif isinstance(obj, RestaurantMenu):
+            changed.add(obj.restaurant_id)
+
+@event.listens_for(Session, 'after_commit')
+def _bump_changed_menus(session):
+    changed = session.info.pop('menu_changes', set())
+    if ALL_RESTAURANTS in changed:
+        bump_menu_version()
+        return
+
+    for restaurant_id in changed:
+        bump_menu_version(restaurant_id)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_menu_changes(session):
+    session.info.pop('menu_changes', None)
@@ -0,0 +1,217 @@
+"""Prometheus metrics for request latency and order throughput
+
+Gunicorn's workers share one listening socket, so each scrape of /metrics reaches
+whichever worker accepts it. For every scrape to see the same totals, each worker
+keeps its counters in memory and a thread writes them to a file of its own in
+METRICS_DIR every FLUSH_INTERVAL seconds, and when it exits. The worker answering a
+scrape adds up every file, keeping those of workers that have since exited so
+the totals never go down. gunicorn.conf.py empties METRICS_DIR when gunicorn starts.
+Without METRICS_DIR, eg. under `flask run`, a process only reports its own counters.
+
+Orders created and closed and items added are counted by the worker that commits
+them, when the commit succeeds. Active orders are read from the database on a
+scrape. Connection pool counters are added up like the others, but the pool's
+current size, checkouts and overflow are the scraped worker's, labelled with its pid.
+"""
+
+import json
+import os
+import tempfile
+import time
+from glob import glob
+from threading import Lock, Thread
+from flask import current_app, g, request
+from models.db import db, pool_metrics
+from models.order_events import on_order_event_committed
+from models.order_models import Order
+
+# seconds, from a cached menu response up to a slow export
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# seconds a worker's counters may be behind in METRICS_DIR
+FLUSH_INTERVAL = 1
+# order events counted, with the metric each one adds to
+ORDER_EVENT_METRICS = {
+    'order_created': 'omakase_orders_created_total',
+    'order_closed': 'omakase_orders_closed_total',
+    'items_added': 'omakase_items_added_total',
+}
+# pool_metrics counters, the rest of its snapshot are gauges
+POOL_COUNTERS = ('checkouts', 'timeouts', 'connects', 'wait_seconds')
+
+# type and help text of every metric, in the order they're rendered
+METRICS = {
+    'omakase_request_duration_seconds': ('histogram', 'Request latency by blueprint and route'),
+    'omakase_requests_total': ('counter', 'Requests by blueprint and response status'),
+    'omakase_orders_created_total': ('counter', 'Orders created'),
+    'omakase_orders_closed_total': ('counter', 'Orders closed'),
+    'omakase_items_added_total': ('counter', 'Menu items added to orders'),
+    'omakase_active_orders': ('gauge', 'Orders not closed yet'),
+}
+METRICS.update({f'omakase_db_pool_{key}_total': ('counter', f'Connection pool {key.replace("_", " ")}') for key in POOL_COUNTERS})
+
+class Counters:
+    """This process' counters, keyed by metric name and labels, and shared through METRICS_DIR"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.values = {}
+        self.directory = None
+        self.changed = False
+        self.flusher_pid = None
+
+    def add(self, name, labels, amount=1):
+        """Add to a counter, labels being a tuple of (label, value) pairs"""
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+            self.changed = True
+
+    def observe(self, name, labels, seconds):
+        """Record seconds in a histogram, as cumulative bucket counters plus a sum and count"""
+        with self.lock:
+            # every bucket gets a series, even if nothing is in it yet
+            for bound in LATENCY_BUCKETS + ('+Inf',):
+                key = (f'{name}_bucket', labels + (('le', str(bound)),))
+                self.values[key] = self.values.get(key, 0) + (1 if bound == '+Inf' or seconds <= bound else 0)
+            for key, amount in (((f'{name}_sum', labels), seconds), ((f'{name}_count', labels), 1)):
+                self.values[key] = self.values.get(key, 0) + amount
+            self.changed = True
+
+    def local(self):
+        """This process' counters, with the connection pool's"""
+        with self.lock:
+            values = dict(self.values)
+
+        snapshot = pool_metrics.snapshot(db.engine.pool)
+        for key in POOL_COUNTERS:
+            values[(f'omakase_db_pool_{key}_total', ())] = snapshot[key]
+
+        return values
+
+    def path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    def flush(self):
+        """Write this process' counters to its file in METRICS_DIR, if set"""
+        if not self.directory:
+            return
+
+        with self.lock:
+            self.changed = False
+        data = [[name, labels, value] for (name, labels), value in self.local().items()]
+        # written aside and renamed into place, so a scrape never reads half a file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path(os.getpid()))
+
+    def start_flusher(self, app):
+        """Flush every FLUSH_INTERVAL seconds something changed, from a thread of this process
+
+        Started on a worker's first request, as threads don't survive gunicorn forking workers
+        """
+        if not self.directory or self.flusher_pid == os.getpid():
+            return
+
+        self.flusher_pid = os.getpid()
+        Thread(target=self.flush_forever, args=(app,), name='metrics-flusher', daemon=True).start()
+
+    def flush_forever(self, app):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            if self.changed:
+                with app.app_context():
+                    self.flush()
+
+    def totals(self):
+        """Every worker's counters added up, or only this process' without METRICS_DIR"""
+        if not self.directory:
+            return self.local()
+
+        self.flush()
+        totals = {}
+        for path in glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                # removed since listing it
+                continue
+            for name, labels, value in data:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                totals[key] = totals.get(key, 0) + value
+
+        return totals
+
+counters = Counters()
+
+def format_labels(labels):
+    return ','.join(f'{label}="{value}"' for label, value in labels)
+
+def metric_name(name):
+    """The metric a histogram series belongs to, eg. x for x_bucket"""
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+def sort_key(item):
+    (name, labels), value = item
+    # buckets in increasing order of their bound
+    return name, [(label, float(value) if label == 'le' else 0, value) for label, value in labels]
+
+def active_orders():
+    rows = (db.session.query(Order.restaurant_id, db.func.count())
+            .filter(Order.active == True)
+            .group_by(Order.restaurant_id)
+            .all())
+    return {('omakase_active_orders', (('restaurant_id', str(restaurant_id or '')),)): count for restaurant_id, count in rows}
+
+def render_metrics():
+    """Every metric in the Prometheus text exposition format"""
+    series = counters.totals()
+    # active orders are read from the database, so they're right from the first scrape
+    series.update(active_orders())
+
+    by_metric = {name: [] for name in METRICS}
+    for item in sorted(series.items(), key=sort_key):
+        (name, labels), value = item
+        by_metric[metric_name(name)].append(f'{name}{{{format_labels(labels)}}} {value}' if labels else f'{name} {value}')
+
+    lines = []
+    for name, (type, help) in METRICS.items():
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} {type}'] + by_metric[name]
+
+    worker = os.getpid()
+    for key, value in pool_metrics.snapshot(db.engine.pool).items():
+        if key not in POOL_COUNTERS:
+            lines += [f'# TYPE omakase_db_pool_{key} gauge', f'omakase_db_pool_{key}{{worker="{worker}"}} {value}']
+
+    return '\n'.join(lines) + '\n'
+
+def count_order_event(event):
+    name = ORDER_EVENT_METRICS.get(event.get('event'))
+    if name:
+        counters.add(name, (('restaurant_id', str(event.get('restaurant_id') or '')),), event.get('quantity', 1))
+
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+def _record_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        # the route pattern, not the path, so ids in urls don't make a series each
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        blueprint = request.blueprint or 'app'
+        counters.observe('omakase_request_duration_seconds', (('blueprint', blueprint), ('route', route)), time.perf_counter() - start)
+        counters.add('omakase_requests_total', (('blueprint', blueprint), ('status', str(response.status_code))))
+        counters.start_flusher(current_app._get_current_object())
+
+    return response
+
+def init_metrics(app):
+    """Time every request of app and count committed order events for the /metrics endpoint"""
+    counters.directory = app.config.get('METRICS_DIR')
+    on_order_event_committed(count_order_event)
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
@@ -0,0 +1,146 @@
+"""Real-time order events over PostgreSQL LISTEN/NOTIFY
+
+Order changes call publish_order_event() inside their transaction, which queues a
+NOTIFY on the order_events channel. PostgreSQL only delivers it if the transaction
+commits, and delivers it to every worker process listening.
+
+Each process runs one listener thread on a dedicated connection and fans events
+out to in-process subscriber queues, one per open dashboard event stream, so
+streams cost no database work of their own.
+
+Handlers added with on_order_event_committed() are called once a process' own
+events are committed, eg. to count them for metrics without counting them once per worker.
+"""
+
+import json
+import select
+from queue import Queue, Full
+from threading import Event, Lock, Thread
+from sqlalchemy import event as sqlalchemy_event
+from models.db import db, listen_engine
+
+CHANNEL = 'order_events'
+# seconds the listener waits on its connection before checking it again
+POLL_TIMEOUT = 5
+# events a slow subscriber may fall behind by before it is dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+# session.info key of the events published in the session's current transaction
+PENDING_EVENTS = 'pending_order_events'
+
+_commit_handlers = []
+
+def publish_order_event(event, order_id, restaurant_id=None, quantity=None):
+    """Queue an order event, sent when the current transaction commits
+
+    event is one of 'order_created', 'order_updated', 'order_closed',
+    'need_assistance' or 'items_added'. New orders need flushing first to have an id.
+    restaurant_id lets subscribers skip other locations' orders, quantity is
+    the number of items added for 'items_added'
+    """
+    data = {'event': event, 'order_id': order_id, 'restaurant_id': restaurant_id}
+    if quantity is not None:
+        data['quantity'] = quantity
+    payload = json.dumps(data)
+    db.session.execute(db.text('SELECT pg_notify(:channel, :payload)'), {'channel': CHANNEL, 'payload': payload})
+    db.session.info.setdefault(PENDING_EVENTS, []).append(data)
+
+def on_order_event_committed(handler):
+    """Call handler(event) for every order event this process commits, right after the commit
+
+    Handlers run on the committing thread and must be quick, and can't use the session
+    """
+    if handler not in _commit_handlers:
+        _commit_handlers.append(handler)
+
+@sqlalchemy_event.listens_for(db.session, 'after_commit')
+def _events_committed(session):
+    for data in session.info.pop(PENDING_EVENTS, []):
+        for handler in _commit_handlers:
+            handler(data)
+
+@sqlalchemy_event.listens_for(db.session, 'after_rollback')
+def _events_rolled_back(session):
+    session.info.pop(PENDING_EVENTS, None)
+
+class OrderEventBus:
+    """Fans order events from one LISTEN connection out to subscriber queues"""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = Lock()
+        self.thread = None
+        self.listening = Event()
+
+    def subscribe(self):
+        """Get a queue that receives every order event from now on, starting the listener if needed"""
+        queue = Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(queue)
+            self.start()
+
+        # events committed before LISTEN runs would be missed, so wait for it
+        self.listening.wait(POLL_TIMEOUT)
+        return queue
+
+    def start(self):
+        """Start the listener thread if it isn't running, called holding the lock"""
+        if self.thread is None or not self.thread.is_alive():
+            self.listening.clear()
+            self.thread = Thread(target=self.listen, args=(listen_engine(),), name='order-event-listener', daemon=True)
+            self.thread.start()
+
+    def is_listening(self):
+        return self.listening.is_set()
+
+    def is_subscribed(self, queue):
+        """Is the queue still receiving events? Queues that fell too far behind are dropped"""
+        with self.lock:
+            return queue in self.subscribers
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            self.subscribers.discard(queue)
+
+    def dispatch(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for queue in subscribers:
+            try:
+                queue.put_nowait(event)
+            except Full:
+                # the stream stopped reading, drop it instead of buffering forever. The
+                # stream sees it's no longer subscribed and ends, so the browser reconnects and reloads
+                self.unsubscribe(queue)
+
+    def listen(self, engine):
+        """Listener thread: LISTEN on a connection kept out of the pool and dispatch notifications"""
+        conn = engine.raw_connection()
+        conn.detach()
+        try:
+            conn.connection.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute(f'LISTEN {CHANNEL}')
+            self.listening.set()
+
+            while True:
+                with self.lock:
+                    if not self.subscribers:
+                        self.thread = None
+                        self.listening.clear()
+                        return
+
+                if select.select([conn.connection], [], [], POLL_TIMEOUT) == ([], [], []):
+                    continue
+
+                conn.connection.poll()
+                while conn.connection.notifies:
+                    notify = conn.connection.notifies.pop(0)
+                    self.dispatch(json.loads(notify.payload))
+        except Exception:
+            self.listening.clear()
+            raise
+        finally:
+            conn.close()
+
+order_event_bus = OrderEventBus()
@@ -2,17 +2,47 @@
 
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.exc import SQLAlchemyError
-from datetime import datetime
+from sqlalchemy.dialects.postgresql import insert
+from datetime import datetime, timedelta
+from decimal import Decimal
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from itertools import groupby
+import csv
+import io
+import json
 from models.db import db
 from models.item_models import MenuItem
 from models.restaurant_models import Table
+from models.order_events import publish_order_event
+
+DELIVERY_COST = 5
+PAGE_SIZE = 50
+EXPORT_CHUNK_SIZE = 1000
+# seconds of changes re-sent on every kitchen feed poll, to cover transactions
+# that were stamped before the previous poll but committed after it
+KITCHEN_FEED_OVERLAP = 5
+EXPORT_CSV_HEADERS = ['order_id', 'timestamp', 'type', 'table_number', 'employee_id', 'active', 'payment_method', 'total_cost',
+                      'menu_item_id', 'menu_item_name', 'cost', 'quantity']
 
 class Order(db.Model):
     """Order Model"""
     __tablename__ = 'orders'
+    # Composite indexes back keyset pagination on (timestamp, id), alone and behind each filter
+    __table_args__ = (
+        db.Index('ix_orders_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_orders_active_timestamp_id', 'active', 'timestamp', 'id'),
+        db.Index('ix_orders_type_timestamp_id', 'type', 'timestamp', 'id'),
+        db.Index('ix_orders_table_number_timestamp_id', 'table_number', 'timestamp', 'id'),
+        db.Index('ix_orders_employee_id_timestamp_id', 'employee_id', 'timestamp', 'id'),
+        # each location's dashboard and history only read its own orders
+        db.Index('ix_orders_restaurant_id_timestamp_id', 'restaurant_id', 'timestamp', 'id'),
+        db.Index('ix_orders_restaurant_id_active_timestamp_id', 'restaurant_id', 'active', 'timestamp', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurants.id', ondelete='cascade'))
+
     employee_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"))
 
     table_number = db.Column(db.Integer, db.ForeignKey('tables.id', ondelete='cascade'))
@@ -25,18 +55,23 @@ class Order(db.Model):
 
     payment_method = db.Column(db.String)
 
-    timestamp = db.Column(db.TIMESTAMP, nullable=False, default=datetime.now())
+    timestamp = db.Column(db.TIMESTAMP, nullable=False, default=datetime.now)
+
+    # database clock time of the last change to the order or its items, for the kitchen feed
+    updated_at = db.Column(db.TIMESTAMP, nullable=False, default=db.func.localtimestamp(), onupdate=db.func.localtimestamp(), index=True)
 
     customers = db.relationship('User', secondary="customers_orders", backref='order')
     
     ordered_items = db.relationship('OrderedItems', backref='associated_orders')
 
     @classmethod
-    def create(cls, table_number=None, type='Dining In'):
+    def create(cls, table_number=None, type='Dining In', restaurant_id=None):
 
-        new_order = Order(table_number=table_number, type=type)
+        new_order = Order(table_number=table_number, type=type, restaurant_id=restaurant_id)
         try:
             db.session.add(new_order)
+            db.session.flush()
+            publish_order_event('order_created', new_order.id, restaurant_id)
             db.session.commit() 
         except SQLAlchemyError as e:
             db.session.rollback()
@@ -50,7 +85,9 @@ class Order(db.Model):
         The ordered items are represented as a list of dictionaries, each containing the item's id and quantity.
         """
     @classmethod
-    def serialize(cls, o):
+    def serialize(cls, o, expand_items=False):
+        """expand_items adds each ordered item's menu item name and cost,
+        read with one join instead of a request per item"""
         data = {
             "id": o.id,
             "table_number": o.table_number,
@@ -58,27 +95,309 @@ class Order(db.Model):
             "need_assistance": o.need_assistance,
             "type": o.type,
             "timestamp": o.timestamp,
-
-            "ordered_items": [{'item_id':i.menu_item_id, 'qty':i.quantity} for i in o.ordered_items],
             }
+
+        if expand_items:
+            items = (db.session.query(OrderedItems.menu_item_id, OrderedItems.quantity, MenuItem.name, MenuItem.cost)
+                     .join(MenuItem, MenuItem.id == OrderedItems.menu_item_id)
+                     .filter(OrderedItems.order_id == o.id)
+                     .order_by(OrderedItems.id))
+            data["ordered_items"] = [{'item_id': item_id, 'qty': qty, 'name': name, 'cost': cost} for item_id, qty, name, cost in items]
+        else:
+            data["ordered_items"] = [{'item_id':i.menu_item_id, 'qty':i.quantity} for i in o.ordered_items]
+
         return data
     
+    @classmethod
+    def filtered(cls, active=None, type=None, table_number=None, employee_id=None, since=None, until=None, restaurant_id=None):
+        """Build an order query from optional filters; filters left as None are not applied
+        
+        since and until are datetimes bounding the order timestamp, since inclusive and until exclusive
+        """
+        query = cls.query
+        for column, value in ((cls.restaurant_id, restaurant_id), (cls.active, active), (cls.type, type),
+                              (cls.table_number, table_number), (cls.employee_id, employee_id)):
+            if value is not None:
+                query = query.filter(column == value)
+
+        if since is not None:
+            query = query.filter(cls.timestamp >= since)
+        if until is not None:
+            query = query.filter(cls.timestamp < until)
+
+        return query
+
+    @classmethod
+    def page(cls, query, cursor=None, limit=PAGE_SIZE):
+        """Keyset pagination over (timestamp, id), newest orders first
+        
+        cursor is the value returned by Order.encode_cursor() for the last order of the previous page.
+        Only rows after the cursor are read, so every page costs the same however deep it is.
+        Raises ValueError for a malformed cursor
+        """
+        if cursor:
+            timestamp, id = cls.decode_cursor(cursor)
+            query = query.filter(db.tuple_(cls.timestamp, cls.id) < db.tuple_(timestamp, id))
+
+        return query.order_by(cls.timestamp.desc(), cls.id.desc()).limit(limit)
+
+    @classmethod
+    def encode_cursor(cls, timestamp, id):
+        """Make an opaque pagination cursor pointing after the order with this timestamp and id"""
+        return urlsafe_b64encode(f'{timestamp.isoformat()}|{id}'.encode()).decode()
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        """Read (timestamp, id) back out of a cursor made by Order.encode_cursor()"""
+        try:
+            timestamp, id = urlsafe_b64decode(cursor.encode()).decode().split('|')
+            return datetime.fromisoformat(timestamp), int(id)
+        except (TypeError, ValueError, UnicodeError) as e:
+            raise ValueError(f'Invalid cursor: {cursor}') from e
+
+    @classmethod
+    def serialize_all(cls, query=None):
+        """Serialize many orders in two queries, an order query and an ordered items query
+
+        Reads plain column tuples instead of ORM objects, so orders don't lazy load
+        their ordered items one by one. query defaults to every order.
+        Returns a list of dictionaries in the same format as Order.serialize()
+        """
+        if query is None:
+            query = cls.query
+
+        rows = query.with_entities(cls.id, cls.table_number, cls.active, cls.need_assistance, cls.type, cls.timestamp).all()
+        data = []
+        by_id = {}
+        for id, table_number, active, need_assistance, type, timestamp in rows:
+            order = {
+                "id": id,
+                "table_number": table_number,
+                "active": active,
+                "need_assistance": need_assistance,
+                "type": type,
+                "timestamp": timestamp,
+
+                "ordered_items": [],
+                }
+            data.append(order)
+            by_id[id] = order
+
+        if not by_id:
+            return data
+
+        items = (db.session.query(OrderedItems.order_id, OrderedItems.menu_item_id, OrderedItems.quantity)
+                 .filter(OrderedItems.order_id.in_(by_id.keys()))
+                 .order_by(OrderedItems.id))
+        for order_id, menu_item_id, quantity in items:
+            by_id[order_id]["ordered_items"].append({'item_id': menu_item_id, 'qty': quantity})
+
+        return data
+
+    @classmethod
+    def export(cls, query=None, chunk_size=EXPORT_CHUNK_SIZE):
+        """Stream orders with their ordered items and total cost, oldest first
+
+        Runs one query joining orders, ordered_items and menu_items through a server-side
+        cursor, fetching chunk_size rows at a time, so memory use doesn't grow with history.
+        query defaults to every order, pass Order.filtered() to narrow it down.
+        Yields one dictionary per order
+        """
+        if query is None:
+            query = cls.query
+
+        rows = (query.with_entities(cls.id, cls.timestamp, cls.type, cls.table_number, cls.employee_id, cls.active, cls.payment_method,
+                                    OrderedItems.menu_item_id, MenuItem.name, MenuItem.cost, OrderedItems.quantity)
+                .outerjoin(OrderedItems, OrderedItems.order_id == cls.id)
+                .outerjoin(MenuItem, MenuItem.id == OrderedItems.menu_item_id)
+                .order_by(cls.id, OrderedItems.id)
+                .yield_per(chunk_size))
+
+        for order_id, order_rows in groupby(rows, key=lambda row: row[0]):
+            order_rows = list(order_rows)
+            _, timestamp, type, table_number, employee_id, active, payment_method = order_rows[0][:7]
+
+            items = [{'item_id': item_id, 'name': name, 'cost': cost, 'qty': qty}
+                     for *_, item_id, name, cost, qty in order_rows if item_id is not None]
+            total = sum(item['qty'] * item['cost'] for item in items)
+            if type == 'Delivery':
+                total += DELIVERY_COST
+
+            yield {
+                "id": order_id,
+                "timestamp": timestamp,
+                "type": type,
+                "table_number": table_number,
+                "employee_id": employee_id,
+                "active": active,
+                "payment_method": payment_method,
+                "total_cost": round(Decimal(total), 2),
+
+                "ordered_items": items,
+                }
+
+    @classmethod
+    def export_ndjson(cls, query=None, chunk_size=EXPORT_CHUNK_SIZE):
+        """Stream orders as newline delimited JSON, one order per line
+
+        Yields text chunks of up to chunk_size orders
+        """
+        lines = []
+        for order in cls.export(query, chunk_size):
+            lines.append(json.dumps(order, default=lambda v: v.isoformat() if isinstance(v, datetime) else str(v)))
+            if len(lines) == chunk_size:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    @classmethod
+    def export_csv(cls, query=None, chunk_size=EXPORT_CHUNK_SIZE):
+        """Stream orders as CSV, one row per ordered item
+
+        Orders without items get a single row with empty item columns.
+        Yields text chunks of up to chunk_size orders, the first one starting with the header row
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_CSV_HEADERS)
+
+        for count, order in enumerate(cls.export(query, chunk_size), start=1):
+            order_columns = [order['id'], order['timestamp'].isoformat(), order['type'], order['table_number'],
+                             order['employee_id'], order['active'], order['payment_method'], order['total_cost']]
+            for item in order['ordered_items'] or [{}]:
+                writer.writerow(order_columns + [item.get('item_id'), item.get('name'), item.get('cost'), item.get('qty')])
+
+            if count % chunk_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        if buffer.getvalue():
+            yield buffer.getvalue()
+
+    @classmethod
+    def backfill_restaurants(cls, default_restaurant_id, batch_size=1000):
+        """Assign a restaurant to orders from before orders had one, batch_size rows per transaction
+
+        Each order gets its table's restaurant, or else its employee's, or else default_restaurant_id.
+        Yields the number of orders of each batch
+        """
+        # imported here, as models.user_models imports this module
+        from models.user_models import User
+
+        after = 0
+        while True:
+            batch = (db.select([cls.id])
+                     .where(db.and_(cls.id > after, cls.restaurant_id == None))
+                     .order_by(cls.id)
+                     .limit(batch_size))
+            table_restaurant = db.select([Table.restaurant_id]).where(Table.id == cls.table_number).as_scalar()
+            employee_restaurant = db.select([User.restaurant_id]).where(User.id == cls.employee_id).as_scalar()
+            ids = [row.id for row in db.session.execute(cls.__table__.update()
+                                                        .where(cls.id.in_(batch))
+                                                        .values(restaurant_id=db.func.coalesce(table_restaurant, employee_restaurant, default_restaurant_id))
+                                                        .returning(cls.id))]
+            db.session.commit()
+            if not ids:
+                return
+
+            after = max(ids)
+            yield len(ids)
+
+    @classmethod
+    def kitchen_tickets(cls, since=None, restaurant_id=None):
+        """Get orders for the kitchen display, with item names resolved, in one query
+
+        Without since, returns every active order. With since, a datetime from a
+        previous call's cursor, returns only orders changed after it (less
+        KITCHEN_FEED_OVERLAP seconds), closed ones included so screens can drop them.
+        Only restaurant_id's orders are returned if given.
+        Returns a (tickets, cursor) tuple, pass cursor back as since on the next call
+        """
+        cursor = db.session.query(db.func.localtimestamp()).scalar()
+
+        query = db.session.query(cls.id, cls.type, cls.table_number, cls.timestamp, cls.active, cls.need_assistance,
+                                 MenuItem.name, OrderedItems.quantity)
+        if restaurant_id is not None:
+            query = query.filter(cls.restaurant_id == restaurant_id)
+        if since is None:
+            query = query.filter(cls.active == True)
+        else:
+            query = query.filter(cls.updated_at > since - timedelta(seconds=KITCHEN_FEED_OVERLAP))
+
+        rows = (query.outerjoin(OrderedItems, OrderedItems.order_id == cls.id)
+                .outerjoin(MenuItem, MenuItem.id == OrderedItems.menu_item_id)
+                .order_by(cls.timestamp, cls.id, OrderedItems.id))
+
+        tickets = []
+        for order_id, order_rows in groupby(rows, key=lambda row: row[0]):
+            order_rows = list(order_rows)
+            _, type, table_number, timestamp, active, need_assistance = order_rows[0][:6]
+            tickets.append({
+                "id": order_id,
+                "type": type,
+                "table_number": table_number,
+                "timestamp": timestamp,
+                "active": active,
+                "need_assistance": need_assistance,
+
+                "items": [{'name': name, 'qty': qty} for *_, name, qty in order_rows if name is not None],
+                })
+
+        return tickets, cursor
+
     @hybrid_property
     def total_cost(self):
-        total = 0
-        for item in self.ordered_items:
-            menu_item_cost = MenuItem.query.filter_by(id=item.menu_item_id).first().cost
-            rate = item.quantity * menu_item_cost
-            total += rate
-        
-        if self.type == 'Delivery':
-            delivery_cost = 5
-            total += delivery_cost
+        """Total cost of the order, computed in a single aggregate query"""
+        total = db.session.query(Order.total_cost).filter(Order.id == self.id).scalar()
+        if total is None:
+            return Decimal('0.00')
         return round(total, 2)
 
+    @total_cost.expression
+    def total_cost(cls):
+        """SQL side of total_cost, so totals can be filtered and sorted in queries
+        
+        eg. Order.query.filter(Order.total_cost > 20).order_by(Order.total_cost.desc())
+        """
+        subtotal = (db.select([db.func.coalesce(db.func.sum(OrderedItems.quantity * MenuItem.cost), 0)])
+                    .where(OrderedItems.order_id == cls.id)
+                    .where(OrderedItems.menu_item_id == MenuItem.id)
+                    .as_scalar())
+        return subtotal + cls.delivery_surcharge()
+
+    @classmethod
+    def delivery_surcharge(cls):
+        """SQL expression for the flat delivery cost added to delivery orders"""
+        return db.case([(cls.type == 'Delivery', DELIVERY_COST)], else_=0)
+
+    @classmethod
+    def totals(cls, order_ids):
+        """Get the total cost for a batch of orders in one query
+        
+        Sums quantity * cost of ordered items joined against menu_items, grouped by order.
+        Returns a dictionary of {order_id: total_cost}
+        """
+        order_ids = list(order_ids)
+        if not order_ids:
+            return {}
+
+        subtotal = db.func.coalesce(db.func.sum(OrderedItems.quantity * MenuItem.cost), 0)
+        rows = (db.session.query(cls.id, subtotal + cls.delivery_surcharge())
+                .outerjoin(OrderedItems, OrderedItems.order_id == cls.id)
+                .outerjoin(MenuItem, MenuItem.id == OrderedItems.menu_item_id)
+                .filter(cls.id.in_(order_ids))
+                .group_by(cls.id)
+                .all())
+
+        return {order_id: round(total, 2) for order_id, total in rows}
+
     def set_payment_method(self, payment_method):
         self.payment_method = payment_method
         try:
+            publish_order_event('order_updated', self.id, self.restaurant_id)
             db.session.commit()
         except SQLAlchemyError as e:
             db.session.rollback()
@@ -90,6 +409,12 @@ class Order(db.Model):
             setattr(self, k, v)
         
         try:
+            if data.get('active') is False:
+                publish_order_event('order_closed', self.id, self.restaurant_id)
+            elif data.get('need_assistance'):
+                publish_order_event('need_assistance', self.id, self.restaurant_id)
+            else:
+                publish_order_event('order_updated', self.id, self.restaurant_id)
             db.session.commit()
         except SQLAlchemyError as e:
             db.session.rollback()
@@ -101,6 +426,7 @@ class Order(db.Model):
         self.table_number = None
         
         try:
+            publish_order_event('order_closed', self.id, self.restaurant_id)
             db.session.commit()
         except SQLAlchemyError as e:
             db.session.rollback()
@@ -111,6 +437,11 @@ class OrderedItems(db.Model):
     ordered, and their associated order number. Default quantity is 0
     """
     __tablename__ = 'ordered_items'
+    # One row per menu item on an order, which add_items upserts against.
+    # Also serves as the index for looking up an order's items
+    __table_args__ = (
+        db.UniqueConstraint('order_id', 'menu_item_id', name='uq_ordered_items_order_menu_item'),
+    )
 
     def __repr__(self):
         return f'<OrderedItem id:{self.id}, order_id:{self.order_id}, menu_item_id:{self.menu_item_id}, quantity: {self.quantity}>'
@@ -121,24 +452,44 @@ class OrderedItems(db.Model):
     quantity = db.Column(db.Integer, default=0)
 
     @classmethod
-    def get_or_create_ordered_item(cls, order, menu_item_id):
-        """Gets or creates an OrderedItem object for the given order_id and menu_item_id"""
-        
-        # Query ordered_item by order id and menu_item_id
-        ordered_item = OrderedItems.query.filter(OrderedItems.order_id==order.id, OrderedItems.menu_item_id == menu_item_id).first()
+    def add_items(cls, order_id, items):
+        """Add menu items to an order in one atomic statement
+
+        items maps menu_item_id to the quantity to add, eg. {3: 1, 7: 2}.
+        Runs a single INSERT ... ON CONFLICT DO UPDATE, so concurrent adds to the
+        same order increment quantities in the database instead of overwriting each other.
+        Returns True, or None if the order or a menu item doesn't exist
+        """
+        if not items:
+            return True
 
-        # if menu_item was not on the order, ordered_item will be falsey. Instantiate (default qty=0)
-        if not ordered_item:
-            ordered_item = OrderedItems(menu_item_id=menu_item_id)
-            order.ordered_items.append(ordered_item)
+        # sorted so concurrent multi-item adds lock rows in the same order and can't deadlock
+        values = [{'order_id': order_id, 'menu_item_id': menu_item_id, 'quantity': quantity}
+                  for menu_item_id, quantity in sorted(items.items())]
+        stmt = insert(cls.__table__).values(values)
+        stmt = stmt.on_conflict_do_update(
+            constraint='uq_ordered_items_order_menu_item',
+            set_={'quantity': db.func.coalesce(cls.__table__.c.quantity, 0) + stmt.excluded.quantity})
 
-            try:
-                db.session.commit()
-            except SQLAlchemyError as e:
+        try:
+            # touching the order first also serializes concurrent adds to it on the order row
+            order = db.session.execute(Order.__table__.update()
+                                       .where(Order.id == order_id)
+                                       .values(updated_at=db.func.localtimestamp())
+                                       .returning(Order.restaurant_id)).first()
+            if order is None:
                 db.session.rollback()
-                print("An error occurred while creating an ordered item:", e)
+                return None
+
+            db.session.execute(stmt)
+            publish_order_event('items_added', order_id, order.restaurant_id, quantity=sum(items.values()))
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print("An error occurred while adding items to an order:", e)
+            return None
 
-        return ordered_item
+        return True
     
     def update(self, data):
         """Update the OrderedItem object with the given data object"""
@@ -159,5 +510,5 @@ class CustomerOrder(db.Model):
     __tablename__ = 'customers_orders'
 
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="cascade"))
+    customer_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="cascade"), index=True)
     order_id = db.Column(db.Integer, db.ForeignKey("orders.id", ondelete="cascade"))
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""Password hashing with a cap on how many hashes run at once
+
+bcrypt is slow on purpose, BCRYPT_LOG_ROUNDS sets how slow (each extra round
+doubles the work). At most PASSWORD_HASH_WORKERS hashes and checks run at once
+per process, so a burst of logins waits its turn instead of taking every CPU core.
+
+Hashing runs on the request thread, which waits for its turn and then hashes.
+bcrypt releases the GIL, so the worker's other threads, which gunicorn.conf.py's
+gthread workers have and sync workers don't, keep serving requests meanwhile.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+import bcrypt
+from flask import current_app, has_app_context
+
+DEFAULT_ROUNDS = 12
+DEFAULT_WORKERS = 2
+
+_lock = Lock()
+_slots = None
+
+def setting(key, default):
+    return current_app.config.get(key, default) if has_app_context() else default
+
+def password_rounds():
+    """bcrypt cost new hashes are made with"""
+    return setting('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+
+def hash_workers():
+    return setting('PASSWORD_HASH_WORKERS', DEFAULT_WORKERS)
+
+def get_slots():
+    """The process' semaphore of PASSWORD_HASH_WORKERS hashing slots, made on first use"""
+    global _slots
+    with _lock:
+        if _slots is None:
+            _slots = BoundedSemaphore(hash_workers())
+    return _slots
+
+def _hash(password, rounds):
+    with get_slots():
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _check(hashed, password):
+    with get_slots():
+        try:
+            return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+        except ValueError:
+            # not a bcrypt hash
+            return False
+
+def hash_password(password, rounds=None):
+    """Hash a password with rounds or BCRYPT_LOG_ROUNDS, once a hashing slot is free"""
+    return _hash(password, rounds or password_rounds())
+
+def hash_passwords(passwords, rounds=None):
+    """Hash several passwords at once, eg. for the seed script, one thread per hashing slot"""
+    rounds = rounds or password_rounds()
+    with ThreadPoolExecutor(max_workers=hash_workers(), thread_name_prefix='password-hash') as executor:
+        return list(executor.map(_hash, passwords, [rounds] * len(passwords)))
+
+def check_password(hashed, password):
+    """Check a password against a bcrypt hash, once a hashing slot is free"""
+    return _check(hashed, password)
+
+def hash_rounds(hashed):
+    """The cost a bcrypt hash was made with, eg. 12 for '$2b$12$...'"""
+    return int(hashed.split('$')[2])
+
+def needs_rehash(hashed):
+    """Was the hash made with a different cost than BCRYPT_LOG_ROUNDS?"""
+    return hash_rounds(hashed) != password_rounds()
@@ -18,6 +18,7 @@ class Restaurant(db.Model):
 
     menu = db.relationship('MenuItem', secondary="restaurants_menus", backref="restaurants")
     employees = db.relationship('User', backref='restaurant')
+    tables = db.relationship('Table', backref='restaurant')
 
     def update(self, restaurant_data):
         """Update new restaurant from input data"""
@@ -36,8 +37,18 @@ class Table(db.Model):
     """Table Model"""
     __tablename__ = 'tables'
     id = db.Column(db.Integer, primary_key=True)
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurants.id', ondelete='cascade'), index=True)
     taken = db.Column(db.Boolean, nullable=False, default=False)
 
+    @classmethod
+    def available(cls, restaurant_id=None):
+        """Query free tables, only restaurant_id's if given"""
+        query = cls.query.filter_by(taken=False)
+        if restaurant_id is not None:
+            query = query.filter_by(restaurant_id=restaurant_id)
+
+        return query.order_by(cls.id)
+
     @classmethod
     def assign(cls, table_number):
         """Set table to taken based on table number"""
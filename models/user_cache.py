@@ -0,0 +1,82 @@
+"""In-process cache of logged in users for Flask-Login
+
+Flask-Login loads the user on every request, and Flask-Authorize then checks
+its role and group names. Both only need a few fields, so each user is loaded
+once, in one query, into a Principal that's reused for PRINCIPAL_CACHE_TTL seconds.
+
+User.register_employee() and User.delete() drop the user's cached principal.
+Other worker processes don't see that, and keep theirs until the TTL runs out.
+"""
+
+import time
+from collections import namedtuple
+from threading import Lock
+from flask import current_app
+from flask_login import UserMixin
+from models.db import db
+from models.user_models import User, Role, Group, UserRole, UserGroup
+
+DEFAULT_TTL = 30
+
+# Flask-Authorize only reads the name of a role or group
+Credential = namedtuple('Credential', ['name'])
+
+_lock = Lock()
+_principals = {}
+
+class Principal(UserMixin):
+    """A logged in user as Flask-Login and Flask-Authorize see it, detached from any session"""
+
+    def __init__(self, id, username, restaurant_id, roles, groups):
+        self.id = id
+        self.username = username
+        self.restaurant_id = restaurant_id
+        self.roles = tuple(Credential(name) for name in roles)
+        self.groups = tuple(Credential(name) for name in groups)
+        self.loaded_at = time.monotonic()
+
+    def __repr__(self):
+        return f'<Principal #{self.id}, {self.username}>'
+
+def load_principal(user_id):
+    """Load a user's principal in one query, or None if there's no such user"""
+    role_names = (db.select([db.func.array_agg(Role.name)])
+                  .where(db.and_(UserRole.c.user_id == User.id, UserRole.c.role_id == Role.id))
+                  .as_scalar())
+    group_names = (db.select([db.func.array_agg(Group.name)])
+                   .where(db.and_(UserGroup.c.user_id == User.id, UserGroup.c.group_id == Group.id))
+                   .as_scalar())
+    row = (db.session.query(User.id, User.uname, User.restaurant_id, role_names, group_names)
+           .filter(User.id == user_id)
+           .first())
+    if row is None:
+        return None
+
+    id, username, restaurant_id, roles, groups = row
+    return Principal(id, username, restaurant_id, roles or [], groups or [])
+
+def get_principal(user_id):
+    """Get a user's principal, loading it if missing or older than PRINCIPAL_CACHE_TTL. A hit runs no queries"""
+    ttl = current_app.config.get('PRINCIPAL_CACHE_TTL', DEFAULT_TTL)
+
+    principal = _principals.get(user_id)
+    if principal and time.monotonic() - principal.loaded_at < ttl:
+        return principal
+
+    principal = load_principal(user_id)
+    with _lock:
+        if principal is None:
+            _principals.pop(user_id, None)
+        else:
+            _principals[user_id] = principal
+
+    return principal
+
+def invalidate_principal(user_id):
+    """Drop a user's cached principal, so their next request loads it again"""
+    with _lock:
+        _principals.pop(user_id, None)
+
+def clear_principal_cache():
+    with _lock:
+        _principals.clear()
@@ -2,28 +2,32 @@
 
 from flask_authorize import RestrictionsMixin, AllowancesMixin
 from flask_login import UserMixin
+from datetime import datetime
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.exc import SQLAlchemyError
-from flask_bcrypt import Bcrypt
 from models.db import db
-from models.order_models import Order
+from models.order_models import Order, CustomerOrder
+from models.passwords import hash_password, check_password, needs_rehash
 
 # db = SQLAlchemy()
-bcrypt = Bcrypt()
 
 # mapping tables
 UserGroup = db.Table(
     'user_group', db.Model.metadata,
-    db.Column('user_id', db.Integer, db.ForeignKey('users.id', ondelete="cascade")),
-    db.Column('group_id', db.Integer, db.ForeignKey('groups.id', ondelete="cascade"))
+    db.Column('user_id', db.Integer, db.ForeignKey('users.id', ondelete="cascade"), index=True),
+    db.Column('group_id', db.Integer, db.ForeignKey('groups.id', ondelete="cascade")),
+    # for listing a group's users, see User.employees()
+    db.Index('ix_user_group_group_id_user_id', 'group_id', 'user_id')
 )
 
 
 UserRole = db.Table(
     'user_role', db.Model.metadata,
-    db.Column('user_id', db.Integer, db.ForeignKey('users.id', ondelete="cascade")),
+    db.Column('user_id', db.Integer, db.ForeignKey('users.id', ondelete="cascade"), index=True),
     db.Column('role_id', db.Integer, db.ForeignKey('roles.id', ondelete="cascade"))
 )
 
@@ -48,16 +52,24 @@ class User(db.Model, UserMixin):
     restaurant_id, name, address, birthday, role
     """
     __tablename__ = 'users'
+    # read uname and username_normalized back from the insert, as the database assigns them
+    __mapper_args__ = {'eager_defaults': True}
 
     def __repr__(self):
-        return f'<User #{self.id}, {self.username}, {self.groups[0].name}>'
+        return f'<User #{self.id}, {self.username}>'
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False, default='user')
     temp = db.Column(db.Boolean, nullable=False, default=False)
-    uname = db.Column(db.String(255))
+    # when a temporary customer last ordered, for purge_temp_customers()
+    last_seen_at = db.Column(db.TIMESTAMP, nullable=False, server_default=db.func.localtimestamp())
+    # defaults to name without spaces plus id, assigned on insert by the users_assign_username trigger below,
+    # and always NULL for temporary customers
+    uname = db.Column(db.String(255), server_default=db.FetchedValue(), server_onupdate=db.FetchedValue())
+    # lowercased uname, kept by the same trigger, which logins look up
+    username_normalized = db.Column(db.String(255), server_default=db.FetchedValue(), server_onupdate=db.FetchedValue())
     password = db.Column(db.String(255))    
-    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurants.id", ondelete="cascade"))
+    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurants.id", ondelete="cascade"), index=True)
     email = db.Column(db.String(255))
     address = db.Column(db.String)
     birthday = db.Column(db.Date, default="1/1/1990")
@@ -69,35 +81,84 @@ class User(db.Model, UserMixin):
     roles = db.relationship('Role', secondary=UserRole)
     groups = db.relationship('Group', secondary=UserGroup)
 
+    __table_args__ = (
+        # temporary customers have no username
+        db.Index('ux_users_username_normalized', 'username_normalized', unique=True, postgresql_where=db.text('NOT temp')),
+        # returning customers are found by phone number, and stale ones by age
+        db.Index('ix_users_temp_phone_number', 'phone_number', postgresql_where=db.text('temp')),
+        db.Index('ix_users_temp_last_seen_at', 'last_seen_at', postgresql_where=db.text('temp')),
+    )
+
     @hybrid_property
     def username(self):
-        if self.uname is None:
-            self.uname = self.name.replace(" ", "") + str(self.id)
-            return self.uname
-        else: 
-            return self.uname
+        return self.uname
+
+    @staticmethod
+    def normalize_username(username):
+        """Usernames are looked up case insensitively, ignoring surrounding whitespace"""
+        return username.strip().lower()
+
+    @classmethod
+    def employees(cls, restaurant_id=None, name=None, role=None):
+        """Query users in the employee group, by name, with their roles and groups loaded up front
+
+        Optionally only restaurant_id's employees, names containing name (ignoring case)
+        and employees with the role named role
+        """
+        query = (cls.query
+                 .join(UserGroup, UserGroup.c.user_id == cls.id)
+                 .join(Group, Group.id == UserGroup.c.group_id)
+                 .filter(Group.name == 'employee')
+                 .options(db.selectinload(cls.roles), db.selectinload(cls.groups)))
+
+        if restaurant_id is not None:
+            query = query.filter(cls.restaurant_id == restaurant_id)
+        if name:
+            query = query.filter(cls.name.ilike(f'%{name}%'))
+        if role:
+            query = query.filter(cls.roles.any(Role.name == role))
+
+        return query.order_by(cls.name, cls.id)
 
     @classmethod
     def hash_pw(cls, password):
         """Hash user's pasasword
         
-        Hashes password
+        Hashes password with bcrypt on the password hashing pool, see models/passwords.py
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password)
-        hashed_UTF8 = hashed_pwd.decode('utf-8')
+        return hash_password(password)
 
-        return hashed_UTF8
+    @classmethod
+    def by_username(cls, username):
+        """Query the user logging in as username
+
+        NOT temp lets the partial unique index on username_normalized answer it
+        """
+        return cls.query.filter(cls.username_normalized == cls.normalize_username(username), cls.temp == False)
 
     @classmethod
     def Authenticate(cls, username, password):
-        """authenticate user, return user object if all good"""
-        user = User.query.filter(User.uname==username).first()
-        
-        if user and bcrypt.check_password_hash(user.password, password):
-            return user
+        """authenticate user, return user object if all good
+
+        Passwords hashed with a different cost than BCRYPT_LOG_ROUNDS are rehashed
+        with the current one, as the plain password is only known here
+        """
+        user = User.by_username(username).first()
         
-        return None
+        if not (user and user.password and check_password(user.password, password)):
+            return None
+
+        if needs_rehash(user.password):
+            user.password = hash_password(password)
+            try:
+                db.session.commit()
+            except SQLAlchemyError as e:
+                # the old hash still works, try again next login
+                db.session.rollback()
+                print(e)
+
+        return user
     
     @classmethod
     def register_employee(cls, employee_data):
@@ -126,26 +187,42 @@ class User(db.Model, UserMixin):
         group = Group.query.filter_by(name='employee').first()
         new_employee.groups.append(group)
 
-        # need to set employee username, which relies on the User instanc having an id
         try:
             db.session.commit()
-            new_employee.username
-            db.session.commit()
         except SQLAlchemyError as e:
             db.session.rollback()
             print(e)
             return None
 
+        # imported here since user_cache imports this module
+        from models.user_cache import invalidate_principal
+        invalidate_principal(new_employee.id)
+
         return new_employee
     
     @classmethod
     def register_customer(cls, customer_data):
-        """Register customer, currently only instantiates temporary customers"""
+        """Register customer, currently only instantiates temporary customers
+
+        A returning customer, with the phone number of an earlier one, reuses their row
+        """
         name = customer_data["contact_info"]['name']
         phone_number = customer_data["contact_info"]['phone_number']
 
-        customer = User(name=name, phone_number=phone_number, temp=True, 
-        groups=[Group.query.filter_by(name='customer').first()])
+        customer = None
+        if phone_number:
+            # skip a customer being purged right now, they're created again instead
+            customer = (User.query
+                        .filter(User.temp, User.phone_number == phone_number)
+                        .order_by(User.last_seen_at.desc())
+                        .with_for_update(skip_locked=True)
+                        .first())
+        if customer is None:
+            customer = User(phone_number=phone_number, temp=True,
+            groups=[Group.query.filter_by(name='customer').first()])
+
+        customer.name = name
+        customer.last_seen_at = db.func.localtimestamp()
 
         # try-except adding address info, to handle takeouts that wouldn't have address
         try: 
@@ -175,9 +252,92 @@ class User(db.Model, UserMixin):
                 
             User.query.filter_by(id=user_id).delete()
             db.session.commit()
+            # imported here since user_cache imports this module
+            from models.user_cache import invalidate_principal
+            invalidate_principal(user_id)
             print(f"User {user_id} deleted")
             return True
         except SQLAlchemy as e:
             db.session.rollback()
             print(e)
             raise None
+
+    @classmethod
+    def backfill_usernames(cls, batch_size=1000):
+        """Assign uname and username_normalized to existing users, batch_size rows per transaction
+
+        Temporary customers' usernames are cleared instead. Walks users by id, so each batch is a short transaction and new users, which
+        the trigger already covers, don't hold it up. Yields the number of rows of each batch
+        """
+        after = 0
+        while True:
+            batch = db.select([cls.id]).where(cls.id > after).order_by(cls.id).limit(batch_size)
+            # setting uname fires the trigger, which fills in the blanks
+            ids = [row.id for row in db.session.execute(cls.__table__.update()
+                                                        .where(cls.id.in_(batch))
+                                                        .values(uname=cls.uname)
+                                                        .returning(cls.id))]
+            db.session.commit()
+            if not ids:
+                return
+
+            after = max(ids)
+            yield len(ids)
+
+    @classmethod
+    def purge_temp_customers(cls, older_than, batch_size=1000):
+        """Delete temporary customers not seen for older_than (a timedelta), with their order links
+
+        Deletes batch_size customers per transaction, so locks are short and the table
+        stays usable meanwhile. Yields the number of customers deleted in each batch
+        """
+        cutoff = db.func.localtimestamp() - older_than
+        after = datetime.min
+        while True:
+            # walks the index from where the last batch stopped, rather than over the rows it deleted.
+            # Customers returning right now are locked by register_customer(), leave them
+            rows = (db.session.query(cls.id, cls.last_seen_at)
+                    .filter(cls.temp, cls.last_seen_at >= after, cls.last_seen_at < cutoff)
+                    .order_by(cls.last_seen_at)
+                    .limit(batch_size)
+                    .with_for_update(skip_locked=True)
+                    .all())
+            if not rows:
+                db.session.commit()
+                return
+
+            after = rows[-1].last_seen_at
+            # one array parameter, which is much cheaper to build and send than IN with batch_size of them
+            ids = db.any_(db.bindparam('ids', [row.id for row in rows], type_=ARRAY(db.Integer)))
+
+            # delete the links in one statement each, rather than row by row through the cascades
+            db.session.execute(CustomerOrder.__table__.delete().where(CustomerOrder.customer_id == ids))
+            db.session.execute(UserGroup.delete().where(UserGroup.c.user_id == ids))
+            db.session.execute(cls.__table__.delete().where(cls.id == ids))
+            db.session.commit()
+            yield len(rows)
+
+############ Username assignment ############
+# Fills in uname as name without spaces plus id when it's not given, which needs the
+# id from the insert, and keeps username_normalized, the lowercased uname logins look up
+USERNAME_TRIGGER_DDL = """
+    CREATE OR REPLACE FUNCTION users_assign_username() RETURNS trigger AS $$
+    BEGIN
+        -- takeout and delivery customers don't log in, so they get no username
+        -- that could take one an employee picks later
+        IF NEW.temp THEN
+            NEW.uname := NULL;
+        ELSIF NEW.uname IS NULL THEN
+            NEW.uname := replace(NEW.name, ' ', '') || NEW.id;
+        END IF;
+        NEW.username_normalized := lower(btrim(NEW.uname));
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS users_assign_username ON users;
+    CREATE TRIGGER users_assign_username BEFORE INSERT OR UPDATE OF uname, temp ON users
+        FOR EACH ROW EXECUTE FUNCTION users_assign_username();
+"""
+
+event.listen(User.__table__, 'after_create', DDL(USERNAME_TRIGGER_DDL))
@@ -3,6 +3,7 @@ from models.db import db
 from models.item_models import MenuItem, Intolerant, Ingredient
 from models.order_models import OrderedItems, Order
 from models.restaurant_models import Table, Restaurant
+from models.passwords import hash_passwords
 from datetime import datetime, timedelta
 from app import app
 
@@ -32,8 +33,11 @@ with app.app_context():
     db.session.add_all(restaurants)
     db.session.commit()
 
+    # hashed together, spread over the password hashing pool
+    manager_pw, ken_pw, barbara_pw, glenn_pw = hash_passwords(['123test123', 'TemporaryPW', 'TemporaryPW2', 'TemporaryPW3'])
+
     employees = [
-        User(restaurant_id=1, name='test', uname='testmanager', password=User.hash_pw('123test123'), address='123 Test St.', birthday='1/1/1990',
+        User(restaurant_id=1, name='test', uname='testmanager', password=manager_pw, address='123 Test St.', birthday='1/1/1990',
              roles=[Role.query.filter_by(name='manager').first()], 
              groups=[Group.query.filter_by(name='employee').first()]),
     ]
@@ -42,9 +46,9 @@ with app.app_context():
     db.session.commit()
 
     customers = [
-        User(name='Ken', address='1 Main St', phone_number='123-456-0000', password=User.hash_pw('TemporaryPW'), birthday='1/1/1970', groups=[Group.query.filter_by(name='customer').first()]),
-        User(name='Barbara', address='1 Main St', phone_number='123-654-0000', password=User.hash_pw('TemporaryPW2'), birthday='8/1/1978', groups=[Group.query.filter_by(name='customer').first()]),
-        User(name='Glenn', address='54 Main St', phone_number='123-456-7890', password=User.hash_pw('TemporaryPW3'), birthday='1/1/1999', groups=[Group.query.filter_by(name='customer').first()])
+        User(name='Ken', address='1 Main St', phone_number='123-456-0000', password=ken_pw, birthday='1/1/1970', groups=[Group.query.filter_by(name='customer').first()]),
+        User(name='Barbara', address='1 Main St', phone_number='123-654-0000', password=barbara_pw, birthday='8/1/1978', groups=[Group.query.filter_by(name='customer').first()]),
+        User(name='Glenn', address='54 Main St', phone_number='123-456-7890', password=glenn_pw, birthday='1/1/1999', groups=[Group.query.filter_by(name='customer').first()])
     ]
 
     db.session.add_all(customers)
@@ -105,27 +109,27 @@ with app.app_context():
     db.session.commit()
 
     tables = [
-        Table(),
-        Table(),
-        Table(),
-        Table(),
-        Table(),
-        Table(),
+        Table(restaurant_id=1),
+        Table(restaurant_id=1),
+        Table(restaurant_id=1),
+        Table(restaurant_id=1),
+        Table(restaurant_id=1),
+        Table(restaurant_id=1),
     ]
 
     db.session.add_all(tables)
     db.session.commit()
 
     orders = [  
-        Order(employee_id=1, type='Takeout', timestamp=datetime.now() - timedelta(minutes=30)),
-        Order(employee_id=1, type='Delivery', timestamp=datetime.now() - timedelta(minutes=15)),
-        Order(employee_id=3, type='Takeout', timestamp=datetime.now() - timedelta(minutes=5)),
-        Order(employee_id=2, type='Dining In', active=False, table_number=2),
-        Order(employee_id=2, type='Dining In', active=False, table_number=2),
-        Order(employee_id=2, type='Dining In', active=False, table_number=2),
-        Order(employee_id=2, type='Dining In', table_number=2),
-        Order(employee_id=2, type='Dining In', table_number=5),
-        Order(employee_id=2, type='Dining In', table_number=3),
+        Order(restaurant_id=1, employee_id=1, type='Takeout', timestamp=datetime.now() - timedelta(minutes=30)),
+        Order(restaurant_id=1, employee_id=1, type='Delivery', timestamp=datetime.now() - timedelta(minutes=15)),
+        Order(restaurant_id=1, employee_id=3, type='Takeout', timestamp=datetime.now() - timedelta(minutes=5)),
+        Order(restaurant_id=1, employee_id=2, type='Dining In', active=False, table_number=2),
+        Order(restaurant_id=1, employee_id=2, type='Dining In', active=False, table_number=2),
+        Order(restaurant_id=1, employee_id=2, type='Dining In', active=False, table_number=2),
+        Order(restaurant_id=1, employee_id=2, type='Dining In', table_number=2),
+        Order(restaurant_id=1, employee_id=2, type='Dining In', table_number=5),
+        Order(restaurant_id=1, employee_id=2, type='Dining In', table_number=3),
     ]
 
     db.session.add_all(orders)
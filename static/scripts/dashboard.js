@@ -12,7 +12,50 @@ async function toggleOrder(id, state){
             "active": state
         }
     });
-    location.reload();
+    // with an event stream the order_closed/order_updated event moves the card
+    if(!window.EventSource){
+        location.reload();
+    }
+}
+
+/** Replace an order's card with a freshly rendered one, in the active or history area */
+async function refreshOrderCard(id){
+    let res = await axios.get(`/employees/dashboard/orders/${id}`);
+    let $card = $(res.data);
+
+    $(`#order-card-${id}`).remove();
+    if($card.find('.order-active').length > 0){
+        $('#active-orders').prepend($card);
+    } else{
+        $('#past-orders').prepend($card);
+    }
+    $card.find('[data-bs-toggle="tooltip"]').each((i, el) => new bootstrap.Tooltip(el));
+}
+
+/** Listen for order events so the dashboard updates without reloading */
+if(window.EventSource){
+    const orderEvents = new EventSource('/employees/dashboard/events');
+    const eventTypes = ['order_created', 'order_updated', 'order_closed', 'need_assistance', 'items_added'];
+    for(let type of eventTypes){
+        orderEvents.addEventListener(type, (evt) => {
+            refreshOrderCard(JSON.parse(evt.data).order_id);
+        });
+    }
+
+    // events sent while the stream was down are lost, so every reconnect reloads the cards
+    let opened = false;
+    orderEvents.addEventListener('open', () => {
+        if(opened){
+            location.reload();
+        }
+        opened = true;
+    });
+    // the browser gives up on a stream that answered with an error, eg. after logging out
+    orderEvents.addEventListener('error', () => {
+        if(orderEvents.readyState == EventSource.CLOSED){
+            setTimeout(() => location.reload(), 3000);
+        }
+    });
 }
 
 async function toggleAssistance(id) {
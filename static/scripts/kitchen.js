@@ -0,0 +1,53 @@
+const $tickets = $('#tickets');
+const POLL_INTERVAL = 1000;
+
+// cursor from the last response; the first request has none and gets every active order
+let cursor = null;
+
+/** Build the element for one ticket
+ *
+ * Menu item names are typed in by employees, so ticket fields go in as text, never as html
+ */
+function ticketElement(ticket){
+    let $items = $('<ul class="list-group list-group-flush">');
+    for(let item of ticket.items){
+        $items.append($('<li class="list-group-item">').text(`${item.name} x${item.qty}`));
+    }
+    let where = ticket.type == 'Dining In' ? `Table ${ticket.table_number}` : ticket.type;
+
+    let $title = $('<h5>').text(`Order #${ticket.id} `);
+    if(ticket.need_assistance){
+        $title.append('<i class="fa-solid fa-lightbulb text-warning"></i>');
+    }
+    let $header = $('<div class="card-header bg-success text-center text-white">').append($title, $('<h6>').text(where));
+
+    return $('<div class="col-auto">').attr('id', `ticket-${ticket.id}`).append(
+        $('<div class="card my-2" style="width: 15rem;">').append($header, $items));
+}
+
+/** Add, replace or remove tickets for the orders in a feed response */
+function applyTickets(tickets){
+    for(let ticket of tickets){
+        let $existing = $(`#ticket-${ticket.id}`);
+        if(!ticket.active){
+            $existing.remove();
+        } else if($existing.length > 0){
+            $existing.replaceWith(ticketElement(ticket));
+        } else{
+            $tickets.append(ticketElement(ticket));
+        }
+    }
+}
+
+async function poll(){
+    try{
+        let res = await axios.get('/omakase/api/kitchen/tickets', {params: cursor ? {since: cursor} : {}});
+        applyTickets(res.data.data);
+        cursor = res.data.cursor;
+    } catch(err){
+        console.log(err);
+    }
+    setTimeout(poll, POLL_INTERVAL);
+}
+
+poll();
@@ -59,6 +59,10 @@ class MenuItem {
     }
     async putMenuItem(id, qty=1){
         let details = await this.getMenuItem(id);
+        this.renderBillItem(details, qty);
+    }
+    renderBillItem(details, qty=1){
+        // details needs the menu item's id, name and cost
         // Check if item already ordered; increment qty if so
         if($(`#${details.id}-qty`).length >= 1){
             let itemQty = parseInt($(`#${details.id}-qty`)[0].innerText);
@@ -90,7 +94,8 @@ class Order {
         this.id = id;
     }
     async getOrderedItems(){
-        let res = await axios.get(`${this.baseURL}/${this.id}`);
+        // expand=items includes each item's name and cost, so the bill needs no more requests
+        let res = await axios.get(`${this.baseURL}/${this.id}`, {params: {expand: 'items'}});
         // console.log(res.data.data.ordered_items);
         return res.data.data.ordered_items;
     }
@@ -109,8 +114,7 @@ class Order {
         let orderedItems = await this.getOrderedItems();
         let m = new MenuItem;
         for(let item of orderedItems){
-            await m.putMenuItem(item.item_id, item.qty);
-            
+            m.renderBillItem({id: item.item_id, name: item.name, cost: item.cost}, item.qty);
         }
         // Really should refactor this, it's in a weird place
         let $costs = $('.cost');
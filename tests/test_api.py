@@ -7,11 +7,15 @@
 #   python -m unittest tests.test_routes.BasicRoutesTestCase
 
 import os
-from models.db import db
+import json
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from models.db import db, QueryCounter
 from models.user_models import Role, Group, User
 from models.restaurant_models import Restaurant
-from models.order_models import Table, Order
+from models.order_models import Table, Order, OrderedItems
 from models.item_models import Ingredient, Intolerant, MenuItem
+from models.menu_cache import clear_menu_cache
 from flask import get_flashed_messages, session
 from flask_login import login_user, logout_user
 from sqlalchemy.exc import SQLAlchemyError
@@ -20,9 +24,12 @@ from unittest import TestCase
 
 # Before importing app, set environmental variable to use a test db for tests
 os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
 
 # Now import app
 from app import app
+# tests use models outside of requests, which needs an app context
+app.app_context().push()
 app.config['WTF_CSRF_ENABLED'] = False
 
 # Make Flask errors be real errors, not HTML pages with error info
@@ -113,6 +120,106 @@ class ApiTestCase(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn('timestamp', html)
 
+    def test_get_all_orders_query_count(self):
+        """Orders and their ordered items load in a fixed number of queries, however many orders there are"""
+        orders = [Order(type='Takeout', ordered_items=[OrderedItems(menu_item_id=self.testItem.id, quantity=2)]) for _ in range(5)]
+        db.session.add_all(orders)
+        db.session.commit()
+        order_ids = [o.id for o in orders]
+
+        with QueryCounter() as counter:
+            resp = self.client.get('/omakase/api/orders')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertLessEqual(counter.count, 2)
+
+        data = {o['id']: o for o in resp.json['data']}
+        for id in order_ids:
+            self.assertEqual(data[id]['ordered_items'], [{'item_id': self.testItem.id, 'qty': 2}])
+
+    def test_get_orders_keyset_pagination(self):
+        """Pages follow next_cursor newest first, without repeating or skipping orders"""
+        orders = [Order(type='Delivery', table_number=self.tables[1].id) for _ in range(5)]
+        db.session.add_all(orders)
+        db.session.commit()
+        order_ids = [o.id for o in orders]
+
+        seen = []
+        cursor = ''
+        while True:
+            resp = self.client.get(f'/omakase/api/orders?type=Delivery&table_number={self.tables[1].id}&limit=2&cursor={cursor}')
+            self.assertEqual(resp.status_code, 200)
+            seen += [o['id'] for o in resp.json['data']]
+            cursor = resp.json['next_cursor']
+            if not cursor:
+                break
+
+        self.assertEqual(seen, list(reversed(order_ids)))
+
+    def test_get_orders_filters(self):
+        """Are orders filtered by active status and time window?"""
+        resp = self.client.get('/omakase/api/orders?active=false')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(all(not o['active'] for o in resp.json['data']))
+
+        resp = self.client.get('/omakase/api/orders?since=2999-01-01T00:00:00')
+        self.assertEqual(resp.json['data'], [])
+        self.assertIsNone(resp.json['next_cursor'])
+
+    def test_get_orders_session_restaurant(self):
+        """Are orders limited to the session's restaurant when no restaurant_id is given?"""
+        ours = Order(type='Takeout', restaurant_id=self.test_restaurant.id)
+        theirs = Order(type='Takeout')
+        db.session.add_all([ours, theirs])
+        db.session.commit()
+        ours_id, theirs_id = ours.id, theirs.id
+
+        with self.client.session_transaction() as sess:
+            sess['restaurant_id'] = self.test_restaurant.id
+        ids = [o['id'] for o in self.client.get('/omakase/api/orders?type=Takeout').json['data']]
+        exported = [json.loads(line)['id'] for line in self.client.get('/omakase/api/orders/export?type=Takeout').get_data(as_text=True).splitlines()]
+
+        self.assertIn(ours_id, ids)
+        self.assertNotIn(theirs_id, ids)
+        self.assertIn(ours_id, exported)
+        self.assertNotIn(theirs_id, exported)
+
+        Order.query.filter(Order.id.in_([ours_id, theirs_id])).delete(synchronize_session=False)
+        db.session.commit()
+
+    def test_get_orders_bad_args(self):
+        """Malformed filters or cursors are a 400, not a 500"""
+        self.assertEqual(self.client.get('/omakase/api/orders?active=maybe').status_code, 400)
+        self.assertEqual(self.client.get('/omakase/api/orders?since=yesterday').status_code, 400)
+        self.assertEqual(self.client.get('/omakase/api/orders?cursor=garbage').status_code, 400)
+
+    def test_export_orders_ndjson(self):
+        """Does the export stream one JSON order per line, with items and totals?"""
+        order = Order(type='Delivery', ordered_items=[OrderedItems(menu_item_id=self.testItem.id, quantity=2)])
+        db.session.add(order)
+        db.session.commit()
+        order_id = order.id
+
+        resp = self.client.get('/omakase/api/orders/export?type=Delivery')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+
+        exported = {o['id']: o for o in map(json.loads, resp.get_data(as_text=True).splitlines())}
+        self.assertEqual(exported[order_id]['total_cost'], '24.90')
+        self.assertEqual(exported[order_id]['ordered_items'][0]['name'], 'test item')
+        self.assertTrue(all(o['type'] == 'Delivery' for o in exported.values()))
+
+    def test_export_orders_csv(self):
+        """Does the CSV export write a header and a row per ordered item?"""
+        resp = self.client.get('/omakase/api/orders/export?format=csv')
+        lines = resp.get_data(as_text=True).splitlines()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(lines[0].startswith('order_id,timestamp,type'))
+        self.assertIn(f'{self.test_order.id},', '\n'.join(lines[1:]))
+
+        self.assertEqual(self.client.get('/omakase/api/orders/export?format=xml').status_code, 400)
+
     def test_get_order_by_id(self):
         resp = self.client.get('/omakase/api/order/1')
         html = resp.get_data(as_text=True)
@@ -131,6 +238,16 @@ class ApiTestCase(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn('timestamp', html)   
 
+    def test_post_new_order_session_restaurant(self):
+        """Is a new order given the session's restaurant when none is sent?"""
+        with self.client.session_transaction() as sess:
+            sess['restaurant_id'] = self.test_restaurant.id
+        resp = self.client.post('/omakase/api/order', json={'type': 'Takeout'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Order.query.get(resp.json['data']['id']).restaurant_id, self.test_restaurant.id)
+        self.assertEqual(self.client.post('/omakase/api/order', json=['Takeout']).status_code, 400)
+
     def test_post_new_order_sqlalchemy_error(self):
         resp = self.client.post('/omakase/api/order', 
                                 json={
@@ -168,6 +285,54 @@ class ApiTestCase(TestCase):
         self.assertEqual(len(self.test_order.ordered_items), 1)
         self.assertIn('ordered_items', html)
 
+    def test_patch_add_items_with_quantity(self):
+        """Are a list of items and quantities added in one call, summing repeats?"""
+        order = Order(type='Takeout')
+        db.session.add(order)
+        db.session.commit()
+
+        resp = self.client.patch(f'/omakase/api/order/{order.id}/add_item',
+                                json={'items': [{'menu_item_id': self.testItem.id, 'quantity': 2},
+                                                {'menu_item_id': self.testItem.id}]})
+        resp = self.client.patch(f'/omakase/api/order/{order.id}/add_item',
+                                json={'menu_item_id': self.testItem.id, 'quantity': 4})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['updated_order']['ordered_items'], [{'item_id': self.testItem.id, 'qty': 7}])
+
+    def test_patch_add_item_bad_requests(self):
+        resp = self.client.patch(f'/omakase/api/order/{self.test_order.id}/add_item', json={'menu_item_id': self.testItem.id, 'quantity': 0})
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.patch('/omakase/api/order/99999/add_item', json={'menu_item_id': self.testItem.id})
+        self.assertEqual(resp.status_code, 404)
+
+        # bodies that aren't a JSON object, or items that aren't a list
+        url = f'/omakase/api/order/{self.test_order.id}/add_item'
+        self.assertEqual(self.client.patch(url, json=[{'menu_item_id': self.testItem.id}]).status_code, 400)
+        self.assertEqual(self.client.patch(url, data='not json', content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.patch(url, json={'items': {'menu_item_id': self.testItem.id}}).status_code, 400)
+        self.assertEqual(self.client.patch(url, json={'items': ['3']}).status_code, 400)
+
+    def test_patch_add_item_concurrently(self):
+        """Do hundreds of parallel adds to one order all count?"""
+        order = Order(type='Dining In')
+        db.session.add(order)
+        db.session.commit()
+        order_id = order.id
+        item_id = self.testItem.id
+
+        def add(_):
+            return app.test_client().patch(f'/omakase/api/order/{order_id}/add_item',
+                                           json={'menu_item_id': item_id}).status_code
+
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            statuses = list(pool.map(add, range(300)))
+
+        self.assertEqual(set(statuses), {202})
+        quantity = db.session.query(OrderedItems.quantity).filter_by(order_id=order_id, menu_item_id=item_id).scalar()
+        self.assertEqual(quantity, 300)
+
     def test_get_menu_item(self):
         resp = self.client.get(f'omakase/api/menu/{self.testItem.id}')
         html = resp.get_data(as_text=True)
@@ -175,9 +340,206 @@ class ApiTestCase(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn('"name": "test item"', html)
     
+    def test_get_menu_items_batch(self):
+        """Are several menu items returned from one request?"""
+        resp = self.client.get(f'/omakase/api/menu?ids={self.testItem.id},99999')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([i['id'] for i in resp.json['data']], [self.testItem.id])
+        self.assertEqual(resp.json['data'][0]['Ingredients'], ['Test Ingredient'])
+
+        self.assertEqual(self.client.get('/omakase/api/menu?ids=1,a').status_code, 400)
+        self.assertEqual(self.client.get('/omakase/api/menu').status_code, 400)
+
+    def test_get_order_expanded_items(self):
+        """Does ?expand=items include each ordered item's name and cost?"""
+        order = Order(type='Takeout', ordered_items=[OrderedItems(menu_item_id=self.testItem.id, quantity=3)])
+        db.session.add(order)
+        db.session.commit()
+
+        resp = self.client.get(f'/omakase/api/order/{order.id}?expand=items')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['data']['ordered_items'],
+                         [{'item_id': self.testItem.id, 'qty': 3, 'name': 'test item', 'cost': '9.95'}])
+
+    def test_menu_conditional_get(self):
+        """Is a repeated menu request answered from cache, and with 304 when the ETag matches?"""
+        clear_menu_cache()
+        first = self.client.get(f'/omakase/api/menu/{self.testItem.id}')
+        etag = first.headers['ETag']
+
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('public', first.headers['Cache-Control'])
+        self.assertIn('max-age', first.headers['Cache-Control'])
+
+        with QueryCounter() as counter:
+            second = self.client.get(f'/omakase/api/menu/{self.testItem.id}')
+            not_modified = self.client.get(f'/omakase/api/menu/{self.testItem.id}', headers={'If-None-Match': etag})
+
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(second.get_data(), first.get_data())
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.headers['ETag'], etag)
+
+    def test_menu_etag_changes_with_menu(self):
+        """Does changing a menu item give the list a new ETag?"""
+        etag = self.client.get('/omakase/api/menu/list_menu_items').headers['ETag']
+
+        self.testItem.in_stock = False
+        db.session.commit()
+        resp = self.client.get('/omakase/api/menu/list_menu_items', headers={'If-None-Match': etag})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertFalse(resp.json['data'][0]['in_stock'])
+
+        self.testItem.in_stock = True
+        db.session.commit()
+
     def test_list_menu_items(self):
         resp = self.client.get('/omakase/api/menu/list_menu_items')
         html = resp.get_data(as_text=True)
 
         self.assertEqual(resp.status_code, 200)
-        self.assertIn('"name": "test item"', html)
\ No newline at end of file
+        self.assertIn('"name": "test item"', html)
+
+    def test_kitchen_tickets_initial_load(self):
+        """Does the first kitchen feed poll return only active orders, with item names?"""
+        active = Order(type='Dining In', table_number=self.tables[0].id,
+                       ordered_items=[OrderedItems(menu_item_id=self.testItem.id, quantity=3)])
+        closed = Order(type='Takeout', active=False)
+        db.session.add_all([active, closed])
+        db.session.commit()
+
+        resp = self.client.get('/omakase/api/kitchen/tickets')
+        tickets = {t['id']: t for t in resp.json['data']}
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('cursor', resp.json)
+        self.assertNotIn(closed.id, tickets)
+        self.assertEqual(tickets[active.id]['items'], [{'name': 'test item', 'qty': 3}])
+
+    def test_kitchen_tickets_since_cursor(self):
+        """Does polling with a cursor return only orders changed since, closed ones included?"""
+        untouched, closing, adding = Order(type='Takeout'), Order(type='Takeout'), Order(type='Takeout')
+        db.session.add_all([untouched, closing, adding])
+        db.session.commit()
+        # age every order past the feed's overlap window
+        db.session.execute(Order.__table__.update().values(updated_at=datetime.now() - timedelta(minutes=1)))
+        db.session.commit()
+        cursor = self.client.get('/omakase/api/kitchen/tickets').json['cursor']
+
+        closing.close()
+        OrderedItems.add_items(adding.id, {self.testItem.id: 2})
+
+        resp = self.client.get('/omakase/api/kitchen/tickets', query_string={'since': cursor})
+        tickets = {t['id']: t for t in resp.json['data']}
+
+        self.assertEqual(set(tickets), {closing.id, adding.id})
+        self.assertFalse(tickets[closing.id]['active'])
+        self.assertEqual(tickets[adding.id]['items'], [{'name': 'test item', 'qty': 2}])
+
+    def test_kitchen_tickets_bad_cursor(self):
+        resp = self.client.get('/omakase/api/kitchen/tickets', query_string={'since': 'yesterday'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_import_menu_items(self):
+        """Can a manager import many menu items in one request?"""
+        manager = User(name='test owner', uname='testM1', password=User.hash_pw('123test123'), email='m@gmail.com',
+                       phone_number='123-456-7890', restaurant_id=self.test_restaurant.id,
+                       roles=[Role.query.filter_by(name='manager').first()],
+                       groups=[Group.query.filter_by(name='employee').first()])
+        db.session.add(manager)
+        db.session.commit()
+
+        items = [{'name': f'import {i}', 'meal_type': 'dessert', 'cost': 4, 'ingredients': ['Sugar']} for i in range(50)]
+
+        with app.test_request_context('/omakase/api/menu/import'):
+            login_user(manager)
+            resp = self.client.post('/omakase/api/menu/import', json={'items': items})
+            bad = self.client.post('/omakase/api/menu/import', json={'items': [{'name': 'no cost', 'meal_type': 'dessert'}]})
+            logout_user()
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(len(resp.json['data']), 50)
+        self.assertEqual(MenuItem.query.get(resp.json['data'][0]).restaurants, [self.test_restaurant])
+        self.assertEqual(bad.status_code, 400)
+
+        MenuItem.query.filter(MenuItem.id.in_(resp.json['data'])).delete(synchronize_session=False)
+        db.session.delete(manager)
+        db.session.commit()
+
+    def test_import_menu_items_unauthorized(self):
+        resp = self.client.post('/omakase/api/menu/import', json={'items': [{'name': 'x', 'meal_type': 'x', 'cost': 1}]})
+        self.assertEqual(resp.status_code, 401)
+
+    def test_list_menu_items_filters(self):
+        """Are items with excluded intolerants, non vegetarian or out of stock items left out in SQL?"""
+        salad = MenuItem(name='test salad', meal_type='appetizer', cost=6, vegetarian=True, intolerants=[self.intolerants[1]])
+        sorbet = MenuItem(name='test sorbet', meal_type='dessert', cost=4, vegetarian=True)
+        stew = MenuItem(name='test stew', meal_type='entree', cost=12, in_stock=False)
+        db.session.add_all([salad, sorbet, stew])
+        db.session.commit()
+        ids = {'test item': self.testItem.id, 'test salad': salad.id, 'test sorbet': sorbet.id, 'test stew': stew.id}
+
+        def names(query_string):
+            resp = self.client.get('/omakase/api/menu/list_menu_items', query_string=query_string)
+            self.assertEqual(resp.status_code, 200)
+            return [item['name'] for item in resp.json['data'] if item['name'] in ids]
+
+        with QueryCounter() as counter:
+            self.assertEqual(names({'exclude_intolerants': 'dairy'}), ['test salad', 'test sorbet', 'test stew'])
+        self.assertLessEqual(counter.count, 3)
+
+        self.assertEqual(names({'exclude_intolerants': 'Dairy,Wheat'}), ['test sorbet', 'test stew'])
+        self.assertEqual(names({'vegetarian': 'true'}), ['test salad', 'test sorbet'])
+        self.assertEqual(names({'in_stock': 'false'}), ['test stew'])
+        self.assertEqual(names({'exclude_intolerants': 'Wheat', 'vegetarian': 'true', 'in_stock': 'true'}), ['test sorbet'])
+
+        resp = self.client.get('/omakase/api/menu/list_menu_items', query_string={'vegetarian': 'maybe'})
+        self.assertEqual(resp.status_code, 400)
+
+        MenuItem.query.filter(MenuItem.id.in_([salad.id, sorbet.id, stew.id])).delete(synchronize_session=False)
+        db.session.commit()
+
+    def test_search_menu_items(self):
+        """Are items found by word prefixes of their name, ingredients or description, name matches first?"""
+        pasta = MenuItem(name='Spaghetti Carbonara', meal_type='entree', cost=14, description='Roman classic')
+        bake = MenuItem(name='Baked Ziti', meal_type='entree', cost=12, description='With spaghetti squash on the side')
+        db.session.add_all([pasta, bake])
+        db.session.commit()
+        MenuItem.add_ingredients(['Guanciale', 'Pecorino'], pasta.id)
+
+        def names(q):
+            resp = self.client.get('/omakase/api/menu/search', query_string={'q': q})
+            self.assertEqual(resp.status_code, 200)
+            return [item['name'] for item in resp.json['data']]
+
+        self.assertEqual(names('spag'), ['Spaghetti Carbonara', 'Baked Ziti'])
+        self.assertEqual(names('guanc'), ['Spaghetti Carbonara'])
+        self.assertEqual(names('spaghetti pecor'), ['Spaghetti Carbonara'])
+        self.assertEqual(names("roman & (!"), ['Spaghetti Carbonara'])
+        self.assertEqual(names('lasagna'), [])
+
+        # renaming an item updates its search text
+        pasta.name = 'Penne Carbonara'
+        db.session.commit()
+        self.assertEqual(names('penne'), ['Penne Carbonara'])
+
+        resp = self.client.get('/omakase/api/menu/search', query_string={'q': ' '})
+        self.assertEqual(resp.status_code, 400)
+
+        MenuItem.query.filter(MenuItem.id.in_([pasta.id, bake.id])).delete(synchronize_session=False)
+        db.session.commit()
+
+class ExportCommandTestCase(TestCase):
+    """CLI commands run in their own app context, which removes the db session on teardown,
+    so they're kept apart from test cases holding on to model instances"""
+
+    def test_export_orders_cli(self):
+        """Does `flask orders export` write the CSV export?"""
+        result = app.test_cli_runner().invoke(args=['orders', 'export', '--format', 'csv'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(result.output.startswith('order_id,timestamp,type'))
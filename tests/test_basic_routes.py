@@ -13,6 +13,7 @@ from unittest import TestCase
 
 # Before importing app, set environmental variable to use a test db for tests
 os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
 
 # import models
 from models.db import db
@@ -22,7 +23,9 @@ from models.order_models import Table, Order
 from models.item_models import Ingredient, Intolerant
 
 # Now import app
-from app import app
+from app import app, create_app
+# tests use models outside of requests, which needs an app context
+app.app_context().push()
 app.config['WTF_CSRF_ENABLED'] = False
 
 # Make Flask errors be real errors, not HTML pages with error info
@@ -44,8 +47,8 @@ class BasicRoutesTestCase(TestCase):
         cls.test_restaurant = Restaurant(name='test restaurant', address='1 Test St.')
 
         cls.tables = [
-            Table(),
-            Table(),
+            Table(restaurant=cls.test_restaurant),
+            Table(restaurant=cls.test_restaurant),
         ]
 
         cls.roles = [
@@ -175,3 +178,30 @@ class BasicRoutesTestCase(TestCase):
             curr_table = Table.query.filter_by(id=session['curr_table_num']).first()
             self.assertIsInstance(curr_table, Table)
             self.assertTrue(curr_table.taken)
+
+class AppFactoryTestCase(TestCase):
+    """Test the production, development and testing configurations"""
+
+    def tearDown(self):
+        # creating an app connects db to it, so point db back at the test app
+        db.app = app
+
+    def test_production_has_no_debug_toolbar(self):
+        """Does production leave out the DebugToolbar and debug mode?"""
+        prod = create_app('production')
+
+        self.assertFalse(prod.debug)
+        self.assertNotIn('_debug_toolbar.static', prod.view_functions)
+
+    def test_development_has_debug_toolbar(self):
+        """Does development run in debug mode with the DebugToolbar?"""
+        dev = create_app('development')
+
+        self.assertTrue(dev.debug)
+        self.assertIn('_debug_toolbar.static', dev.view_functions)
+
+    def test_testing_config(self):
+        """Does the testing configuration use the test database with CSRF off?"""
+        self.assertTrue(app.testing)
+        self.assertFalse(app.config['WTF_CSRF_ENABLED'])
+        self.assertTrue(app.config['SQLALCHEMY_DATABASE_URI'].endswith('omakase-test'))
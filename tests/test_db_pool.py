@@ -0,0 +1,128 @@
+"""Tests for connection pool configuration, pool metrics and query instrumentation"""
+
+# Run tests like:
+#
+#   python -m unittest tests/test_db_pool.py
+# OR
+#   python -m unittest tests.test_db_pool.DbPoolTestCase.test_engine_options_from_env
+
+import os
+from unittest import TestCase
+
+# Before importing app, set environmental variable to use a test db for tests
+
+os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
+
+# now import app
+from app import app
+# tests use models outside of requests, which needs an app context
+app.app_context().push()
+from models.db import db, engine_options, pool_metrics, query_budget, InstrumentedQueuePool, InstrumentedNullPool
+
+class DbPoolTestCase(TestCase):
+    """Test pool settings read from the environment and the pool metrics endpoint"""
+
+    def setUp(self):
+        db.session.remove()
+        pool_metrics.reset()
+        self.client = app.test_client()
+
+    def test_engine_options_from_env(self):
+        """Are DB_POOL_* variables turned into pool options, with defaults for the rest?"""
+        options = engine_options({'DB_POOL_SIZE': '20', 'DB_POOL_RECYCLE': '1800', 'DB_POOL_PRE_PING': 'true'})
+
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 10)
+        self.assertEqual(options['pool_recycle'], 1800)
+        self.assertTrue(options['pool_pre_ping'])
+
+    def test_pgbouncer_mode(self):
+        """Does DB_PGBOUNCER leave pooling to PgBouncer?"""
+        self.assertEqual(engine_options({'DB_PGBOUNCER': '1', 'DB_POOL_SIZE': '20'}), {'poolclass': InstrumentedNullPool})
+
+    def test_checkouts_counted(self):
+        """Are checkouts counted and shown on the internal endpoint?"""
+        db.session.execute('SELECT 1')
+        db.session.remove()
+
+        resp = self.client.get('/internal/db-pool')
+        data = resp.json['data']
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreaterEqual(data['checkouts'], 1)
+        self.assertEqual(data['timeouts'], 0)
+        self.assertEqual(data['size'], app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_size'])
+        self.assertIn('overflow', data)
+
+    def test_public_address_not_served(self):
+        """Is the internal endpoint hidden from public addresses?"""
+        resp = self.client.get('/internal/db-pool', environ_base={'REMOTE_ADDR': '8.8.8.8'})
+
+        self.assertEqual(resp.status_code, 404)
+
+    def test_proxied_request_not_served(self):
+        """Is a request a reverse proxy passed on refused, though it comes from a private address?"""
+        resp = self.client.get('/internal/db-pool', environ_base={'REMOTE_ADDR': '10.0.0.2'}, headers={'X-Forwarded-For': '8.8.8.8'})
+
+        self.assertEqual(resp.status_code, 404)
+
+    def test_internal_token_required(self):
+        """With INTERNAL_TOKEN set, is the bearer token required from every address?"""
+        app.config['INTERNAL_TOKEN'] = 'secret-token'
+        try:
+            self.assertEqual(self.client.get('/internal/db-pool').status_code, 404)
+            self.assertEqual(self.client.get('/internal/db-pool', headers={'Authorization': 'Bearer wrong-token'}).status_code, 404)
+
+            resp = self.client.get('/internal/db-pool', environ_base={'REMOTE_ADDR': '8.8.8.8'},
+                                   headers={'Authorization': 'Bearer secret-token', 'X-Forwarded-For': '8.8.8.8'})
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            app.config['INTERNAL_TOKEN'] = None
+
+class QueryStatsTestCase(TestCase):
+    """Test per request query counts, the slow query log and query budgets"""
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['SLOW_QUERY_MS'] = 100
+
+    def test_server_timing_counts_queries(self):
+        """Is every query a request runs counted in its Server-Timing header?"""
+        resp = self.client.get('/internal/db-pool')
+
+        self.assertEqual(resp.headers['Server-Timing'].split(';')[-1], 'desc="0 queries"')
+
+        with app.test_request_context('/'):
+            app.preprocess_request()
+            db.session.execute('SELECT 1')
+            db.session.execute('SELECT 2')
+            header = app.process_response(app.response_class()).headers['Server-Timing']
+
+        self.assertEqual(header.split(';')[-1], 'desc="2 queries"')
+
+    def test_server_timing_per_request(self):
+        """Does each request count only its own queries, while the tests' app context stays pushed?"""
+        headers = [self.client.get('/omakase/api/kitchen/tickets').headers['Server-Timing'].split(';')[-1] for _ in range(3)]
+
+        self.assertEqual(len(set(headers)), 1)
+        self.assertNotEqual(headers[0], 'desc="0 queries"')
+
+    def test_slow_query_logged_with_route(self):
+        """Are queries over SLOW_QUERY_MS logged with the route name?"""
+        app.config['SLOW_QUERY_MS'] = 0
+
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            self.client.get('/omakase/api/kitchen/tickets')
+
+        self.assertIn('in api.get_kitchen_tickets: SELECT', logs.output[0])
+
+    def test_query_budget(self):
+        """Does going over a query budget fail with the statements run?"""
+        with self.assertRaisesRegex(AssertionError, 'over the budget of 1:\nSELECT 1\nSELECT 2'):
+            with query_budget(1):
+                db.session.execute('SELECT 1')
+                db.session.execute('SELECT 2')
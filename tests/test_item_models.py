@@ -7,17 +7,22 @@
 #   python -m unittest tests.test_models.ItemModelTestCase.test_restaurant_model
 
 import os
+import json
+import tempfile
 from unittest import TestCase
 
 from decimal import Decimal
 # Before importing app, set environmental variable to use a test db for tests
 
 os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
 
 # now import app
 
 from app import app
-from models.db import db
+# tests use models outside of requests, which needs an app context
+app.app_context().push()
+from models.db import db, QueryCounter
 from models.restaurant_models import Restaurant
 from models.item_models import Ingredient, Intolerant, MenuItem
 
@@ -106,6 +111,70 @@ class MenuItemModelTestCase(TestCase):
         self.assertIsInstance(serial_mi, dict)
         self.assertEqual(serial_mi['id'], mi.id)
 
+    def test_add_ingredients_upserts_catalog(self):
+        """Are missing ingredients created and existing ones reused, in a fixed number of queries?"""
+        mi = MenuItem(name='Carbonara', meal_type='Entree', cost=14.50)
+        db.session.add(mi)
+        db.session.commit()
+        mi_id = mi.id
+
+        with QueryCounter() as counter:
+            MenuItem.add_ingredients(['Pasta', 'Guanciale', None, 'Guanciale'], mi_id)
+
+        self.assertLessEqual(counter.count, 3)
+        self.assertEqual(Ingredient.query.filter_by(name='Pasta').count(), 1)
+        self.assertEqual(sorted(i.name for i in MenuItem.query.get(mi_id).ingredients), ['Guanciale', 'Pasta'])
+
+        # adding the same ingredients again leaves the links as they are
+        MenuItem.add_ingredients(['Pasta'], mi_id)
+        self.assertEqual(len(MenuItem.query.get(mi_id).ingredients), 2)
+
+    def test_add_new_item(self):
+        """Is a new item added to the menu with its ingredients and intolerants?"""
+        mi = MenuItem.add_new_item({'name': 'Lasagna', 'meal_type': 'Entree', 'cost': 15, 'description': 'layered',
+                                    'ingredients': ['Pasta', 'Ricotta', None], 'intolerants': ['Dairy'],
+                                    'csrf_token': 'token'})
+
+        self.assertEqual(mi.restaurants, [self.r])
+        self.assertEqual(sorted(i.name for i in mi.ingredients), ['Pasta', 'Ricotta'])
+        self.assertEqual([i.name for i in mi.intolerants], ['Dairy'])
+
+    def test_add_new_item_failure_saves_nothing(self):
+        """Does a failed add leave no partial item or new ingredients behind?"""
+        mi = MenuItem.add_new_item({'name': 'Free Lunch', 'meal_type': 'Entree', 'cost': None,
+                                    'ingredients': ['Air'], 'intolerants': []})
+
+        self.assertIsNone(mi)
+        self.assertIsNone(MenuItem.query.filter_by(name='Free Lunch').first())
+        self.assertIsNone(Ingredient.query.filter_by(name='Air').first())
+
+    def test_import_items(self):
+        """Are hundreds of items imported in a fixed number of queries?"""
+        items = [{'name': f'imported {i}', 'meal_type': 'Entree', 'cost': 5 + i % 10,
+                  'ingredients': ['Pasta', f'imported ingredient {i}'], 'intolerants': ['Wheat']}
+                 for i in range(300)]
+        items[0]['vegetarian'] = True
+
+        with QueryCounter() as counter:
+            ids = MenuItem.import_items(items, self.r.id)
+
+        self.assertLessEqual(counter.count, 7)
+        self.assertEqual(len(ids), 300)
+        first = MenuItem.query.get(ids[0])
+        self.assertEqual(first.name, 'imported 0')
+        self.assertTrue(first.vegetarian)
+        self.assertTrue(first.in_stock)
+        self.assertEqual(first.restaurants, [self.r])
+        self.assertEqual(sorted(i.name for i in first.ingredients), ['Pasta', 'imported ingredient 0'])
+        self.assertEqual([i.name for i in first.intolerants], ['Wheat'])
+
+    def test_import_items_failure_saves_nothing(self):
+        ids = MenuItem.import_items([{'name': 'good', 'meal_type': 'Entree', 'cost': 5},
+                                     {'name': 'bad', 'meal_type': 'Entree', 'cost': None}], self.r.id)
+
+        self.assertIsNone(ids)
+        self.assertIsNone(MenuItem.query.filter_by(name='good').first())
+
     def test_ingredient(self):
         """Does basic ingredient model work?"""
         ingr = Ingredient(name='test ingredient 2')
@@ -121,4 +190,85 @@ class MenuItemModelTestCase(TestCase):
         db.session.commit()
 
         self.assertIsInstance(intol, Intolerant)
-    
\ No newline at end of file
+    
+class MenuCommandTestCase(TestCase):
+    """CLI commands run in their own app context, which removes the db session on teardown,
+    so they're kept apart from test cases holding on to model instances"""
+
+    def setUp(self):
+        self.runner = app.test_cli_runner(mix_stderr=False)
+        self.dir = tempfile.TemporaryDirectory()
+
+        r = Restaurant(name='CLI Restaurant', address='1 Import Way')
+        db.session.add(r)
+        db.session.commit()
+        self.r_id = r.id
+
+    def tearDown(self):
+        self.dir.cleanup()
+        MenuItem.query.filter(MenuItem.name.like('cli %')).delete(synchronize_session=False)
+        Restaurant.query.filter_by(id=self.r_id).delete()
+        db.session.commit()
+
+    def test_import_export_menu_csv(self):
+        """Does a CSV menu imported with `flask menu import` export back the same?"""
+        path = os.path.join(self.dir.name, 'menu.csv')
+        with open(path, 'w') as f:
+            f.write('name,meal_type,cost,description,vegetarian,ingredients,intolerants\n'
+                    'cli soup,appetizer,4.50,"hot\nsoup",true,Broth|Pasta,Gluten\n'
+                    'cli cake,dessert,6,,,Flour,\n')
+
+        result = self.runner.invoke(args=['menu', 'import', path, '--restaurant-id', str(self.r_id), '--batch-size', '1'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Imported 2 menu items', result.stderr)
+
+        soup = MenuItem.query.filter_by(name='cli soup').one()
+        self.assertEqual(soup.description, 'hot\nsoup')
+        self.assertTrue(soup.vegetarian)
+        self.assertEqual([r.id for r in soup.restaurants], [self.r_id])
+        self.assertEqual([i.name for i in soup.intolerants], ['Gluten'])
+
+        out = os.path.join(self.dir.name, 'menu.ndjson')
+        result = self.runner.invoke(args=['menu', 'export', '--format', 'ndjson', '--output', out, '--restaurant-id', str(self.r_id)])
+        self.assertEqual(result.exit_code, 0)
+
+        with open(out) as f:
+            exported = {item['name']: item for item in map(json.loads, f) if item['name'].startswith('cli ')}
+        self.assertEqual(exported['cli soup']['ingredients'], ['Broth', 'Pasta'])
+        self.assertEqual(exported['cli soup']['cost'], '4.50')
+        self.assertEqual(exported['cli cake']['intolerants'], [])
+        self.assertFalse(exported['cli cake']['vegetarian'])
+
+    def test_import_menu_json_array(self):
+        """Is a .json file read as a JSON array of items, and malformed JSON reported with its line?"""
+        path = os.path.join(self.dir.name, 'menu.json')
+        with open(path, 'w') as f:
+            json.dump([{'name': 'cli roll', 'meal_type': 'entree', 'cost': 7, 'ingredients': ['Rice']}], f, indent=2)
+
+        result = self.runner.invoke(args=['menu', 'import', path, '--restaurant-id', str(self.r_id)])
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        self.assertIn('Imported 1 menu items', result.stderr)
+        self.assertEqual([i.name for i in MenuItem.query.filter_by(name='cli roll').one().ingredients], ['Rice'])
+
+        with open(path, 'w') as f:
+            f.write('[\n  {"name": "cli broken",\n]\n')
+        result = self.runner.invoke(args=['menu', 'import', path, '--restaurant-id', str(self.r_id)])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('Line 3 is not valid JSON', result.stderr)
+
+        path = os.path.join(self.dir.name, 'menu.ndjson')
+        with open(path, 'w') as f:
+            f.write('{"name": "cli ok", "meal_type": "entree", "cost": 5}\n[1, 2]\n')
+        result = self.runner.invoke(args=['menu', 'import', path, '--restaurant-id', str(self.r_id)])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('Line 2 is not a JSON object', result.stderr)
+
+    def test_import_menu_bad_row(self):
+        path = os.path.join(self.dir.name, 'menu.ndjson')
+        with open(path, 'w') as f:
+            f.write('{"name": "cli ok", "meal_type": "entree", "cost": 5}\n{"name": "cli bad", "meal_type": "entree"}\n')
+
+        result = self.runner.invoke(args=['menu', 'import', path])
+
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIsNone(MenuItem.query.filter_by(name='cli ok').first())
@@ -0,0 +1,113 @@
+"""Tests for the menu snapshot cache"""
+
+# Run tests like:
+#
+#   python -m unittest tests/test_menu_cache.py
+# OR
+#   python -m unittest tests.test_menu_cache.MenuCacheTestCase.test_snapshot_hit_runs_no_queries
+
+import os
+from unittest import TestCase
+
+# Before importing app, set environmental variable to use a test db for tests
+
+os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
+
+# now import app
+
+from app import app
+# tests use models outside of requests, which needs an app context
+app.app_context().push()
+from models.db import db, QueryCounter
+from models.restaurant_models import Restaurant
+from models.item_models import Ingredient, Intolerant, MenuItem
+from models import menu_cache
+from models.menu_cache import get_menu_snapshot, get_menu_payload, clear_menu_cache
+
+# We create our tables here once for all tests, then in each test we'll delete the data and create fresh new clean test data
+db.drop_all()
+db.create_all()
+
+class MenuCacheTestCase(TestCase):
+    """Test the per restaurant menu snapshot cache"""
+
+    def setUp(self):
+        clear_menu_cache()
+
+        self.r = Restaurant(name='Test Restaurant', address='123 Main Street')
+        self.r.menu = [
+            MenuItem(name='soup', meal_type='appetizer', cost='4.50',
+                ingredients=[Ingredient(name='Broth')], intolerants=[Intolerant(name='Dairy')]),
+            MenuItem(name='steak', meal_type='entree', cost='24.00'),
+            MenuItem(name='salad', meal_type='appetizer', cost='6.00'),
+        ]
+        db.session.add(self.r)
+        db.session.commit()
+        self.restaurant_id = self.r.id
+
+    def tearDown(self):
+        db.session.rollback()
+        Restaurant.query.delete()
+        MenuItem.query.delete()
+        Ingredient.query.delete()
+        Intolerant.query.delete()
+        db.session.commit()
+
+    def test_snapshot_groups_by_meal_type(self):
+        """Are snapshot items grouped by meal_type, with their ingredients and intolerants?"""
+        snapshot = get_menu_snapshot(self.restaurant_id)
+
+        self.assertEqual(list(snapshot.by_type), ['appetizer', 'entree'])
+        self.assertEqual([i['name'] for i in snapshot.by_type['appetizer']], ['soup', 'salad'])
+        self.assertEqual(snapshot.items[0]['Ingredients'], ['Broth'])
+        self.assertEqual(snapshot.items[0]['Intolerants'], ['Dairy'])
+
+    def test_snapshot_hit_runs_no_queries(self):
+        """Is a cached snapshot returned without touching the database?"""
+        snapshot = get_menu_snapshot(self.restaurant_id)
+
+        with QueryCounter() as counter:
+            cached = get_menu_snapshot(self.restaurant_id)
+
+        self.assertIs(cached, snapshot)
+        self.assertEqual(counter.count, 0)
+
+    def test_stock_change_invalidates_snapshot(self):
+        """Does committing a menu item change rebuild the snapshot?"""
+        snapshot = get_menu_snapshot(self.restaurant_id)
+
+        MenuItem.query.filter_by(name='steak').one().in_stock = False
+        db.session.commit()
+
+        rebuilt = get_menu_snapshot(self.restaurant_id)
+        self.assertIsNot(rebuilt, snapshot)
+        self.assertFalse(rebuilt.by_type['entree'][0]['in_stock'])
+
+    def test_new_item_invalidates_snapshot(self):
+        """Does MenuItem.add_new_item() show up on the next snapshot?"""
+        get_menu_snapshot(self.restaurant_id)
+
+        MenuItem.add_new_item({'name': 'cake', 'meal_type': 'dessert', 'cost': 5, 'description': 'chocolate',
+                               'ingredients': [], 'intolerants': []})
+
+        self.assertIn('dessert', get_menu_snapshot(self.restaurant_id).by_type)
+
+    def test_rollback_keeps_snapshot(self):
+        """Are changes that are rolled back ignored?"""
+        snapshot = get_menu_snapshot(self.restaurant_id)
+
+        self.r.menu[0].name = 'stew'
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertIs(get_menu_snapshot(self.restaurant_id), snapshot)
+
+    def test_payloads_are_bounded(self):
+        """Are the least recently built payloads dropped past MAX_PAYLOADS?"""
+        for key in range(menu_cache.MAX_PAYLOADS + 10):
+            get_menu_payload(('test', key), lambda: [])
+
+        self.assertEqual(len(menu_cache._payloads), menu_cache.MAX_PAYLOADS)
+        self.assertNotIn(('test', 0), menu_cache._payloads)
+        self.assertIn(('test', menu_cache.MAX_PAYLOADS + 9), menu_cache._payloads)
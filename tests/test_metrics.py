@@ -0,0 +1,107 @@
+"""Tests for the Prometheus metrics endpoint"""
+
+# Run tests like:
+#
+#   python -m unittest tests/test_metrics.py
+# OR
+#   python -m unittest tests.test_metrics.MetricsTestCase.test_request_latency_recorded
+
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+# Before importing app, set environmental variable to use a test db for tests
+
+os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
+
+# now import app
+from app import app
+# tests use models outside of requests, which needs an app context
+app.app_context().push()
+from models.db import db
+from models.item_models import MenuItem
+from models.order_models import Order, OrderedItems
+from models.order_events import publish_order_event
+from models.restaurant_models import Restaurant
+from models.metrics import counters
+
+# We create our tables here once for all tests, then in each test we'll delete the data and create fresh new clean test data
+db.drop_all()
+db.create_all()
+
+class MetricsTestCase(TestCase):
+    """Test request and order metrics served at /metrics"""
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.r = Restaurant(name='Test Restaurant', address='123 Main Street')
+        db.session.add(self.r)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        Order.query.delete()
+        MenuItem.query.delete()
+        Restaurant.query.delete()
+        db.session.commit()
+
+    def test_request_latency_recorded(self):
+        """Are requests timed by blueprint and route pattern, and counted by status?"""
+        self.client.get('/omakase/api/menu/999999')
+
+        metrics = self.client.get('/metrics').get_data(as_text=True)
+
+        self.assertIn('omakase_request_duration_seconds_count{blueprint="api",route="/omakase/api/menu/<int:id>"} 1', metrics)
+        self.assertIn('omakase_request_duration_seconds_bucket{blueprint="api",route="/omakase/api/menu/<int:id>",le="+Inf"} 1', metrics)
+        self.assertIn('omakase_requests_total{blueprint="api",status="404"} 1', metrics)
+
+    def test_order_throughput_counted(self):
+        """Are orders created and closed, items added and active orders counted per restaurant?"""
+        item = MenuItem(name='test item', meal_type='entree', cost=5)
+        db.session.add(item)
+        db.session.commit()
+
+        order = Order.create(type='Takeout', restaurant_id=self.r.id)
+        OrderedItems.add_items(order.id, {item.id: 3})
+        Order.create(type='Takeout', restaurant_id=self.r.id).close()
+
+        # rolled back, so never counted
+        order = Order(type='Takeout', restaurant_id=self.r.id)
+        db.session.add(order)
+        db.session.flush()
+        publish_order_event('order_created', order.id, self.r.id)
+        db.session.rollback()
+
+        metrics = self.client.get('/metrics').get_data(as_text=True).splitlines()
+        self.assertIn(f'omakase_orders_closed_total{{restaurant_id="{self.r.id}"}} 1', metrics)
+        self.assertIn(f'omakase_items_added_total{{restaurant_id="{self.r.id}"}} 3', metrics)
+        self.assertIn(f'omakase_orders_created_total{{restaurant_id="{self.r.id}"}} 2', metrics)
+        self.assertIn(f'omakase_active_orders{{restaurant_id="{self.r.id}"}} 1', metrics)
+
+    def test_workers_added_up(self):
+        """With METRICS_DIR, does every scrape add up every worker's counters, including exited ones'?"""
+        with TemporaryDirectory() as directory:
+            counters.directory = directory
+            try:
+                self.client.get('/omakase/api/menu/999999')
+                mine = self.client.get('/metrics').get_data(as_text=True).splitlines()
+                line = next(line for line in mine if line.startswith('omakase_requests_total{blueprint="api",status="404"}'))
+                count = int(line.split()[-1])
+
+                # another worker's file, left behind after it exited
+                with open(os.path.join(directory, '1.json'), 'w') as f:
+                    json.dump([['omakase_requests_total', [['blueprint', 'api'], ['status', '404']], 5]], f)
+
+                metrics = self.client.get('/metrics').get_data(as_text=True).splitlines()
+                self.assertIn(f'omakase_requests_total{{blueprint="api",status="404"}} {count + 5}', metrics)
+                self.assertTrue(os.path.exists(os.path.join(directory, f'{os.getpid()}.json')))
+            finally:
+                counters.directory = None
+
+    def test_public_address_not_served(self):
+        """Is /metrics hidden from public addresses?"""
+        resp = self.client.get('/metrics', environ_base={'REMOTE_ADDR': '8.8.8.8'})
+
+        self.assertEqual(resp.status_code, 404)
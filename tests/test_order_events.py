@@ -0,0 +1,89 @@
+"""Tests for real-time order events"""
+
+# Run tests like:
+#
+#   python -m unittest tests/test_order_events.py
+# OR
+#   python -m unittest tests.test_order_events.OrderEventsTestCase.test_create_publishes_event
+
+import os
+from queue import Empty
+from unittest import TestCase
+
+# Before importing app, set environmental variable to use a test db for tests
+
+os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
+
+# now import app
+from app import app
+# tests use models outside of requests, which needs an app context
+app.app_context().push()
+from models.db import db
+from models.item_models import MenuItem
+from models.order_models import Order, OrderedItems
+from models.order_events import order_event_bus, publish_order_event, SUBSCRIBER_QUEUE_SIZE
+
+# We create our tables here once for all tests, then in each test we'll delete the data and create fresh new clean test data
+db.drop_all()
+db.create_all()
+
+class OrderEventsTestCase(TestCase):
+    """Test order events published through LISTEN/NOTIFY"""
+
+    def setUp(self):
+        self.queue = order_event_bus.subscribe()
+
+    def tearDown(self):
+        order_event_bus.unsubscribe(self.queue)
+        db.session.rollback()
+        Order.query.delete()
+        MenuItem.query.delete()
+        db.session.commit()
+
+    def test_create_publishes_event(self):
+        """Does creating an order publish order_created once committed?"""
+        order = Order.create(type='Takeout')
+
+        self.assertEqual(self.queue.get(timeout=5), {'event': 'order_created', 'order_id': order.id, 'restaurant_id': None})
+
+    def test_close_and_assistance_events(self):
+        """Are closing an order and asking for assistance told apart?"""
+        order = Order.create(type='Takeout')
+        self.queue.get(timeout=5)
+
+        order.update({'need_assistance': True})
+        self.assertEqual(self.queue.get(timeout=5)['event'], 'need_assistance')
+
+        order.close()
+        self.assertEqual(self.queue.get(timeout=5), {'event': 'order_closed', 'order_id': order.id, 'restaurant_id': None})
+
+    def test_items_added_event(self):
+        item = MenuItem(name='test item', meal_type='entree', cost=5)
+        order = Order(type='Takeout')
+        db.session.add_all([item, order])
+        db.session.commit()
+
+        OrderedItems.add_items(order.id, {item.id: 2})
+
+        self.assertEqual(self.queue.get(timeout=5), {'event': 'items_added', 'order_id': order.id, 'restaurant_id': None, 'quantity': 2})
+
+    def test_rollback_publishes_nothing(self):
+        """Are events from a rolled back transaction dropped?"""
+        order = Order(type='Takeout')
+        db.session.add(order)
+        db.session.flush()
+        publish_order_event('order_created', order.id)
+        db.session.rollback()
+
+        with self.assertRaises(Empty):
+            self.queue.get(timeout=1)
+
+    def test_slow_subscriber_dropped(self):
+        """Is a subscriber that stops reading dropped once its queue is full, so its stream can end?"""
+        for i in range(SUBSCRIBER_QUEUE_SIZE):
+            order_event_bus.dispatch({'event': 'order_updated', 'order_id': i, 'restaurant_id': None})
+        self.assertTrue(order_event_bus.is_subscribed(self.queue))
+
+        order_event_bus.dispatch({'event': 'order_updated', 'order_id': -1, 'restaurant_id': None})
+        self.assertFalse(order_event_bus.is_subscribed(self.queue))
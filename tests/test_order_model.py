@@ -14,10 +14,13 @@ from datetime import date, datetime
 # Before importing app, set environmental variable to use a test db for tests
 
 os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
 
 # now import app
 from app import app
-from models.db import db
+# tests use models outside of requests, which needs an app context
+app.app_context().push()
+from models.db import db, QueryCounter
 from models.restaurant_models import Restaurant
 from models.user_models import User, Role, Group
 from models.item_models import Ingredient, Intolerant, MenuItem
@@ -153,6 +156,40 @@ class OrderModelTestCase(TestCase):
         self.assertIsInstance(self.test_order.total_cost, Decimal)    
         self.assertNotEqual(self.test_order.total_cost, 0)
         
+    def test_order_total_cost(self):
+        """Is total_cost quantity * cost, plus delivery cost for deliveries?"""
+        self.assertEqual(self.test_order.total_cost, Decimal('9.00'))
+
+        self.test_order.update({'type': 'Delivery'})
+        self.assertEqual(self.test_order.total_cost, Decimal('14.00'))
+
+    def test_order_totals_batch(self):
+        """Does Order.totals() get totals for many orders in one query?"""
+        empty_order = Order(employee_id=self.e.id, type='Delivery')
+        db.session.add(empty_order)
+        db.session.commit()
+
+        order_ids = [self.test_order.id, empty_order.id]
+
+        with QueryCounter() as counter:
+            totals = Order.totals(order_ids)
+
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(totals[order_ids[0]], Decimal('9.00'))
+        self.assertEqual(totals[order_ids[1]], Decimal('5.00'))
+
+    def test_order_total_cost_expression(self):
+        """Can orders be filtered and sorted by total_cost in SQL?"""
+        cheap_order = Order(employee_id=self.e.id, type='Takeout')
+        db.session.add(cheap_order)
+        db.session.commit()
+
+        expensive = Order.query.filter(Order.total_cost > 5).all()
+        by_total = Order.query.order_by(Order.total_cost.desc()).all()
+
+        self.assertEqual(expensive, [self.test_order])
+        self.assertEqual(by_total, [self.test_order, cheap_order])
+
     def test_order_serialize(self):
         """Does the Order.serialize() class method return a JSON ready format?"""
         serialized = Order.serialize(self.test_order)
@@ -179,4 +216,86 @@ class OrderModelTestCase(TestCase):
 
         self.test_order.update({'type': 'Delivery', 'active': False})
         self.assertEqual(self.test_order.type, "Delivery")
-        self.assertEqual(self.test_order.active, False)
\ No newline at end of file
+        self.assertEqual(self.test_order.active, False)
+
+    def test_orders_scoped_by_restaurant(self):
+        """Do Order.filtered() and Order.kitchen_tickets() only return the given restaurant's orders?"""
+        other = Restaurant(name='Other Restaurant', address='9 Side Street')
+        db.session.add(other)
+        db.session.commit()
+
+        ours = Order.create(type='Takeout', restaurant_id=self.r.id)
+        theirs = Order.create(type='Takeout', restaurant_id=other.id)
+
+        self.assertEqual(Order.filtered(restaurant_id=self.r.id).all(), [ours])
+        tickets, cursor = Order.kitchen_tickets(restaurant_id=other.id)
+        self.assertEqual([ticket['id'] for ticket in tickets], [theirs.id])
+
+        Order.query.delete()
+        db.session.delete(other)
+        db.session.commit()
+
+    def test_available_tables_scoped_by_restaurant(self):
+        """Does Table.available() only list the restaurant's free tables?"""
+        tables = [
+            Table(restaurant_id=self.r.id),
+            Table(restaurant_id=self.r.id, taken=True),
+            Table(),
+        ]
+        db.session.add_all(tables)
+        db.session.commit()
+
+        self.assertEqual(Table.available(self.r.id).all(), [tables[0]])
+
+        Table.query.delete()
+        db.session.commit()
+
+class OrderCommandTestCase(TestCase):
+    """Test the `flask orders` commands"""
+
+    def setUp(self):
+        db.session.rollback()
+        self.runner = app.test_cli_runner(mix_stderr=False)
+
+    def tearDown(self):
+        db.session.rollback()
+        Order.query.delete()
+        Table.query.delete()
+        User.query.delete()
+        Restaurant.query.delete()
+        db.session.commit()
+
+    def test_migrate_restaurants(self):
+        """Does `flask orders migrate-restaurants` give orders and tables from before restaurants a restaurant?"""
+        first = Restaurant(name='First Restaurant')
+        second = Restaurant(name='Second Restaurant')
+        db.session.add_all([first, second])
+        db.session.commit()
+        employee = User(name='Second Employee', restaurant_id=second.id)
+        db.session.add(employee)
+        db.session.commit()
+        # the command's app context ends the session, detaching these
+        first_id, second_id, employee_id = first.id, second.id, employee.id
+
+        # orders and tables as they were, without a restaurant
+        db.session.execute('ALTER TABLE orders DROP COLUMN restaurant_id')
+        db.session.execute('ALTER TABLE tables DROP COLUMN restaurant_id')
+        db.session.commit()
+        table_id = db.session.execute('INSERT INTO tables (taken) VALUES (false) RETURNING id').scalar()
+        db.session.execute("INSERT INTO orders (table_number, employee_id, type, active, need_assistance, timestamp, updated_at) VALUES "
+                           "(:table, NULL, 'Dining In', true, false, now(), now()), "
+                           "(NULL, :employee, 'Takeout', true, false, now(), now()), "
+                           "(NULL, NULL, 'Delivery', true, false, now(), now())", {'table': table_id, 'employee': employee_id})
+        db.session.commit()
+
+        result = self.runner.invoke(args=['orders', 'migrate-restaurants', '--restaurant-id', str(first_id), '--batch-size', '2'])
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        self.assertIn('1 tables and 3 orders', result.stderr)
+
+        self.assertEqual([table.restaurant_id for table in Table.query.all()], [first_id])
+        self.assertEqual([order.restaurant_id for order in Order.query.order_by(Order.id)], [first_id, second_id, first_id])
+        self.assertTrue(db.session.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = 'ix_orders_restaurant_id_active_timestamp_id'::regclass").scalar())
+
+        # running it again changes nothing
+        result = self.runner.invoke(args=['orders', 'migrate-restaurants'])
+        self.assertIn('0 tables and 0 orders', result.stderr)
@@ -12,7 +12,7 @@ from flask import session
 from unittest import TestCase
 
 # import models
-from models.db import db
+from models.db import db, query_budget
 from models.restaurant_models import Restaurant
 from models.user_models import Role, Group, User
 from models.order_models import Order, Table
@@ -20,9 +20,12 @@ from models.item_models import Ingredient, Intolerant
 
 # Before importing app, set environmental variable to use a test db for tests
 os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
 
 # Now import app
 from app import app
+# tests use models outside of requests, which needs an app context
+app.app_context().push()
 app.config['WTF_CSRF_ENABLED'] = False
 
 # Make Flask errors be real errors, not HTML pages with error info
@@ -119,6 +122,18 @@ class OrderTestCase(TestCase):
         self.assertIn('Itemized Bill', html)
         self.assertIn('Menu', html)
 
+    def test_order_page_query_budget(self):
+        """Does the order page run a fixed number of queries, with the time in Server-Timing?"""
+        with self.client.session_transaction() as session:
+                session['current_order_id'] = self.test_order.id
+                session['restaurant_id'] = self.test_restaurant.id
+
+        with query_budget(4):
+            resp = self.client.get('/order')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertRegex(resp.headers['Server-Timing'], r'^db;dur=[\d.]+;desc="\d queries"$')
+
     def test_takeout_route(self):
         resp = self.client.get('/takeout')
 
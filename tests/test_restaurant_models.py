@@ -14,9 +14,12 @@ from datetime import date, datetime
 # Before importing app, set environmental variable to use a test db for tests
 
 os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
 
 # now import app
 from app import app
+# tests use models outside of requests, which needs an app context
+app.app_context().push()
 from models.db import db
 from models.restaurant_models import Restaurant, Table
 
@@ -8,20 +8,27 @@
 
 import os
 from unittest import TestCase
+from sqlalchemy.exc import IntegrityError
 
 from datetime import date
 # Before importing app, set environmental variable to use a test db for tests
 
 os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
 
 # now import app
 
 import datetime
 from app import app
-from models.db import db
+# tests use models outside of requests, which needs an app context
+app.app_context().push()
+from models.db import db, QueryCounter
 from models.restaurant_models import Restaurant
+from models.passwords import hash_password, hash_rounds
 from models.user_models import User, Role, Group
+from models.user_cache import get_principal, clear_principal_cache
 from models.item_models import Ingredient, Intolerant, MenuItem
+from models.order_models import Order, CustomerOrder
 
 # We create our tables here once for all tests, then in each test we'll delete the data and create fresh new clean test data
 db.drop_all()
@@ -196,6 +203,66 @@ class UserModelTestCase(TestCase):
         self.assertEqual('manager', new_employee.roles[0].name)
         self.assertEqual("employee", new_employee.groups[0].name)
 
+    def test_authenticate_rehashes_old_cost(self):
+        """Is a password hashed with another cost rehashed with BCRYPT_LOG_ROUNDS on login?"""
+        self.e.uname = 'rehash1'
+        self.e.password = hash_password('testpassword123', rounds=5)
+        db.session.commit()
+
+        self.assertIsNone(User.Authenticate('rehash1', 'wrongpassword'))
+        self.assertEqual(hash_rounds(self.e.password), 5)
+
+        self.assertEqual(User.Authenticate('rehash1', 'testpassword123'), self.e)
+        self.assertEqual(hash_rounds(self.e.password), app.config['BCRYPT_LOG_ROUNDS'])
+        self.assertEqual(User.Authenticate('rehash1', 'testpassword123'), self.e)
+
+    def test_username_assigned_on_insert(self):
+        """Is the default username assigned by the insert, and normalized for logins?"""
+        e = User(name='New Hire', password=User.hash_pw('newhire123'))
+        db.session.add(e)
+        db.session.flush()
+
+        # read back by the insert itself
+        with QueryCounter() as counter:
+            self.assertEqual(e.username, f'NewHire{e.id}')
+            self.assertEqual(e.username_normalized, f'newhire{e.id}')
+        self.assertEqual(counter.count, 0)
+        db.session.commit()
+
+        self.assertEqual(User.Authenticate(f' NEWHIRE{e.id} ', 'newhire123'), e)
+
+    def test_username_unique_ignoring_case(self):
+        """Can two users have usernames differing only in case?"""
+        self.e.uname = 'SameName'
+        db.session.commit()
+
+        db.session.add(User(name='Other', uname='samename'))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+    def test_login_uses_username_index(self):
+        """Can logins look users up through the partial unique index on username_normalized?"""
+        query = User.by_username('test123')
+        sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+
+        # the table is too small for the planner to pick an index on its own
+        db.session.execute('SET LOCAL enable_seqscan = off')
+        plan = '\n'.join(row[0] for row in db.session.execute(f'EXPLAIN {sql}'))
+        db.session.rollback()
+
+        self.assertIn('ux_users_username_normalized', plan)
+
+    def test_temp_customer_has_no_username(self):
+        """Are temporary customers left without a username an employee could want?"""
+        customer = User.register_customer({'contact_info': {'name': 'Jane Smith', 'phone_number': '123-555-5678'}})
+        self.assertIsNone(customer.uname)
+        self.assertIsNone(customer.username_normalized)
+
+        # the username the customer would have had by default
+        db.session.add(User(name='Jane Smith', uname=f'JaneSmith{customer.id}'))
+        db.session.commit()
+
     def test_register_customer(self):
         # Prepare test customer data
         customer_data = {
@@ -246,6 +313,42 @@ class UserModelTestCase(TestCase):
         self.assertTrue(new_customer.temp)
         self.assertIn(Group.query.filter_by(name='customer').first(), new_customer.groups)
 
+    def test_register_customer_returning(self):
+        """Does a returning customer, by phone number, reuse their row?"""
+        first = User.register_customer({'contact_info': {'name': 'Jane Smith', 'phone_number': '123-555-5678'},
+                                        'address': {'street': '456 Oak Rd', 'city': 'Anytown', 'state': 'CA', 'zip_code': '12345'}})
+        again = User.register_customer({'contact_info': {'name': 'Jane S', 'phone_number': '123-555-5678'}})
+        other = User.register_customer({'contact_info': {'name': 'Jane Smith', 'phone_number': '123-555-0000'}})
+
+        self.assertEqual(again.id, first.id)
+        self.assertEqual(again.name, 'Jane S')
+        self.assertEqual(again.address, '456 Oak Rd, Anytown, CA, 12345')
+        self.assertNotEqual(other.id, first.id)
+        self.assertEqual(User.query.filter_by(temp=True).count(), 2)
+
+    def test_purge_temp_customers(self):
+        """Are only temporary customers not seen for longer than the retention period deleted, with their order links?"""
+        stale = [User.register_customer({'contact_info': {'name': f'Stale {i}', 'phone_number': f'555-000{i}'}}) for i in range(5)]
+        recent = User.register_customer({'contact_info': {'name': 'Recent', 'phone_number': '555-1111'}})
+        order = Order.create(type='Takeout')
+        order.customers = [stale[0], recent]
+        db.session.commit()
+
+        stale_ids = [c.id for c in stale]
+        User.query.filter(User.id.in_(stale_ids)).update({'last_seen_at': datetime.datetime(2020, 1, 1)}, synchronize_session=False)
+        # employees are never temporary, however old
+        self.e.last_seen_at = datetime.datetime(2020, 1, 1)
+        db.session.commit()
+
+        self.assertEqual(list(User.purge_temp_customers(datetime.timedelta(days=30), batch_size=2)), [2, 2, 1])
+
+        self.assertEqual(User.query.filter(User.id.in_(stale_ids)).count(), 0)
+        self.assertEqual(db.session.query(CustomerOrder.customer_id).filter_by(order_id=order.id).all(), [(recent.id,)])
+        self.assertIsNotNone(User.query.get(recent.id))
+        self.assertIsNotNone(User.query.get(self.e.id))
+        Order.query.delete()
+        db.session.commit()
+
     def test_delete_user(self):
         test_employee = self.e
 
@@ -254,4 +357,100 @@ class UserModelTestCase(TestCase):
         res = User.query.filter_by(id=test_employee.id).first()
         print(res)
         self.assertIsNone(res)
-        
\ No newline at end of file
+        
+
+    def test_principal_cached(self):
+        """Is a user's principal, with role and group names, cached until they're deleted?"""
+        clear_principal_cache()
+        principal = get_principal(self.e.id)
+
+        self.assertEqual(principal.username, self.e.username)
+        self.assertEqual([role.name for role in principal.roles], ['waitstaff'])
+        self.assertEqual([group.name for group in principal.groups], ['employee'])
+
+        with QueryCounter() as counter:
+            self.assertIs(get_principal(self.e.id), principal)
+        self.assertEqual(counter.count, 0)
+
+        User.delete(self.e.id)
+        self.assertIsNone(get_principal(self.e.id))
+
+class UserCommandTestCase(TestCase):
+    """Test the `flask users` commands"""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        db.session.commit()
+        self.runner = app.test_cli_runner(mix_stderr=False)
+
+    def tearDown(self):
+        db.session.rollback()
+        User.query.delete()
+        db.session.commit()
+
+    def test_migrate_usernames(self):
+        """Does `flask users migrate-usernames` bring a database from before the trigger up to date?"""
+        # users as they were, without usernames until first read
+        db.session.execute('DROP TRIGGER users_assign_username ON users')
+        db.session.execute('ALTER TABLE users DROP COLUMN username_normalized')
+        db.session.execute(User.__table__.insert(), [{'name': f'Old Timer {i}', 'uname': None, 'temp': False} for i in range(5)]
+                           + [{'name': 'Named', 'uname': ' Chef ', 'temp': False}, {'name': 'Customer', 'uname': 'Customer1', 'temp': True}])
+        db.session.commit()
+
+        result = self.runner.invoke(args=['users', 'migrate-usernames', '--batch-size', '2'])
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        self.assertIn('Backfilled 7 users', result.stderr)
+
+        users = User.query.order_by(User.id).all()
+        self.assertEqual([(u.uname, u.username_normalized) for u in users[:2]],
+                         [(f'OldTimer0{users[0].id}', f'oldtimer0{users[0].id}'), (f'OldTimer1{users[1].id}', f'oldtimer1{users[1].id}')])
+        self.assertEqual(users[-2].username_normalized, 'chef')
+        self.assertEqual((users[-1].uname, users[-1].username_normalized), (None, None))
+        self.assertEqual(db.session.execute("SELECT indisvalid, indpred IS NOT NULL FROM pg_index WHERE indexrelid = 'ux_users_username_normalized'::regclass").first(),
+                         (True, True))
+
+        # the trigger is back for new users, and running it again changes nothing
+        new = User(name='New Hire')
+        db.session.add(new)
+        db.session.commit()
+        self.assertEqual(new.username_normalized, f'newhire{new.id}')
+        self.assertEqual(self.runner.invoke(args=['users', 'migrate-usernames']).exit_code, 0)
+
+    def test_migrate_usernames_partial_index(self):
+        """Is a unique index on every user, from before temporary customers had no usernames, made partial?"""
+        db.session.execute('DROP INDEX ux_users_username_normalized')
+        db.session.execute('CREATE UNIQUE INDEX ux_users_username_normalized ON users (username_normalized)')
+        db.session.commit()
+
+        result = self.runner.invoke(args=['users', 'migrate-usernames'])
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        self.assertEqual(db.session.execute("SELECT indisvalid, indpred IS NOT NULL FROM pg_index WHERE indexrelid = 'ux_users_username_normalized'::regclass").first(),
+                         (True, True))
+        self.assertIsNone(db.session.execute("SELECT to_regclass('ux_users_username_normalized_partial')").scalar())
+
+    def test_migrate_usernames_duplicates(self):
+        """Are usernames differing only in case reported instead of failing the index build?"""
+        db.session.execute('DROP INDEX ux_users_username_normalized')
+        db.session.add_all([User(name='A', uname='Dup'), User(name='B', uname='dup')])
+        db.session.commit()
+
+        result = self.runner.invoke(args=['users', 'migrate-usernames'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('dup', result.stderr)
+
+        User.query.filter_by(uname='dup').delete()
+        db.session.commit()
+        self.assertEqual(self.runner.invoke(args=['users', 'migrate-usernames']).exit_code, 0)
+
+    def test_purge_temp_customers(self):
+        """Does `flask users purge-temp-customers` delete customers older than TEMP_CUSTOMER_RETENTION_DAYS?"""
+        days = app.config['TEMP_CUSTOMER_RETENTION_DAYS']
+        db.session.add_all([User(name='Stale', temp=True, last_seen_at=datetime.datetime.now() - datetime.timedelta(days=days + 1)),
+                            User(name='Recent', temp=True, last_seen_at=datetime.datetime.now() - datetime.timedelta(days=days - 1))])
+        db.session.commit()
+
+        result = self.runner.invoke(args=['users', 'purge-temp-customers'])
+        self.assertEqual(result.exit_code, 0, result.stderr)
+        self.assertIn('Deleted 1 temporary customers', result.stderr)
+        self.assertEqual([u.name for u in User.query.all()], ['Recent'])
@@ -9,22 +9,28 @@
 import os
 # from dotenv import load_env
 # from flask import get_flashed_messages, session
+from flask import g
 from flask_login import login_user, logout_user
 from psycopg2 import IntegrityError
 from unittest import TestCase
 
 # import models
-from models.db import db
+from models.db import db, QueryCounter, query_budget
 from models.restaurant_models import Restaurant
 from models.user_models import Role, Group, User
 from models.order_models import Order, Table
 from models.item_models import Ingredient, Intolerant, MenuItem
+from models.user_cache import clear_principal_cache, get_principal
+from models.order_events import order_event_bus, SUBSCRIBER_QUEUE_SIZE
 
 # Before importing app, set environmental variable to use a test db for tests
 os.environ['DATABASE_URL'] = 'postgresql:///omakase-test'
+os.environ['APP_CONFIG'] = 'testing'
 
 # Now import app
 from app import app
+# tests use models outside of requests, which needs an app context
+app.app_context().push()
 app.config['WTF_CSRF_ENABLED'] = False
 
 # Make Flask errors be real errors, not HTML pages with error info
@@ -124,6 +130,23 @@ class EmployeeTestCase(TestCase):
             self.assertEqual(resp.status_code, 401)
             # self.assertRaises(IntegrityError)
 
+    def test_logged_in_user_cached(self):
+        """Is the logged in user loaded once, then authorized without queries?"""
+        clear_principal_cache()
+        # other tests log in through the shared app context, make these requests use the session
+        g.pop('_login_user', None)
+        self.client.post('/login', data={'username': 'testA1', 'password': '123test123'})
+
+        for expected_queries in (1, 0):
+            g.pop('_login_user', None)
+            with QueryCounter() as counter:
+                resp = self.client.get('/employees/kitchen-dashboard')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(counter.count, expected_queries)
+
+        g.pop('_login_user', None)
+
     def test_get_add_employee(self):
         with app.test_request_context('/employees/add-employee'):
             login_user(self.e)
@@ -332,6 +355,40 @@ class EmployeeTestCase(TestCase):
             self.assertIn('Employee List', html)
             self.assertIn('test manager', html)
 
+    def test_employee_list_filtered_paged(self):
+        """Does the employee list page through employees only, filtered by name and role, in a fixed number of queries?"""
+        kitchen = Role.query.filter_by(name='kitchen').first()
+        employee = Group.query.filter_by(name='employee').first()
+        db.session.add_all([User(name=f'cook {i:02}', roles=[kitchen], groups=[employee]) for i in range(60)])
+        db.session.commit()
+        User.register_customer({'contact_info': {'name': 'test customer', 'phone_number': '555-0000'}})
+
+        with app.test_request_context('/employees/list'):
+            # logged in as the app's user loader does, with roles and groups already loaded
+            login_user(get_principal(self.e.id))
+
+            # a page, its employees' roles and groups, the count and the role filter's options
+            with query_budget(5):
+                resp = self.client.get('/employees/list')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('cook 00', html)
+            self.assertIn('Page 1 of 2', html)
+            self.assertNotIn('test manager', html)
+            self.assertNotIn('test customer', html)
+
+            html = self.client.get('/employees/list?page=2').get_data(as_text=True)
+            self.assertIn('test manager', html)
+            self.assertNotIn('cook 00', html)
+            self.assertNotIn('test customer', html)
+
+            html = self.client.get('/employees/list?name=COOK 5&role=kitchen').get_data(as_text=True)
+            self.assertIn('cook 55', html)
+            self.assertNotIn('cook 49', html)
+            self.assertNotIn('test manager', html)
+            self.assertNotIn('Page 1', html)
+
     def test_show_employee_dashboard(self):
         with app.test_request_context('/employees/employee-dashboard'):
             login_user(self.e)
@@ -346,6 +403,54 @@ class EmployeeTestCase(TestCase):
             self.assertIn('Employee Dashboard', html)
             self.assertIn(f'Order #{self.test_order.id}', html)
 
+    def test_dashboard_events(self):
+        """Does the event stream send only the session's restaurant's events, and end once dropped?"""
+        with app.test_request_context('/employees/dashboard/events'):
+            login_user(self.e)
+            with self.client.session_transaction() as session:
+                session['restaurant_id'] = self.test_restaurant.id
+            restaurant_id = self.test_restaurant.id
+
+            resp = self.client.get('/employees/dashboard/events')
+            chunks = iter(resp.response)
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            self.assertEqual(next(chunks), b'retry: 3000\n\n')
+
+            order_event_bus.dispatch({'event': 'order_created', 'order_id': -1, 'restaurant_id': restaurant_id + 1})
+            order_event_bus.dispatch({'event': 'order_created', 'order_id': -2, 'restaurant_id': restaurant_id})
+            self.assertEqual(next(chunks), f'event: order_created\ndata: {{"event": "order_created", "order_id": -2, "restaurant_id": {restaurant_id}}}\n\n'.encode())
+
+            # falling behind drops the stream's queue, which ends the stream for the browser to reconnect
+            for i in range(SUBSCRIBER_QUEUE_SIZE + 1):
+                order_event_bus.dispatch({'event': 'order_updated', 'order_id': i, 'restaurant_id': restaurant_id + 1})
+            self.assertEqual(list(chunks), [])
+            resp.close()
+
+    def test_dashboard_order_card_restaurant(self):
+        """Are other restaurants' order cards hidden from the dashboard?"""
+        other = Restaurant(name='other restaurant', address='2 Test St.')
+        db.session.add(other)
+        db.session.commit()
+        ours = Order(type='Takeout', restaurant_id=self.test_restaurant.id)
+        theirs = Order(type='Takeout', restaurant_id=other.id)
+        db.session.add_all([ours, theirs])
+        db.session.commit()
+        ours_id, theirs_id = ours.id, theirs.id
+
+        with app.test_request_context('/employees/dashboard/orders'):
+            login_user(self.e)
+            with self.client.session_transaction() as session:
+                session['restaurant_id'] = self.test_restaurant.id
+
+            resp = self.client.get(f'/employees/dashboard/orders/{ours_id}')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'Order #{ours_id}', resp.get_data(as_text=True))
+            self.assertEqual(self.client.get(f'/employees/dashboard/orders/{theirs_id}').status_code, 404)
+
+        Order.query.filter(Order.id.in_([ours_id, theirs_id])).delete(synchronize_session=False)
+        Restaurant.query.filter_by(name='other restaurant').delete()
+        db.session.commit()
+
     def test_delete_employee(self):
         """DELETE /employees/<id>/delete
         
@@ -362,6 +467,28 @@ class EmployeeTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(f"Deleted user {deleted_id}", html)
 
+    def test_delete_employee_other_restaurant(self):
+        """Can't a manager delete another restaurant's employee?"""
+        other = Restaurant(name='other restaurant', address='2 Test St.')
+        db.session.add(other)
+        db.session.commit()
+        self.e2.restaurant_id = other.id
+        db.session.commit()
+        e2_id = self.e2.id
+
+        with app.test_request_context('/employees/list'):
+            login_user(self.e)
+            with self.client.session_transaction() as session:
+                session['restaurant_id'] = self.test_restaurant.id
+
+            resp = self.client.post(f"/employees/{e2_id}/delete")
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertIsNotNone(User.query.get(e2_id))
+        User.query.filter_by(id=e2_id).delete()
+        Restaurant.query.filter_by(name='other restaurant').delete()
+        db.session.commit()
+
     def test_delete_employee_not_self(self):
         """Managers can't delete themselves. 
         This is to prevent losing access to manager privileges